@@ -0,0 +1,253 @@
+import argparse
+import io
+import itertools
+import json
+import multiprocessing
+import platform
+import resource
+import time
+from queue import Empty
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+
+from src.utils import get_loader_kwargs
+
+# python src/data/benchmark_loaders.py --project 1 --data_path /dtu/datasets1/02514/hotdog_nothotdog --num_workers 0 4 8 16 --batch_size 32 64 --profile loader_profile.json
+
+# (source size, resized size) of the images of every project for synthetic data
+SYNTHETIC_SIZES = {1: ((512, 512), (224, 224)), 2: ((584, 565), (256, 256)), 4: ((1024, 768), (512, 512))}
+
+
+class SyntheticImages(Dataset):
+    '''
+    Stand-in for a project's dataset without the data: random JPEGs are decoded and resized
+    per sample like the real images, and returned as (3, H, W) uint8 tensors with a label.
+    '''
+    def __init__(self, num_samples, source_size, img_size, num_distinct=16, seed=0):
+        self.num_samples = num_samples
+        self.img_size = img_size
+        rng = np.random.default_rng(seed)
+        self.encoded = []
+        for _ in range(num_distinct):
+            buffer = io.BytesIO()
+            Image.fromarray(rng.integers(0, 256, source_size[::-1] + (3,), dtype=np.uint8)).save(buffer, format='JPEG', quality=90)
+            self.encoded.append(buffer.getvalue())
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, idx):
+        image = Image.open(io.BytesIO(self.encoded[idx % len(self.encoded)])).convert('RGB').resize(self.img_size[::-1])
+        return torch.from_numpy(np.asarray(image).copy()).permute(2, 0, 1), idx % 2
+
+
+def get_loader(args, batch_size, loader_kwargs):
+    # Training loader of the project with the given worker settings
+    if args.synthetic:
+        source_size, img_size = SYNTHETIC_SIZES[args.project]
+        dataset = SyntheticImages(args.num_samples, source_size, img_size)
+        return DataLoader(dataset, batch_size=batch_size, shuffle=True, **loader_kwargs)
+
+    # Default dataset roots of get_loaders unless given
+    root = {'root': args.data_path} if args.data_path is not None else {}
+
+    if args.project == 1:
+        import torchvision.transforms as transforms
+        from src.data.project1.dataloader import get_loaders
+        # Images from the image store are resized uint8 tensors already
+        transform = transforms.Compose([transforms.Resize((224, 224)), transforms.PILToTensor()]) if args.image_store is None else None
+        return get_loaders(
+            batch_size=batch_size, train_transforms=transform, test_transforms=transform,
+            image_store=args.image_store, **root, **loader_kwargs,
+        )[args.split]
+
+    if args.project == 2:
+        from src.data.project2.dataloader import get_loaders
+        loaders = get_loaders(args.dataset, batch_size=batch_size, **loader_kwargs)
+        return loaders[0][args.split] if args.dataset == 'DRIVE' else loaders[args.split]
+
+    if args.project == 4:
+        from src.data.project4.dataloader import get_loaders
+        loaders, _ = get_loaders(
+            'waste', batch_size=batch_size, proposals_path=args.proposals_path,
+            region_mode=args.region_mode, region_store=args.region_store, **root, **loader_kwargs,
+        )
+        return loaders[args.split]
+
+    raise ValueError(f'unknown project {args.project}')
+
+def num_samples(batch):
+    # Batches are (x, y) tuples or the packed dictionaries of project4
+    if isinstance(batch, dict):
+        return len(batch['images'])
+    return len(batch[0])
+
+def peak_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+def run_config(args, config, results):
+    '''
+    Iterates the loader for a number of epochs in a fresh process, so the peak memory of this
+    configuration is not mixed up with the others. Workers are joined before reading their peak.
+    '''
+    batch_size = config.pop('batch_size')
+    loader = get_loader(args, batch_size, get_loader_kwargs(**config))
+
+    samples, first_batch, batch = 0, None, None
+    start = time.perf_counter()
+    for _ in range(args.epochs):
+        for i, batch in enumerate(loader):
+            if first_batch is None:
+                first_batch = time.perf_counter() - start
+            samples += num_samples(batch)
+            if i + 1 >= args.num_batches:
+                break
+    elapsed = time.perf_counter() - start
+    del loader, batch
+
+    results.put({
+        **config,
+        'batch_size':           batch_size,
+        'samples_per_sec':      samples / max(elapsed, 1e-9),
+        'first_batch_sec':      first_batch if first_batch is not None else elapsed,
+        'peak_rss_mb':          peak_rss_mb(resource.RUSAGE_SELF),
+        'peak_worker_rss_mb':   peak_rss_mb(resource.RUSAGE_CHILDREN),
+    })
+
+def wait_for_result(process, queue, poll_interval=1.0):
+    # Result of the child, or None if it exited without one (an exception or being killed)
+    while True:
+        try:
+            return queue.get(timeout=poll_interval)
+        except Empty:
+            if not process.is_alive():
+                # The result may have been put right before exiting
+                try:
+                    return queue.get(timeout=poll_interval)
+                except Empty:
+                    return None
+
+def benchmark(args, configs):
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for config in configs:
+        queue = context.Queue()
+        process = context.Process(target=run_config, args=(args, dict(config), queue))
+        process.start()
+        try:
+            result = wait_for_result(process, queue)
+        finally:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+        if result is None:
+            result = {**config, 'failed': True, 'exitcode': process.exitcode}
+            results.append(result)
+            print(
+                f"{result['num_workers']:>8} {result['batch_size']:>6} {str(result['prefetch_factor']):>9} {str(result['persistent_workers']):>11} {str(result['pin_memory']):>6} "
+                f"failed with exit code {process.exitcode}"
+            )
+            continue
+
+        results.append(result)
+        print(
+            f"{result['num_workers']:>8} {result['batch_size']:>6} {str(result['prefetch_factor']):>9} {str(result['persistent_workers']):>11} {str(result['pin_memory']):>6} "
+            f"{result['samples_per_sec']:>12.1f} {result['first_batch_sec']:>10.2f} {result['peak_rss_mb']:>10.0f} {result['peak_worker_rss_mb']:>13.0f}"
+        )
+    return results
+
+def parse_arguments():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--project", type=int, required=True,
+                        help="Project whose get_loaders is benchmarked - one of: [1, 2, 4]")
+    parser.add_argument("--data_path", type=str, default=None,
+                        help="Dataset root (projects 1 and 4), project2 uses the paths of its datasets.")
+    parser.add_argument("--dataset", type=str, default='PH2',
+                        help="Project2 dataset - one of: [DRIVE, PH2]")
+    parser.add_argument("--split", type=str, default='train',
+                        help="Loader to benchmark - one of: [train, validation, test]")
+    parser.add_argument("--synthetic", type=bool, default=False,
+                        help="Decode random JPEGs of the project's image size instead of the dataset.")
+    parser.add_argument("--num_samples", type=int, default=2048,
+                        help="Number of synthetic samples.")
+    parser.add_argument("--image_store", type=str, default=None,
+                        help="Project1 image store built with src/data/project1/image_store.py.")
+    parser.add_argument("--proposals_path", type=str, default="/work3/s184984/02514/project4/bboxes/proposals",
+                        help="Project4 selective search proposals.")
+    parser.add_argument("--region_mode", type=str, default='crop',
+                        help="Project4 region mode - one of: [crop, roi]")
+    parser.add_argument("--region_store", type=str, default=None,
+                        help="Project4 region store.")
+
+    # Grid
+    parser.add_argument("--num_workers", nargs='+', type=int, default=[0, 2, 4, 8],
+                        help="Numbers of workers to try.")
+    parser.add_argument("--batch_size", nargs='+', type=int, default=[32, 64],
+                        help="Batch sizes to try.")
+    parser.add_argument("--prefetch_factor", nargs='+', type=int, default=[2, 4],
+                        help="Batches prefetched per worker to try.")
+    parser.add_argument("--persistent_workers", nargs='+', type=int, default=[0, 1],
+                        help="Whether to keep workers alive between epochs, as 0/1.")
+    parser.add_argument("--pin_memory", nargs='+', type=int, default=[0],
+                        help="Whether to collate into pinned memory, as 0/1.")
+    parser.add_argument("--num_batches", type=int, default=50,
+                        help="Maximum number of batches per epoch.")
+    parser.add_argument("--epochs", type=int, default=2,
+                        help="Number of epochs per configuration - worker start-up is paid every epoch without persistence.")
+
+    parser.add_argument("--profile", type=str, default=None,
+                        help="Write the best configurations as a profile for --loader_profile of the train_model.py scripts.")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    # Get input arguments
+    args = parse_arguments()
+
+    # Prefetching and persistence only matter with workers
+    configs = []
+    for num_workers, batch_size, prefetch_factor, persistent_workers, pin_memory in itertools.product(
+            args.num_workers, args.batch_size, args.prefetch_factor, args.persistent_workers, args.pin_memory):
+        config = {'num_workers': num_workers, 'batch_size': batch_size, 'pin_memory': bool(pin_memory),
+                  'persistent_workers': bool(persistent_workers) and num_workers > 0,
+                  'prefetch_factor': prefetch_factor if num_workers > 0 else None}
+        if config not in configs:
+            configs.append(config)
+
+    print(f"{'workers':>8} {'batch':>6} {'prefetch':>9} {'persistent':>11} {'pin':>6} {'samples/sec':>12} {'first [s]':>10} {'RSS [MB]':>10} {'worker [MB]':>13}")
+    results = benchmark(args, configs)
+
+    # Failed configurations are kept in the profile but never chosen
+    succeeded = [result for result in results if not result.get('failed', False)]
+    if len(succeeded) == 0:
+        raise RuntimeError('all configurations failed, see the errors of the benchmark processes above')
+
+    best = max(succeeded, key=lambda result: result['samples_per_sec'])
+    by_batch_size = {}
+    for result in succeeded:
+        if str(result['batch_size']) not in by_batch_size or result['samples_per_sec'] > by_batch_size[str(result['batch_size'])]['samples_per_sec']:
+            by_batch_size[str(result['batch_size'])] = result
+    print(f"Best: {best}")
+
+    if args.profile is not None:
+        with open(args.profile, 'w') as f:
+            json.dump({
+                'project':          args.project,
+                'host':             platform.node(),
+                'cpu_count':        multiprocessing.cpu_count(),
+                'data_path':        args.data_path,
+                'synthetic':        args.synthetic,
+                'best':             best,
+                'by_batch_size':    by_batch_size,
+                'results':          results,
+            }, f, indent=2)
@@ -1,3 +1,8 @@
+import hashlib
+import json
+import os
+import time
+
 from tqdm import tqdm
 
 import numpy as np
@@ -10,7 +15,11 @@ from torch.utils.data import DataLoader, Dataset
 import torchvision.transforms as transforms
 from torchvision.datasets import ImageFolder
 
-from src.utils import set_seed
+from src.utils import set_seed, get_loader_kwargs, CACHE_ROOT
+from src.data.project1.image_store import ImageStore
+
+# Normalization statistics, keyed by dataset fingerprint
+STATS_CACHE_DIR = f'{CACHE_ROOT}/stats'
 
 class HotdogDataset(Dataset):
     def __init__(self, subset, transform=None):
@@ -26,38 +35,97 @@ class HotdogDataset(Dataset):
     def __len__(self):
         return len(self.subset)
     
-def get_normalization_constants(root: str, seed: int = 0):
+def get_normalization_transform(img_size=(224, 224)):
+    # Only resize as we want to compute means...
+    return transforms.Compose([
+        transforms.Resize(img_size),
+        transforms.PILToTensor(),
+    ])
+
+def dataset_fingerprint(root, transform):
+    # Changes when files are added, removed or modified, or when the images are resized differently
+    files = sorted(
+        (os.path.relpath(os.path.join(dirpath, name), root), os.stat(os.path.join(dirpath, name)).st_mtime_ns)
+        for dirpath, _, names in os.walk(root) for name in names
+    )
+    content = json.dumps({'root': os.path.abspath(root), 'files': files, 'transform': repr(transform)})
+    return hashlib.sha256(content.encode()).hexdigest()[:16]
+
+def compute_normalization_constants(trainset, batch_size=64, num_workers=1):
+    # Trainset is decoded and resized in the workers
+    loader = DataLoader(trainset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+
+    # Per-channel pixel sums and sums of squares in a single pass, float64 keeps them exact
+    total, total_squared, num_pixels = torch.zeros(3, dtype=torch.float64), torch.zeros(3, dtype=torch.float64), 0
+    start = time.perf_counter()
+    for x, _ in tqdm(loader, desc='Computing mean and std. dev. of training split...'):
+        x = x.to(torch.float64).div_(255)
+        total += x.sum(dim=(0, 2, 3))
+        total_squared += x.square().sum(dim=(0, 2, 3))
+        num_pixels += x.shape[0] * x.shape[2] * x.shape[3]
+    elapsed = time.perf_counter() - start
+
+    train_mean = total / num_pixels
+    train_std  = (total_squared / num_pixels - train_mean ** 2).clamp(min=0).sqrt()
+    print(f"({len(trainset) / max(elapsed, 1e-9):.1f} images/sec)")
+    return train_mean.to(torch.float32), train_std.to(torch.float32)
+
+def get_normalization_constants(root: str, seed: int = 0, batch_size: int = 64, num_workers: int = 1, cache_dir=STATS_CACHE_DIR):
+    '''
+    Per-channel pixel mean and std. dev. of the resized training split. Statistics are cached in
+    cache_dir under a fingerprint of the training files and the resize transform, so they are
+    only computed once per dataset (cache_dir None always recomputes).
+    '''
     # Set seed for split control
     set_seed(seed)
 
-    # Define transforms (only resize as we want to compute means...)
-    normalization_transform = transforms.Compose([
-        transforms.Resize((224, 224)),
-        transforms.ToTensor(),
-    ])
+    normalization_transform = get_normalization_transform()
+    cache_path = f'{cache_dir}/stats_{dataset_fingerprint(f"{root}/train", normalization_transform)}.json' if cache_dir is not None else None
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path, 'r') as f:
+            stats = json.load(f)
+        train_mean, train_std = torch.tensor(stats['mean']), torch.tensor(stats['std'])
+        print(f"\nMean: {train_mean}\nStd. dev.: {train_std}\n(cached in {cache_path})")
+        return train_mean, train_std
 
     # Get trainset
     trainset     = ImageFolder(f'{root}/train', transform=normalization_transform)
-
-    # Compute means and standard deviations from training set
-    train_mean = torch.stack([t.mean(1).mean(1) for t, c in tqdm(trainset, desc='Computing mean of training split...')]).mean(0)
-    train_std  = torch.stack([t.std(1).std(1) for t, c in tqdm(trainset, desc='Computing std. dev. of training split...')]).std(0)
-    print(f"\nMean: {train_mean}\nStd. dev.: {train_std}")    
+    train_mean, train_std = compute_normalization_constants(trainset, batch_size=batch_size, num_workers=num_workers)
+    print(f"\nMean: {train_mean}\nStd. dev.: {train_std}")
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        class_counts = np.bincount(trainset.targets, minlength=len(trainset.classes))
+        # Written to a temporary file first, so concurrent runs never read a partial file
+        with open(f'{cache_path}.{os.getpid()}.tmp', 'w') as f:
+            json.dump({
+                'root':         os.path.abspath(root),
+                'num_images':   len(trainset),
+                'mean':         train_mean.tolist(),
+                'std':          train_std.tolist(),
+                'class_counts': dict(zip(trainset.classes, class_counts.tolist())),
+            }, f)
+        os.replace(f'{cache_path}.{os.getpid()}.tmp', cache_path)
     return train_mean, train_std
 
 def get_loaders(
         root: str = '/dtu/datasets1/02514/hotdog_nohotdog', 
         batch_size: int = 64, seed: int = 0, 
         train_transforms=None, test_transforms=None, 
-        num_workers=1,
+        num_workers=1, image_store=None,
+        pin_memory=False, persistent_workers=False, prefetch_factor=None,
     ) -> dict:
 
     # Set seed for split control
     set_seed(seed)
 
-    # Load images as datasets
-    trainset = ImageFolder(f'{root}/train', transform=train_transforms)
-    testvalset     = ImageFolder(f'{root}/test') 
+    # Load images as datasets - pre-decoded uint8 tensors from an image store have the same order (and splits)
+    if image_store is not None:
+        trainset = ImageStore(image_store, 'train', transform=train_transforms)
+        testvalset     = ImageStore(image_store, 'test')
+    else:
+        trainset = ImageFolder(f'{root}/train', transform=train_transforms)
+        testvalset     = ImageFolder(f'{root}/test') 
 
     # Get validation set size
     N_testval  = testvalset.__len__()                                       # total test points
@@ -72,9 +140,10 @@ def get_loaders(
     testset = HotdogDataset(test_subset, transform=test_transforms)
 
     # Get dataloaders
-    trainloader = DataLoader(trainset,  batch_size=batch_size, shuffle=True, num_workers=num_workers)
-    valloader   = DataLoader(valset,    batch_size=batch_size, shuffle=False, num_workers=num_workers)
-    testloader  = DataLoader(testset,   batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    loader_kwargs = get_loader_kwargs(num_workers, pin_memory, persistent_workers, prefetch_factor)
+    trainloader = DataLoader(trainset,  batch_size=batch_size, shuffle=True, **loader_kwargs)
+    valloader   = DataLoader(valset,    batch_size=batch_size, shuffle=False, **loader_kwargs)
+    testloader  = DataLoader(testset,   batch_size=batch_size, shuffle=False, **loader_kwargs)
 
     # Return loaders in dictionary
     return {'train': trainloader, 'validation': valloader, 'test': testloader, 'test_idxs': order[N_val:]}
@@ -0,0 +1,119 @@
+import argparse
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+import torchvision.transforms as transforms
+from torchvision.datasets import ImageFolder
+from tqdm import tqdm
+
+from src.utils import MemmapStore, read_store_meta, write_store_meta, is_store_complete
+
+SPLITS = ('train', 'test')
+
+
+class ImageStore(MemmapStore, Dataset):
+    '''
+    Read-only view of one ImageFolder split of the hotdog images written by build_image_store,
+    as resized (3, H, W) uint8 tensors sliced from a single memory-mapped array. Rows are in
+    ImageFolder order and the ImageFolder attributes (samples, imgs, targets, classes,
+    class_to_idx) are kept, so the store is a drop-in replacement for the decoded split.
+    '''
+    lazy_attributes = ('images',)
+
+    def __init__(self, path, split='train', transform=None):
+        super().__init__(path)
+        self.split = split
+        self.transform = transform
+        meta = read_store_meta(path)
+
+        self.img_size = tuple(meta['img_size'])
+        self.num_images = meta['num_images']
+        self.classes = meta['classes']
+        self.class_to_idx = {c: idx for idx, c in enumerate(self.classes)}
+        self.start, self.stop = meta['splits'][split]
+
+        self.targets = np.load(f'{path}/labels.npy')[self.start:self.stop].tolist()
+        paths = np.load(f'{path}/paths.npy')[self.start:self.stop].tolist()
+        self.samples = list(zip(paths, self.targets))
+        self.imgs = self.samples
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def open(self):
+        # Copy-on-write map gives writable arrays for torch.from_numpy without copying the data
+        self.images = np.load(f'{self.path}/images.npy', mmap_mode='c')
+
+    def __getitem__(self, idx):
+        self.ensure_open()
+        x = torch.from_numpy(self.images[self.start + idx])
+        if self.transform:
+            x = self.transform(x)
+        return x, self.targets[idx]
+
+
+def is_image_store(path):
+    return is_store_complete(path)
+
+def build_image_store(root, path, img_size=(224, 224), batch_size=64, num_workers=1):
+    '''
+    Decodes and resizes the train and test ImageFolder splits once and writes them, in ImageFolder
+    order, as a single (N, 3, H, W) uint8 array with the labels and image paths of every row.
+    '''
+    os.makedirs(path, exist_ok=True)
+    transform = transforms.Compose([
+        transforms.Resize(img_size),
+        transforms.PILToTensor(),
+    ])
+    datasets = [ImageFolder(f'{root}/{split}', transform=transform) for split in SPLITS]
+    num_images = sum(len(dataset) for dataset in datasets)
+
+    # Written row by row into the final .npy file, the images never have to fit in memory
+    images = np.lib.format.open_memmap(f'{path}/images.npy', mode='w+', dtype=np.uint8, shape=(num_images, 3) + tuple(img_size))
+    splits, row = {}, 0
+    for split, dataset in zip(SPLITS, datasets):
+        splits[split] = (row, row + len(dataset))
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+        for x, _ in tqdm(loader, desc=f'Building {split} image store in {path}...'):
+            images[row:row + len(x)] = x.numpy()
+            row += len(x)
+    images.flush()
+    del images
+
+    np.save(f'{path}/labels.npy', np.concatenate([np.array(dataset.targets, dtype=np.int64) for dataset in datasets]))
+    np.save(f'{path}/paths.npy', np.array([sample_path for dataset in datasets for sample_path, _ in dataset.samples]))
+    write_store_meta(path, {
+        'root': os.path.abspath(root),
+        'img_size': list(img_size),
+        'num_images': num_images,
+        'classes': datasets[0].classes,
+        'splits': splits,
+    })
+
+
+def parse_arguments():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--data_path", type=str, default='/dtu/datasets1/02514/hotdog_nothotdog',
+                        help="Path to data set.")
+    parser.add_argument("--store_path", type=str, default='/work3/s184984/02514/project1/image_store',
+                        help="Directory the store is written to.")
+    parser.add_argument("--img_size", type=int, default=224,
+                        help="Size images are resized to.")
+    parser.add_argument("--batch_size", type=int, default=64,
+                        help="Number of images decoded per batch.")
+    parser.add_argument("--num_workers", type=int, default=1,
+                        help="Number of workers in the dataloader.")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    # Get input arguments
+    args = parse_arguments()
+
+    build_image_store(args.data_path, args.store_path, img_size=(args.img_size, args.img_size), batch_size=args.batch_size, num_workers=args.num_workers)
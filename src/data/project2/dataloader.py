@@ -17,10 +17,13 @@ import numpy as np
 # Get loaders function
 from torch.utils.data import DataLoader
 
+from src.utils import get_loader_kwargs
+
 def NoOp(image, **kwargs):
     return image
 
-def get_loaders(dataset, batch_size=2, seed=1, num_workers=1, augmentations:dict={'rotate': False, 'flip': False}):
+def get_loaders(dataset, batch_size=2, seed=1, num_workers=1, augmentations:dict={'rotate': False, 'flip': False}, pin_memory=False, persistent_workers=False, prefetch_factor=None):
+    loader_kwargs = get_loader_kwargs(num_workers, pin_memory, persistent_workers, prefetch_factor)
     img_size = (256, 256)
     test_transform = A.Compose([
                 A.Resize(img_size[0], img_size[1]),
@@ -49,34 +52,34 @@ def get_loaders(dataset, batch_size=2, seed=1, num_workers=1, augmentations:dict
                     DRIVE(mode='train', fold=fold, transform=train_transform),
                     batch_size=batch_size,
                     shuffle=True,
-                    num_workers=num_workers,
+                    **loader_kwargs,
                 ),
                 'test': DataLoader(
                     DRIVE(mode='test', fold=fold, transform=test_transform),
                     batch_size=batch_size,
                     shuffle=True,
-                    num_workers=num_workers,
+                    **loader_kwargs,
                 ),
                 'validation': DataLoader(
                     DRIVE(mode='val', fold=fold, transform=test_transform),
                     batch_size=batch_size,
                     shuffle=True,
-                    num_workers=num_workers,
+                    **loader_kwargs,
                 ),
             }
             for fold in range(5)
         }
     
     elif dataset == 'PH2':
-        return _extracted_from_get_loaders_(batch_size, num_workers, augmentations)
+        return _extracted_from_get_loaders_(batch_size, loader_kwargs, augmentations)
     elif dataset == 'DRIVE_TEST':
-        return {'test':DataLoader(DRIVE_TEST(transform=test_transform), batch_size=batch_size, shuffle=True, num_workers=num_workers)}
+        return {'test':DataLoader(DRIVE_TEST(transform=test_transform), batch_size=batch_size, shuffle=True, **loader_kwargs)}
     else:
         raise ValueError('unknown dataset')
     
 
 # TODO Rename this here and in `get_loaders`
-def _extracted_from_get_loaders_(batch_size, num_workers, augmentations):
+def _extracted_from_get_loaders_(batch_size, loader_kwargs, augmentations):
     # won't work if halving in the CNN structure will end up with an odd number, numbers must be divisible by 2^N
     img_size = (256, 256)
     
@@ -92,13 +95,13 @@ def _extracted_from_get_loaders_(batch_size, num_workers, augmentations):
             ], is_check_shapes=False) 
 
     trainset = PH2_dataset(mode='train', transform=train_transform)
-    train_loader = DataLoader(trainset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
+    train_loader = DataLoader(trainset, batch_size=batch_size, shuffle=True, **loader_kwargs)
 
     valset = PH2_dataset(mode='val', transform=test_transform)
-    val_loader = DataLoader(valset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
+    val_loader = DataLoader(valset, batch_size=batch_size, shuffle=True, **loader_kwargs)
 
     testset = PH2_dataset(mode='test', transform=test_transform)
-    test_loader = DataLoader(testset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
+    test_loader = DataLoader(testset, batch_size=batch_size, shuffle=True, **loader_kwargs)
 
     return {'train': train_loader, 'validation': val_loader, 'test': test_loader}
 
@@ -143,8 +146,7 @@ class DRIVE(torch.utils.data.Dataset):
         image_path = self.image_paths[idx]
         label_path = self.label_paths[idx]
 
-        image = np.array(Image.open(image_path)) / 255 
-        image = image.astype(np.float32)
+        image = np.array(Image.open(image_path))
         label =  np.array(Image.open(label_path)) / 255
         transformed = self.transform(image=image, mask=label)
         X = transformed['image']
@@ -166,8 +168,7 @@ class DRIVE_TEST(torch.utils.data.Dataset):
         'Generates one sample of data'
         image_path = self.image_paths[idx]
 
-        image = np.array(Image.open(image_path)) / 255 
-        image = image.astype(np.float32)
+        image = np.array(Image.open(image_path))
         transformed = self.transform(image=image)
         X = transformed['image']
         return X, torch.zeros((6, 1, 256,256))
@@ -215,8 +216,7 @@ class PH2_dataset(torch.utils.data.Dataset):
         label_path = self.label_paths[idx]
         
         # Albumentations
-        image = np.array(Image.open(image_path)) / 255 
-        image = image.astype(np.float32)
+        image = np.array(Image.open(image_path))
         label =  np.array(Image.open(label_path)) * 1.0
         transformed = self.transform(image=image, mask=label)
         X = transformed['image']
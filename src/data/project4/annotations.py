@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from src.utils import MemmapStore, read_store_meta, write_store_meta, is_store_complete, CACHE_ROOT
+
+CACHE_DIR = f'{CACHE_ROOT}/annotations'
+
+# Indexes already opened in this process, shared by the train, validation and test sets
+_indexes = {}
+
+
+class AnnotationIndex(MemmapStore):
+    '''
+    Compact, read-only index of a COCO annotation file. Boxes (x, y, w, h) and category ids of
+    all annotations are stored in flat arrays grouped by image, with per-image offsets.
+    Arrays are memory-mapped from the cache, so workers share them instead of unpickling a copy.
+    '''
+    lazy_attributes = ('arrays',)
+
+    def __init__(self, path):
+        super().__init__(path)
+        meta = read_store_meta(path)
+        self.file_names = meta['file_names']
+        self.categories = meta['categories']
+
+    def __len__(self):
+        return len(self.file_names)
+
+    def open(self):
+        self.arrays = {
+            key: np.load(f'{self.path}/{key}.npy', mmap_mode='r')
+            for key in ('boxes', 'category_ids', 'offsets', 'widths', 'heights')
+        }
+
+    def get(self, idx):
+        # Boxes and category ids of the idx'th image
+        self.ensure_open()
+        start, end = self.arrays['offsets'][idx], self.arrays['offsets'][idx + 1]
+        return self.arrays['boxes'][start:end], self.arrays['category_ids'][start:end]
+
+    def get_size(self, idx):
+        # Width and height of the idx'th image
+        self.ensure_open()
+        return int(self.arrays['widths'][idx]), int(self.arrays['heights'][idx])
+
+
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def build_annotation_index(anns_file_path, path):
+    with open(anns_file_path, 'r') as f:
+        dataset = json.loads(f.read())
+
+    images = dataset['images']
+    image_position = {img_data['id']: idx for idx, img_data in enumerate(images)}
+
+    # Group annotations by image, keeping the order of the annotation file
+    anns = dataset['annotations']
+    positions = np.array([image_position[ann['image_id']] for ann in anns], dtype=np.int64)
+    order = np.argsort(positions, kind='stable')
+    boxes = np.array([ann['bbox'] for ann in anns], dtype=np.float64).reshape(-1, 4)[order]
+    category_ids = np.array([ann['category_id'] for ann in anns], dtype=np.int32)[order]
+    counts = np.bincount(positions, minlength=len(images))
+
+    os.makedirs(path, exist_ok=True)
+    np.save(f'{path}/boxes.npy', boxes)
+    np.save(f'{path}/category_ids.npy', category_ids)
+    np.save(f'{path}/offsets.npy', np.concatenate([[0], np.cumsum(counts)]).astype(np.int64))
+    np.save(f'{path}/widths.npy', np.array([img_data['width'] for img_data in images], dtype=np.int32))
+    np.save(f'{path}/heights.npy', np.array([img_data['height'] for img_data in images], dtype=np.int32))
+
+    write_store_meta(path, {
+        'file_names': [img_data['file_name'] for img_data in images],
+        'categories': [
+            {key: cat[key] for key in ('id', 'name', 'supercategory')}
+            for cat in dataset['categories']
+        ],
+    })
+
+def load_annotation_index(anns_file_path, cache_dir=CACHE_DIR) -> AnnotationIndex:
+    '''
+    Returns the annotation index of the file, building it once and caching it on disk
+    keyed on the hash of the annotation file.
+    '''
+    if anns_file_path in _indexes:
+        return _indexes[anns_file_path]
+
+    path = f'{cache_dir}/{file_hash(anns_file_path)}'
+    if not is_store_complete(path):
+        # Built next to the cache and moved into place, so concurrent runs never read a partial index
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        build_annotation_index(anns_file_path, tmp_path)
+        if os.path.isdir(path) and not is_store_complete(path):
+            # Left behind by an interrupted build
+            shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            # Another run finished the same index first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    _indexes[anns_file_path] = AnnotationIndex(path)
+    return _indexes[anns_file_path]
@@ -3,18 +3,59 @@ import torch.nn as nn
 from torch.utils.data import DataLoader, Dataset, Subset
 import numpy as np
 from PIL import Image, ExifTags
-from pycocotools.coco import COCO
 import random
-import json
 import os
-import pickle
 
 from typing import Tuple
 
 from albumentations.pytorch import ToTensorV2
 import albumentations as A
 
-from src.utils import set_seed
+from src.utils import set_seed, get_loader_kwargs
+from src.data.project4.region_store import RegionStore
+from src.data.project4.proposal_store import ProposalStore
+from src.data.project4.annotations import load_annotation_index
+from src.data.project4.proposal_ranking import ProposalRanker
+
+# Obtain Exif orientation tag code
+ORIENTATION = next(tag for tag, name in ExifTags.TAGS.items() if name == 'Orientation')
+
+PROPOSALS_PATH = '/work3/s184984/02514/project4/bboxes/proposals'
+
+# Transposes undoing the Exif orientation of portrait and upside down images
+EXIF_TRANSPOSE = {
+    3: Image.Transpose.ROTATE_180,
+    6: Image.Transpose.ROTATE_270,
+    8: Image.Transpose.ROTATE_90,
+}
+
+def exif_rotate(image):
+    # Rotate portrait and upside down images if necessary
+    method = EXIF_TRANSPOSE.get(image.getexif().get(ORIENTATION))
+    if method is not None:
+        image = image.transpose(method)
+    return image
+
+def decode_image(path, size=None):
+    '''
+    Decodes an image as uint8, letting the JPEG decoder downscale by a power of two while
+    staying at least size = (height, width). Exif orientation is applied to the reduced image.
+    Returns the image and the (x, y) factor from original to decoded coordinates.
+    '''
+    image = Image.open(path)
+    width, height = image.size
+    orientation = image.getexif().get(ORIENTATION)
+    if size is not None:
+        # Draft sizes are in stored orientation, not in displayed orientation
+        draft_size = (size[1], size[0]) if orientation not in (6, 8) else (size[0], size[1])
+        image.draft(image.mode, draft_size)
+    scale = (image.size[0] / width, image.size[1] / height)
+
+    if orientation in EXIF_TRANSPOSE:
+        image = image.transpose(EXIF_TRANSPOSE[orientation])
+        if orientation in (6, 8):
+            scale = scale[::-1]
+    return np.asarray(image), scale
 
 class WasteDataset(Dataset):
 
@@ -22,11 +63,34 @@ class WasteDataset(Dataset):
             self, mode, transform, 
             data_path='/dtu/datasets1/02514/data_wastedetection', 
             seed=420, region_size=(224, 224),
-            use_super_categories=True
+            use_super_categories=True,
+            region_store=None,
+            proposals_path=PROPOSALS_PATH,
+            annotation_index=None,
+            region_mode='crop',
+            sample_regions=False,
+            iou_threshold=0.5,
+            decode_size=None,
+            proposal_ranker=None,
+            top_n_proposals=-1,
         ):
 
         # Read annotations
         self.transform = transform
+        self.region_size = region_size
+        # 'crop' extracts regions here, 'roi' leaves it to a batched RoIAlign in the model
+        if region_mode not in ('crop', 'roi'):
+            raise ValueError('region_mode must be one of crop or roi')
+        self.region_mode = region_mode
+
+        # Sample foreground and background proposals before extracting regions (for training)
+        self.sample_regions = sample_regions
+        self.iou_threshold = iou_threshold
+        # Decode JPEGs at reduced resolution, no smaller than the size the transform resizes to
+        self.decode_size = decode_size
+        # Only keep the top-N proposals of a cheap ranking stage before extracting regions
+        self.proposal_ranker = proposal_ranker
+        self.top_n_proposals = top_n_proposals
         self.region_transform = A.Compose([
             A.Resize(region_size[0], region_size[1]),
             ToTensorV2(),
@@ -36,25 +100,30 @@ class WasteDataset(Dataset):
             ToTensorV2(),
         ])
         
-        # Load dataset
+        # Load dataset - the annotation index is parsed once and shared between splits
         self.data_path = data_path
         anns_file_path = self.data_path + '/' + 'annotations.json'
-        self.coco = COCO(anns_file_path)
-        with open(anns_file_path, 'r') as f:
-            dataset = json.loads(f.read())
+        self.annotations = annotation_index if annotation_index is not None else load_annotation_index(anns_file_path)
+        categories = self.annotations.categories
         
         # Extract categories, supercategories and other useful information
         self.use_super_categories = use_super_categories
         if self.use_super_categories:
-            self.categories = sorted(list(set([cat['supercategory'] for cat in dataset['categories']])))
+            self.categories = sorted(list(set([cat['supercategory'] for cat in categories])))
             # Create dictionary for mapping between ids and chosen category
             supercat2id = {x: index for index, x in enumerate(self.categories)}
-            self.id2supercatid = {cat['id']: supercat2id[cat['supercategory']] for cat in dataset['categories']}
+            self.id2supercatid = {cat['id']: supercat2id[cat['supercategory']] for cat in categories}
+            id2label = self.id2supercatid
         else:
-            self.categories = sorted(list(set([cat['name'] for cat in dataset['categories']])))
+            self.categories = sorted(list(set([cat['name'] for cat in categories])))
             # Create dictionary for mapping between ids and chosen category
             cat2id = {x: index for index, x in enumerate(self.categories)}
-            self.id2catid = {cat['id']: cat2id[cat['name']] for cat in dataset['categories']}
+            self.id2catid = {cat['id']: cat2id[cat['name']] for cat in categories}
+            id2label = self.id2catid
+
+        # Lookup table from category id to label
+        self.label_map = np.zeros(max(id2label.keys()) + 1, dtype=np.int64)
+        self.label_map[list(id2label.keys())] = list(id2label.values())
 
         # Get number of classes and category mapping
         self.num_classes = len(self.categories) + 1
@@ -62,11 +131,8 @@ class WasteDataset(Dataset):
         # add background class
         self.id2cat[len(self.id2cat)] = 'Background'
 
-        # get image id and paths
-        self.image_paths = [(
-            self.coco.getAnnIds(imgIds=img_data['id'], catIds=[], iscrowd=None), 
-            img_data['file_name']) 
-        for img_data in dataset['images']]
+        # get image index and paths
+        self.image_paths = list(enumerate(self.annotations.file_names))
         
         # Exclude images with bounding boxes exceeding image
         exclude_images = [
@@ -85,12 +151,6 @@ class WasteDataset(Dataset):
         random.seed(seed)
         random.shuffle(self.image_paths)
 
-        # Obtain Exif orientation tag code
-        for orientation in ExifTags.TAGS.keys():
-            if ExifTags.TAGS[orientation] == 'Orientation':
-                self.orientation = orientation
-                break   
-
         # Compute splits sizes
         train_size = int(0.7 * len(self.image_paths))
         val_size = int(0.1 * len(self.image_paths))
@@ -105,17 +165,20 @@ class WasteDataset(Dataset):
         else:
             raise ValueError('mode must be one of train, val or test')
 
-        # Load proposed bounding boxes
-        with open('/work3/s184984/02514/project4/bboxes/bboxes_no_zeros.pkl', 'rb') as fp:
-            proposed_bboxes = pickle.load(fp)
-
-        # Restrict to train, test or validation set
-        selected_images         = [img_path[1] for img_path in self.image_paths] 
-        self.proposed_bboxes    = {
-            img_name: tuple([list(bbox_) for bbox_ in proposed_bboxes_ if bbox_[2] > 20 and bbox_[3] > 20]) 
-            for img_name, proposed_bboxes_ in proposed_bboxes.items() 
-            if img_name in selected_images
-        }
+        # Serve images and regions from a precomputed region store
+        self.proposals_path = proposals_path
+        self.region_store = RegionStore(region_store) if region_store is not None else None
+        if self.region_store is not None:
+            self.region_store.check_settings(
+                use_super_categories=use_super_categories, img_size=decode_size,
+                region_size=region_size, proposals_path=proposals_path,
+            )
+            return
+
+        # Proposed bounding boxes (already without small boxes) are memory-mapped on first access
+        self.proposed_bboxes = ProposalStore(proposals_path)
+        if self.sample_regions and not self.proposed_bboxes.has_matches:
+            raise ValueError('sampling regions requires proposal matches, see src/data/project4/proposal_store.py')
 
     def __len__(self):
         'Returns the total number of samples'
@@ -136,41 +199,54 @@ class WasteDataset(Dataset):
         elif box_type == 'predicted':
             return torch.tensor([x, y, x+w, y+h]), self.transform_pred_bbox(image = image[y:y+h, x:x+w, :])['image']
 
-    def process_image(self, image):
-
-        # Rotate portrait and upside down images if necessary
-        if image._getexif():
-            exif = dict(image._getexif().items())
-            if self.orientation in exif:
-                if exif[self.orientation] == 3:
-                    image = image.rotate(180,expand=True)
-                if exif[self.orientation] == 6:
-                    image = image.rotate(270,expand=True)
-                if exif[self.orientation] == 8:
-                    image = image.rotate(90,expand=True)
-                    
-        image = np.array(image) / 255 
-        return image.astype(np.float32)
-        
+    def sample_proposals(self, img_path, n_gt):
+        # All foreground proposals and 3 background proposals per foreground or ground truth region
+        match_iou, _ = self.proposed_bboxes.get_matches(img_path)
+        foreground = np.flatnonzero(match_iou >= self.iou_threshold)
+        background = np.flatnonzero(match_iou < self.iou_threshold)
+        n_background_sample = (len(foreground) + n_gt) * 3
+        # torch RNG is seeded differently in every worker, unlike numpy
+        background = background[torch.randperm(len(background))[:n_background_sample].numpy()]
+        return np.sort(np.concatenate([foreground, background]))
+
+    def convert_boxes(self, bboxes):
+        # (x, y, w, h) -> (x1, y1, x2, y2) with the same rounding as extract_resize_region
+        (x, y, w, h) = np.ceil(np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)).astype(np.int64).T
+        return torch.from_numpy(np.stack([x, y, x+w, y+h], axis=1))
+
+    def process_image(self, img_path):
+        # uint8 image decoded near the target size and rotated if necessary
+        return decode_image(self.data_path + '/' + img_path, self.decode_size)
+
+    def scale_boxes(self, bboxes, scale, image_shape):
+        # Annotations are in full resolution coordinates, clip rounding errors to the decoded image
+        bboxes = np.asarray(bboxes, dtype=np.float64) * np.array([scale[0], scale[1]] * 2)
+        bboxes[:, :2] = np.clip(bboxes[:, :2], 0, [image_shape[1], image_shape[0]])
+        bboxes[:, 2:] = np.minimum(bboxes[:, 2:], [image_shape[1], image_shape[0]] - bboxes[:, :2])
+        return bboxes
+
     def __getitem__(self, idx):
+        if self.region_store is not None:
+            return self.getitem_from_store(idx)
+
         ### IMAGE ###
         # Load ids
-        anno_id, img_path = self.image_paths[idx]
+        img_idx, img_path = self.image_paths[idx]
 
         # Load and process image metadata
-        image = Image.open(self.data_path + '/' + img_path)
-        image = self.process_image(image)
+        image, scale = self.process_image(img_path)
 
         ### BBOX AND LABEL ###
         # Load bbox and bbox ids
-        category_ids, bboxes = zip(*[([item['category_id']], item['bbox']) for item in self.coco.loadAnns(anno_id)])
-        if self.use_super_categories:
-            category_ids = tuple([[self.id2supercatid[id_[0]]] for id_ in category_ids])
-        else:
-            category_ids = tuple([[self.id2catid[id_[0]]] for id_ in category_ids])
+        bboxes, category_ids = self.annotations.get(img_idx)
+        bboxes = self.scale_boxes(bboxes, scale, image.shape)
+        category_ids = self.label_map[category_ids][:, None]
 
         # Extract proposed bounding boxes
-        pred_bboxes = torch.tensor(self.proposed_bboxes[img_path])
+        pred_bboxes = self.proposed_bboxes[img_path]
+        if self.sample_regions:
+            pred_bboxes = pred_bboxes[self.sample_proposals(img_path, len(bboxes))]
+        pred_bboxes = torch.from_numpy(pred_bboxes.astype(np.int64))
         
         # Transform image
         transformed = self.transform(image=image, bboxes = bboxes, category_ids = category_ids)
@@ -179,12 +255,63 @@ class WasteDataset(Dataset):
         # Extract categories, bboxes and new image after transformations are applied
         category_ids = transformed['category_ids']
         transformed_bboxes = transformed['bboxes']
+        category_ids = torch.from_numpy(np.asarray(category_ids, dtype=np.int64).reshape(-1, 1))
+
+        # Rank proposals on the resized image
+        if self.proposal_ranker is not None:
+            keep = self.proposal_ranker.top_n(image.permute(1, 2, 0).numpy(), self.convert_boxes(pred_bboxes).numpy(), self.top_n_proposals)
+            pred_bboxes = pred_bboxes[torch.from_numpy(keep)]
+
+        # Only return boxes, regions are extracted for the whole batch in the model
+        if self.region_mode == 'roi':
+            return (image, category_ids, (self.convert_boxes(transformed_bboxes), None), (self.convert_boxes(pred_bboxes), None))
+
         modified_image = np.array(image.permute(1,2,0))
         bboxes, extracted_bboxes = zip(*(self.extract_resize_region(modified_image, bbox, box_type='gt') for bbox in transformed_bboxes))        
         pred_bboxes, extracted_pred_bboxes = zip(*(self.extract_resize_region(modified_image, bbox, box_type='predicted') for bbox in pred_bboxes))
              
-        return (image, torch.tensor(category_ids), (torch.stack(bboxes), torch.stack(extracted_bboxes)), (torch.stack(pred_bboxes), torch.stack(extracted_pred_bboxes)))
-
+        return (image, category_ids, (torch.stack(bboxes), torch.stack(extracted_bboxes)), (torch.stack(pred_bboxes), torch.stack(extracted_pred_bboxes)))
+
+    def getitem_from_store(self, idx):
+        # Slices of the memory-mapped store, no decoding or resizing
+        _, img_path = self.image_paths[idx]
+        image, category_ids, boxes, regions, n_gt = self.region_store[img_path]
+        pred_bboxes, pred_regions = boxes[n_gt:], regions[n_gt:]
+
+        # Rank the stored (x1, y1, x2, y2) proposals on the stored image, as in __getitem__
+        if self.proposal_ranker is not None:
+            keep = torch.from_numpy(self.proposal_ranker.top_n(image.permute(1, 2, 0).numpy(), pred_bboxes.numpy(), self.top_n_proposals))
+            pred_bboxes, pred_regions = pred_bboxes[keep], pred_regions[keep]
+
+        return (image, category_ids, (boxes[:n_gt], regions[:n_gt]), (pred_bboxes, pred_regions))
+
+
+def collate_batch(batch):
+    '''
+    Packs a list of samples into concatenated tensors with per-image offsets, so row
+    gt_offsets[i]:gt_offsets[i+1] of gt_boxes belongs to image i. Regions are None
+    if they are extracted in the model. Module level, so it can be pickled to workers.
+    '''
+    images, cat_ids, bboxes_data, pred_bboxes_data = zip(*batch)
+    gt_counts   = torch.tensor([0] + [len(bboxes) for (bboxes, _) in bboxes_data])
+    pred_counts = torch.tensor([0] + [len(pred_bboxes) for (pred_bboxes, _) in pred_bboxes_data])
+
+    return {
+        'images':       torch.stack(images),
+        'gt_boxes':     torch.concat([bboxes for (bboxes, _) in bboxes_data]),
+        'gt_labels':    torch.concat([cat_ids_.flatten() for cat_ids_ in cat_ids]),
+        'gt_offsets':   torch.cumsum(gt_counts, 0),
+        'gt_regions':   torch.concat([regions for (_, regions) in bboxes_data]) if bboxes_data[0][1] is not None else None,
+        'pred_boxes':   torch.concat([pred_bboxes for (pred_bboxes, _) in pred_bboxes_data]),
+        'pred_offsets': torch.cumsum(pred_counts, 0),
+        'pred_regions': torch.concat([regions for (_, regions) in pred_bboxes_data]) if pred_bboxes_data[0][1] is not None else None,
+    }
+
+def get_transform(img_size=(512, 512)):
+    return A.Compose([
+        A.Resize(img_size[0], img_size[1]),
+        ToTensorV2(),
+    ], bbox_params=A.BboxParams(format='coco', label_fields=['category_ids']), is_check_shapes=False)
 
 def get_loaders(
         dataset, 
@@ -193,6 +320,15 @@ def get_loaders(
         img_size=(512, 512), region_size=(224, 224),
         use_super_categories=True,
         root = '/dtu/datasets1/02514/data_wastedetection',
+        region_store = None,
+        proposals_path = PROPOSALS_PATH,
+        region_mode = 'crop',
+        sample_regions = False,
+        pin_memory = False,
+        proposal_ranker = None,
+        top_n_proposals = -1,
+        persistent_workers = False,
+        prefetch_factor = None,
     ) -> Tuple[dict, int]:
     
     # Set seed for split control
@@ -204,21 +340,31 @@ def get_loaders(
         ToTensorV2(),
     ], bbox_params=A.BboxParams(format='coco', label_fields=['category_ids']), is_check_shapes=False)
 
-    # Define transforms for training
-    test_transform = A.Compose([
-        A.Resize(img_size[0], img_size[1]),
-        ToTensorV2(),
-    ], bbox_params=A.BboxParams(format='coco', label_fields=['category_ids']), is_check_shapes=False)
+    # Define transforms for test and validation
+    test_transform = get_transform(img_size)
+
+    # Ranking of validation and test proposals, see src/data/project4/proposal_ranking.py
+    if proposal_ranker is not None:
+        proposal_ranker = ProposalRanker.load(proposal_ranker)
+
+    # Parse annotations once for all splits
+    annotations = load_annotation_index(root + '/' + 'annotations.json')
 
-    # Get train, validation and test sets
-    trainset    = WasteDataset('train', data_path=root, transform=train_transform, region_size=region_size, use_super_categories=use_super_categories)
-    valset      = WasteDataset('val',   data_path=root, transform=test_transform, region_size=region_size, use_super_categories=use_super_categories)
-    testset     = WasteDataset('test',  data_path=root, transform=test_transform, region_size=region_size, use_super_categories=use_super_categories)
+    # Get train, validation and test sets - val and test do not change between epochs and can be served from a region store
+    trainset    = WasteDataset('train', data_path=root, transform=train_transform, decode_size=img_size, region_size=region_size, use_super_categories=use_super_categories, 
+                               proposals_path=proposals_path, annotation_index=annotations, region_mode=region_mode, sample_regions=sample_regions)
+    valset      = WasteDataset('val',   data_path=root, transform=test_transform, decode_size=img_size, region_size=region_size, use_super_categories=use_super_categories, 
+                               proposals_path=proposals_path, annotation_index=annotations, region_mode=region_mode, region_store=f'{region_store}/val' if region_store is not None else None,
+                               proposal_ranker=proposal_ranker, top_n_proposals=top_n_proposals)
+    testset     = WasteDataset('test',  data_path=root, transform=test_transform, decode_size=img_size, region_size=region_size, use_super_categories=use_super_categories, 
+                               proposals_path=proposals_path, annotation_index=annotations, region_mode=region_mode, region_store=f'{region_store}/test' if region_store is not None else None,
+                               proposal_ranker=proposal_ranker, top_n_proposals=top_n_proposals)
 
     # Get dataloaders
-    trainloader = DataLoader(trainset,  batch_size=batch_size, shuffle=True,  num_workers=num_workers, collate_fn=lambda x: x)
-    valloader   = DataLoader(valset,    batch_size=batch_size, shuffle=False, num_workers=num_workers, collate_fn=lambda x: x)
-    testloader  = DataLoader(testset,   batch_size=batch_size, shuffle=False, num_workers=num_workers, collate_fn=lambda x: x)
+    loader_kwargs = get_loader_kwargs(num_workers, pin_memory, persistent_workers, prefetch_factor)
+    trainloader = DataLoader(trainset,  batch_size=batch_size, shuffle=True,  collate_fn=collate_batch, **loader_kwargs)
+    valloader   = DataLoader(valset,    batch_size=batch_size, shuffle=False, collate_fn=collate_batch, **loader_kwargs)
+    testloader  = DataLoader(testset,   batch_size=batch_size, shuffle=False, collate_fn=collate_batch, **loader_kwargs)
 
     # Return loaders in dictionary
     return {'train': trainloader, 'validation': valloader, 'test': testloader}, trainset.num_classes
@@ -229,8 +375,7 @@ def NoOp(image, **kwargs):
 def dummy_data():
     # an image
     image = Image.open(os.getcwd() + '/src/data/project4/dummy_data/img.jpg')
-    image = np.array(image) / 255 
-    image = image.astype(np.float32)
+    image = np.array(image)
     # the bbox
     category_ids = 0
     bboxes = [50, 50, 100, 100]
@@ -0,0 +1,211 @@
+import argparse
+import json
+import time
+
+import numpy as np
+import torch
+from torchvision.ops import box_iou
+from tqdm import tqdm
+
+FEATURE_NAMES = ['bias', 'log_area', 'log_area_squared', 'abs_log_aspect', 'center_distance', 'border_contact', 'color_contrast', 'color_std']
+
+# Hand-set weights favouring distinct, compact boxes that do not touch the border
+DEFAULT_WEIGHTS = [0.0, 0.0, -0.15, -0.5, -0.5, -0.5, 4.0, 1.0]
+
+
+def integral_image(image):
+    # Summed-area table with a leading row and column of zeros
+    table = np.zeros((image.shape[0] + 1, image.shape[1] + 1) + image.shape[2:], dtype=np.float64)
+    table[1:, 1:] = image.cumsum(0).cumsum(1)
+    return table
+
+def box_sums(table, boxes):
+    # Sum of the pixels inside every (x1, y1, x2, y2) box in O(1) per box
+    x1, y1, x2, y2 = boxes.T
+    return table[y2, x2] - table[y1, x2] - table[y2, x1] + table[y1, x1]
+
+def proposal_features(image, boxes, context=0.1):
+    '''
+    Cheap per-box features from the box geometry and the color statistics of the box and a
+    ring of context around it. image is (H, W, 3) uint8 and boxes are (N, 4) (x1, y1, x2, y2).
+    '''
+    height, width = image.shape[:2]
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+    boxes = np.clip(boxes, 0, [width, height, width, height])
+    w, h = np.maximum(boxes[:, 2] - boxes[:, 0], 1), np.maximum(boxes[:, 3] - boxes[:, 1], 1)
+
+    # Geometry
+    log_area = np.log(w * h / (width * height))
+    abs_log_aspect = np.abs(np.log(w / h))
+    center_distance = np.hypot((boxes[:, 0] + boxes[:, 2]) / (2 * width) - 0.5, (boxes[:, 1] + boxes[:, 3]) / (2 * height) - 0.5)
+    border_contact = ((boxes[:, 0] == 0).astype(int) + (boxes[:, 1] == 0) + (boxes[:, 2] == width) + (boxes[:, 3] == height)) / 4
+
+    # Color statistics inside the box and in the surrounding ring
+    image = image.astype(np.float64) / 255
+    table, table_squared = integral_image(image), integral_image((image ** 2).sum(2))
+    dx, dy = np.ceil(context * w).astype(np.int64), np.ceil(context * h).astype(np.int64)
+    outer = np.clip(boxes + np.stack([-dx, -dy, dx, dy], axis=1), 0, [width, height, width, height])
+
+    inner_area = (w * h)[:, None]
+    outer_area = ((outer[:, 2] - outer[:, 0]) * (outer[:, 3] - outer[:, 1]))[:, None]
+    inner_sum, outer_sum = box_sums(table, boxes), box_sums(table, outer)
+    inner_mean = inner_sum / inner_area
+    ring_mean = (outer_sum - inner_sum) / np.maximum(outer_area - inner_area, 1)
+    color_contrast = np.where(outer_area[:, 0] > inner_area[:, 0], np.linalg.norm(inner_mean - ring_mean, axis=1), 0)
+    color_std = np.sqrt(np.maximum(box_sums(table_squared, boxes) / inner_area[:, 0] - (inner_mean ** 2).sum(1), 0))
+
+    return np.stack([
+        np.ones(len(boxes)), log_area, log_area ** 2, abs_log_aspect,
+        center_distance, border_contact, color_contrast, color_std,
+    ], axis=1)
+
+
+class ProposalRanker:
+    '''
+    Linear objectness scorer on proposal_features. Uses hand-set weights unless fitted on
+    proposals labelled by their overlap with the ground truth.
+    '''
+    def __init__(self, weights=DEFAULT_WEIGHTS):
+        self.weights = np.asarray(weights, dtype=np.float64)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            return cls(json.load(f)['weights'])
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'features': FEATURE_NAMES, 'weights': self.weights.tolist()}, f)
+
+    def score(self, image, boxes):
+        return proposal_features(image, boxes) @ self.weights
+
+    def top_n(self, image, boxes, n):
+        # Indices of the n highest scoring boxes in their original order, all boxes if n is -1
+        if n < 0 or len(boxes) <= n:
+            return np.arange(len(boxes))
+        return np.sort(np.argpartition(-self.score(image, boxes), n)[:n])
+
+    def fit(self, features, labels, steps=500, lr=0.5, weight_decay=1e-4):
+        # Class balanced logistic regression with gradient descent
+        labels = labels.astype(np.float64)
+        positive = max(labels.mean(), 1e-6)
+        sample_weights = np.where(labels == 1, 0.5 / positive, 0.5 / max(1 - positive, 1e-6)) / len(labels)
+        for _ in range(steps):
+            probs = 1 / (1 + np.exp(-(features @ self.weights)))
+            self.weights -= lr * (features.T @ (sample_weights * (probs - labels)) + weight_decay * self.weights)
+        return self
+
+
+def iterate_split(dataset, max_images=None):
+    # uint8 (H, W, 3) image, ground truth and proposal (x1, y1, x2, y2) boxes of every image in the split
+    for idx in range(len(dataset) if max_images is None else min(max_images, len(dataset))):
+        image, _, (bboxes, _), (pred_bboxes, _) = dataset[idx]
+        yield image.permute(1, 2, 0).numpy(), bboxes, pred_bboxes
+
+def recall_report(ranker, dataset, top_ns, iou_threshold=0.5, max_images=None):
+    '''
+    Fraction of ground truth boxes covered by a proposal with IoU >= iou_threshold when only the
+    top-N ranked proposals of every image are kept, for every N in top_ns (-1 keeps all proposals).
+    '''
+    found = {n: 0 for n in top_ns}
+    kept = {n: 0 for n in top_ns}
+    num_gt, num_images, ranking_time = 0, 0, 0.0
+
+    for image, bboxes, pred_bboxes in tqdm(iterate_split(dataset, max_images), desc='Ranking proposals...'):
+        start = time.perf_counter()
+        order = np.argsort(-ranker.score(image, pred_bboxes.numpy()), kind='stable')
+        ranking_time += time.perf_counter() - start
+
+        num_gt += len(bboxes)
+        num_images += 1
+        if len(bboxes) == 0 or len(pred_bboxes) == 0:
+            continue
+        iou = box_iou(bboxes.to(torch.float), pred_bboxes.to(torch.float)).numpy()[:, order]
+        # Rank of the first proposal covering every ground truth box
+        covered = iou >= iou_threshold
+        first = np.where(covered.any(1), covered.argmax(1), np.inf)
+        for n in top_ns:
+            n_ = len(order) if n < 0 else n
+            found[n] += int((first < n_).sum())
+            kept[n] += min(n_, len(order))
+
+    return {
+        'num_images':       num_images,
+        'num_gt':           num_gt,
+        'ms_per_image':     1000 * ranking_time / max(num_images, 1),
+        'recall':           {n: found[n] / max(num_gt, 1) for n in top_ns},
+        'mean_proposals':   {n: kept[n] / max(num_images, 1) for n in top_ns},
+    }
+
+
+def parse_arguments():
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    for name in ('fit', 'report'):
+        subparser = subparsers.add_parser(name)
+        subparser.add_argument("--data_path", type=str, default="/dtu/datasets1/02514/data_wastedetection",
+                               help="Path to dataset")
+        subparser.add_argument("--proposals_path", type=str, default='/work3/s184984/02514/project4/bboxes/proposals',
+                               help="Path to selective search proposals generated with src/data/project4/proposals.py")
+        subparser.add_argument("--ranker", type=str, default=None,
+                               help="Ranker weights (json) - written by fit, read by report. Hand-set weights are used if not given.")
+        subparser.add_argument("--img_size", type=int, default=512,
+                               help="Size images are resized to.")
+        subparser.add_argument("--max_images", type=int, default=None,
+                               help="Only use the first images of the split.")
+        subparser.add_argument("--iou_threshold", type=float, default=0.5,
+                               help="IoU for a proposal to count as covering a ground truth box.")
+
+    subparsers.choices['report'].add_argument("--top_n", nargs='+', type=int, default=[50, 100, 200, 500, 1000, -1],
+                                              help="Numbers of kept proposals per image to report recall for, -1 for all.")
+    subparsers.choices['report'].add_argument("--output", type=str, default=None,
+                                              help="Optionally write the report as json.")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from src.data.project4.dataloader import WasteDataset, get_transform
+
+    # Get input arguments
+    args = parse_arguments()
+
+    dataset = WasteDataset(
+        'train' if args.command == 'fit' else 'val',
+        data_path=args.data_path,
+        transform=get_transform((args.img_size, args.img_size)),
+        decode_size=(args.img_size, args.img_size),
+        proposals_path=args.proposals_path,
+        region_mode='roi',
+    )
+
+    if args.command == 'fit':
+        features, labels = [], []
+        for image, bboxes, pred_bboxes in tqdm(iterate_split(dataset, args.max_images), desc='Computing proposal features...'):
+            if len(pred_bboxes) == 0:
+                continue
+            features.append(proposal_features(image, pred_bboxes.numpy()))
+            if len(bboxes) == 0:
+                labels.append(np.zeros(len(pred_bboxes), dtype=bool))
+            else:
+                labels.append(box_iou(bboxes.to(torch.float), pred_bboxes.to(torch.float)).max(0)[0].numpy() >= args.iou_threshold)
+
+        ranker = ProposalRanker().fit(np.concatenate(features), np.concatenate(labels))
+        ranker.save(args.ranker or 'proposal_ranker.json')
+        print(dict(zip(FEATURE_NAMES, ranker.weights.round(3))))
+
+    elif args.command == 'report':
+        ranker = ProposalRanker.load(args.ranker) if args.ranker is not None else ProposalRanker()
+        report = recall_report(ranker, dataset, args.top_n, iou_threshold=args.iou_threshold, max_images=args.max_images)
+
+        print(f"Ranking: {report['ms_per_image']:.2f} ms/image over {report['num_images']} images, {report['num_gt']} ground truth boxes")
+        print(f"{'top N':>8} {'proposals/img':>14} {'recall':>8}")
+        for n in args.top_n:
+            print(f"{'all' if n < 0 else n:>8} {report['mean_proposals'][n]:>14.1f} {report['recall'][n]:>8.3f}")
+
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                json.dump(report, f)
@@ -0,0 +1,168 @@
+import argparse
+import json
+import os
+import pickle
+
+import numpy as np
+
+from src.utils import MemmapStore
+from src.data.project4.annotations import load_annotation_index
+
+
+class ProposalStore(MemmapStore):
+    '''
+    Columnar proposal boxes: one flat (N, 4) array of (x, y, w, h) boxes, per-image offsets
+    and a filename index. Boxes are memory-mapped on first access and sliced per image in O(1).
+    '''
+    lazy_attributes = ('boxes', 'offsets', 'matches')
+
+    def __init__(self, path):
+        super().__init__(path)
+        with open(f'{path}/file_names.json', 'r') as f:
+            self.file_names = json.load(f)
+        self.file2idx = {file_name: idx for idx, file_name in enumerate(self.file_names)}
+        self.has_matches = os.path.exists(f'{path}/match_iou.npy')
+
+    def __len__(self):
+        return len(self.file_names)
+
+    def __contains__(self, file_name):
+        return file_name in self.file2idx
+
+    def open(self):
+        self.boxes = np.load(f'{self.path}/boxes.npy', mmap_mode='r')
+        self.offsets = np.load(f'{self.path}/offsets.npy', mmap_mode='r')
+
+    def get_slice(self, file_name):
+        self.ensure_open()
+        idx = self.file2idx[file_name]
+        return slice(int(self.offsets[idx]), int(self.offsets[idx + 1]))
+
+    def __getitem__(self, file_name):
+        self.ensure_open()
+        return self.boxes[self.get_slice(file_name)]
+
+    def get_matches(self, file_name):
+        # Best IoU with a ground truth box and index of that box (-1 if no overlap) for every proposal
+        if self.matches is None:
+            self.matches = (
+                np.load(f'{self.path}/match_iou.npy', mmap_mode='r'),
+                np.load(f'{self.path}/match_gt.npy', mmap_mode='r'),
+            )
+        rows = self.get_slice(file_name)
+        return self.matches[0][rows], self.matches[1][rows]
+
+
+def write_proposal_store(proposals: dict, path, min_box_size=None):
+    '''
+    Writes a dictionary of image file name -> list of (x, y, w, h) boxes as a ProposalStore.
+    '''
+    os.makedirs(path, exist_ok=True)
+    file_names = sorted(proposals.keys())
+
+    boxes, counts = [], []
+    for file_name in file_names:
+        bboxes = np.array(proposals[file_name], dtype=np.int64).reshape(-1, 4)
+        if min_box_size is not None:
+            bboxes = bboxes[(bboxes[:, 2] > min_box_size) & (bboxes[:, 3] > min_box_size)]
+        boxes.append(bboxes)
+        counts.append(len(bboxes))
+
+    boxes = np.concatenate(boxes) if len(boxes) > 0 else np.zeros((0, 4), dtype=np.int64)
+    # Resized images are small, so int16 is usually enough
+    dtype = np.int16 if len(boxes) == 0 or np.abs(boxes).max() <= np.iinfo(np.int16).max else np.int32
+
+    np.save(f'{path}/boxes.npy', boxes.astype(dtype))
+    np.save(f'{path}/offsets.npy', np.concatenate([[0], np.cumsum(counts)]).astype(np.int64))
+    with open(f'{path}/file_names.json', 'w') as f:
+        json.dump(file_names, f)
+
+    return ProposalStore(path)
+
+
+def box_iou(boxes1, boxes2):
+    # IoU matrix between (x1, y1, x2, y2) boxes
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    lt = np.maximum(boxes1[:, None, :2], boxes2[None, :, :2])
+    rb = np.minimum(boxes1[:, None, 2:], boxes2[None, :, 2:])
+    wh = np.clip(rb - lt, 0, None)
+    intersection = wh[..., 0] * wh[..., 1]
+    return intersection / np.maximum(area1[:, None] + area2[None, :] - intersection, 1e-7)
+
+def to_corners(bboxes):
+    # (x, y, w, h) -> (x1, y1, x2, y2), rounded like WasteDataset.extract_resize_region
+    (x, y, w, h) = np.ceil(np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)).T
+    return np.stack([x, y, x+w, y+h], axis=1)
+
+def write_matches(store, annotations, img_size=(512, 512)):
+    '''
+    Matches every proposal in the store to the ground truth boxes of its image, in the coordinates
+    of the resized image, and stores the best IoU and matched box alongside the proposals.
+    '''
+    store.ensure_open()
+
+    file2idx = {file_name: idx for idx, file_name in enumerate(annotations.file_names)}
+    match_iou = np.zeros(int(store.offsets[-1]), dtype=np.float32)
+    match_gt = -np.ones_like(match_iou, dtype=np.int16)
+
+    for file_name in store.file_names:
+        rows = store.get_slice(file_name)
+        if file_name not in file2idx or rows.stop == rows.start:
+            continue
+
+        # Ground truth boxes scaled like the Resize transform in get_loaders
+        bboxes, _ = annotations.get(file2idx[file_name])
+        width, height = annotations.get_size(file2idx[file_name])
+        bboxes = bboxes * np.array([img_size[1] / width, img_size[0] / height] * 2)
+        if len(bboxes) == 0:
+            continue
+
+        iou = box_iou(to_corners(bboxes), to_corners(store[file_name]))
+        match_iou[rows] = iou.max(axis=0)
+        match_gt[rows] = np.where(iou.max(axis=0) > 0, iou.argmax(axis=0), -1)
+
+    np.save(f'{store.path}/match_iou.npy', match_iou)
+    np.save(f'{store.path}/match_gt.npy', match_gt)
+    store.has_matches = True
+
+
+def parse_arguments():
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    # Convert a whole-file pickle to the indexed format
+    convert = subparsers.add_parser('convert')
+    convert.add_argument("--pickle_path", type=str, default='/work3/s184984/02514/project4/bboxes/bboxes_no_zeros.pkl',
+                         help="Pickled dictionary of proposals to convert.")
+    convert.add_argument("--output", type=str, default='/work3/s184984/02514/project4/bboxes/proposals',
+                         help="Directory of the resulting proposal store.")
+    convert.add_argument("--min_box_size", type=int, default=20,
+                         help="Only keep boxes with width and height larger than this.")
+
+    # Precompute proposal to ground truth matches
+    match = subparsers.add_parser('match')
+    match.add_argument("--store", type=str, default='/work3/s184984/02514/project4/bboxes/proposals',
+                       help="Directory of the proposal store.")
+    match.add_argument("--data_path", type=str, default="/dtu/datasets1/02514/data_wastedetection",
+                       help="Path to dataset")
+    match.add_argument("--img_size", type=int, default=512,
+                       help="Size images are resized to in the dataset.")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    # Get input arguments
+    args = parse_arguments()
+
+    if args.command == 'convert':
+        with open(args.pickle_path, 'rb') as fp:
+            proposals = pickle.load(fp)
+        write_proposal_store(proposals, args.output, min_box_size=args.min_box_size)
+
+    elif args.command == 'match':
+        store = ProposalStore(args.store)
+        write_matches(store, load_annotation_index(f'{args.data_path}/annotations.json'), img_size=(args.img_size, args.img_size))
@@ -0,0 +1,120 @@
+import argparse
+import json
+import os
+import time
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+from PIL import Image
+from tqdm import tqdm
+
+import albumentations as A
+
+from src.utils import selective_search
+from src.data.project4.dataloader import exif_rotate
+from src.data.project4.proposal_store import write_proposal_store, write_matches
+from src.data.project4.annotations import load_annotation_index
+
+
+def propose(file_name, data_path, img_size=(512, 512), scale=500, sigma=0.9, min_size=10, min_box_size=20):
+    '''
+    Runs selective search on a single image resized to the size used by WasteDataset.
+    Returns boxes as (x, y, w, h) in resized image coordinates.
+    '''
+    image = exif_rotate(Image.open(f'{data_path}/{file_name}')).convert('RGB')
+    image = A.Resize(img_size[0], img_size[1])(image=np.array(image))['image']
+
+    # Run selective search and remove small boxes
+    bboxes = selective_search(torch.from_numpy(image).permute(2, 0, 1), scale=scale, sigma=sigma, min_size=min_size)
+    bboxes = sorted(bbox for bbox in bboxes if bbox[2] > min_box_size and bbox[3] > min_box_size)
+    return file_name, [list(map(int, bbox)) for bbox in bboxes]
+
+def load_checkpoint(checkpoint_path):
+    # Per-image results of an interrupted run, a truncated last line is ignored
+    proposals = {}
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, 'r') as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                proposals[result['file_name']] = result['boxes']
+    return proposals
+
+def generate_proposals(
+        file_names, data_path, checkpoint_path,
+        num_workers=1, chunksize=4, **kwargs
+    ) -> dict:
+    '''
+    Runs selective search over all images in a process pool. Results are appended to
+    the checkpoint as soon as an image is done, so an interrupted run resumes where it stopped.
+    '''
+    proposals = load_checkpoint(checkpoint_path)
+    todo = [file_name for file_name in file_names if file_name not in proposals]
+    print(f"Found {len(proposals)} images in checkpoint, {len(todo)} images left.")
+
+    start = time.time()
+    with Pool(num_workers) as pool, open(checkpoint_path, 'a') as f:
+        results = pool.imap_unordered(partial(propose, data_path=data_path, **kwargs), todo, chunksize=chunksize)
+        for file_name, bboxes in tqdm(results, total=len(todo), desc='Running selective search...'):
+            f.write(json.dumps({'file_name': file_name, 'boxes': bboxes}) + '\n')
+            f.flush()
+            proposals[file_name] = bboxes
+
+    elapsed = time.time() - start
+    print(f"Processed {len(todo)} images in {elapsed:.1f}s ({len(todo) / max(elapsed, 1e-9):.2f} images/sec)")
+    return proposals
+
+
+def parse_arguments():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--data_path", type=str, default="/dtu/datasets1/02514/data_wastedetection",
+                        help="Path to dataset")
+    parser.add_argument("--annotations", type=str, default=None,
+                        help="Annotation file listing the images - defaults to <data_path>/annotations.json")
+    parser.add_argument("--output", type=str, default='/work3/s184984/02514/project4/bboxes/proposals',
+                        help="Directory of the resulting proposal store.")
+    parser.add_argument("--checkpoint", type=str, default=None,
+                        help="Per-image checkpoint used for resuming - defaults to <output>.partial.jsonl")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(),
+                        help="Number of processes running selective search.")
+    parser.add_argument("--chunksize", type=int, default=4,
+                        help="Number of images handed to a process at a time.")
+    parser.add_argument("--img_size", type=int, default=512,
+                        help="Size images are resized to before running selective search.")
+    parser.add_argument("--scale", type=float, default=500,
+                        help="Selective search scale (free parameter, higher means larger clusters).")
+    parser.add_argument("--sigma", type=float, default=0.9,
+                        help="Selective search sigma (width of Gaussian kernel for smoothing).")
+    parser.add_argument("--min_size", type=int, default=10,
+                        help="Selective search min_size (minimum component size).")
+    parser.add_argument("--min_box_size", type=int, default=20,
+                        help="Only keep boxes with width and height larger than this.")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    # Get input arguments
+    args = parse_arguments()
+
+    annotations = args.annotations or f'{args.data_path}/annotations.json'
+    with open(annotations, 'r') as f:
+        file_names = [img_data['file_name'] for img_data in json.loads(f.read())['images']]
+
+    proposals = generate_proposals(
+        file_names, args.data_path, args.checkpoint or f'{args.output}.partial.jsonl',
+        num_workers=args.num_workers, chunksize=args.chunksize,
+        img_size=(args.img_size, args.img_size),
+        scale=args.scale, sigma=args.sigma, min_size=args.min_size, min_box_size=args.min_box_size,
+    )
+
+    # Indexed format consumed by WasteDataset, with matches used for sampling training regions
+    store = write_proposal_store(proposals, args.output)
+    write_matches(store, load_annotation_index(annotations), img_size=(args.img_size, args.img_size))
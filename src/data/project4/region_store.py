@@ -0,0 +1,188 @@
+import argparse
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from src.utils import MemmapStore, read_store_meta, write_store_meta
+
+
+# Dataset settings recorded in meta.json and checked when a dataset opens the store
+SETTINGS = ('use_super_categories', 'img_size', 'region_size', 'proposals_path')
+
+def normalize_settings(settings):
+    # JSON comparable values, sizes as lists and absolute paths
+    return {
+        key: os.path.abspath(value) if key == 'proposals_path' else list(value) if key in ('img_size', 'region_size') and value is not None else value
+        for key, value in settings.items()
+    }
+
+def _identity(batch):
+    return batch
+
+def to_uint8(x):
+    # Regions are uint8 already, float regions in [0, 1] are quantized
+    if x.dtype == torch.uint8:
+        return x.numpy()
+    return (x * 255).round_().clamp_(0, 255).to(torch.uint8).numpy()
+
+
+class RegionStore(MemmapStore):
+    '''
+    Read-only view of the resized image and region crops written by build_region_store.
+    Shards are memory-mapped lazily, so the store is cheap to send to DataLoader workers.
+    '''
+    lazy_attributes = ('shards',)
+
+    def __init__(self, path):
+        super().__init__(path)
+        meta = read_store_meta(path)
+
+        self.file_names = meta['file_names']
+        self.region_size = tuple(meta['region_size'])
+        self.num_shards = meta['num_shards']
+        # Dataset settings the store was built with, None for stores built before they were recorded
+        self.settings = {key: meta.get(key) for key in SETTINGS}
+
+        # (shard, image slot, row start, number of gt boxes, number of proposals) per image
+        self.index = np.load(f'{path}/index.npy')
+        self.file2idx = {file_name: idx for idx, file_name in enumerate(self.file_names)}
+
+    def check_settings(self, **settings):
+        # Raises if the store was built with different dataset settings than the given ones
+        mismatches = [
+            f'{key}={self.settings[key]} (expected {value})'
+            for key, value in normalize_settings(settings).items()
+            if self.settings[key] != value
+        ]
+        if len(mismatches) > 0:
+            raise ValueError(f'region store {self.path} was built with different settings, rebuild it: ' + ', '.join(mismatches))
+
+    def __len__(self):
+        return len(self.file_names)
+
+    def __contains__(self, file_name):
+        return file_name in self.file2idx
+
+    def open(self):
+        # Copy-on-write maps give writable arrays for torch.from_numpy without copying the data
+        self.shards = [{
+            key: np.load(f'{self.path}/shard_{shard:04d}_{key}.npy', mmap_mode='c')
+            for key in ('images', 'regions', 'boxes', 'labels')
+        } for shard in range(self.num_shards)]
+
+    def __getitem__(self, file_name):
+        self.ensure_open()
+
+        shard, slot, start, n_gt, n_pred = self.index[self.file2idx[file_name]]
+        arrays = self.shards[shard]
+        rows = slice(start, start + n_gt + n_pred)
+
+        image   = torch.from_numpy(arrays['images'][slot])
+        regions = torch.from_numpy(arrays['regions'][rows])
+        boxes   = torch.from_numpy(arrays['boxes'][rows])
+        labels  = torch.from_numpy(arrays['labels'][start:start + n_gt]).long().unsqueeze(1)
+        return image, labels, boxes, regions, int(n_gt)
+
+
+def build_region_store(dataset, path, shard_size=64, num_workers=1):
+    '''
+    Materializes the image, ground truth regions and proposal regions of every
+    sample in the dataset as uint8 shards that can be served by a RegionStore.
+    '''
+    os.makedirs(path, exist_ok=True)
+    loader = DataLoader(dataset, batch_size=1, shuffle=False, num_workers=num_workers, collate_fn=_identity)
+
+    file_names, index = [], []
+    shard = {key: [] for key in ('images', 'regions', 'boxes', 'labels')}
+    num_shards, row = 0, 0
+
+    def write_shard():
+        for key, values in shard.items():
+            np.save(f'{path}/shard_{num_shards:04d}_{key}.npy', np.concatenate(values) if key != 'images' else np.stack(values))
+            values.clear()
+
+    for idx, [(image, cat_ids, (bboxes, regions), (pred_bboxes, pred_regions))] in enumerate(tqdm(loader, desc=f'Building region store in {path}...')):
+        n_gt, n_pred = len(bboxes), len(pred_bboxes)
+        file_names.append(dataset.image_paths[idx][1])
+        index.append((num_shards, len(shard['images']), row, n_gt, n_pred))
+
+        shard['images'].append(to_uint8(image))
+        shard['regions'].append(np.concatenate([to_uint8(regions), to_uint8(pred_regions)]))
+        shard['boxes'].append(torch.concat([bboxes, pred_bboxes]).numpy().astype(np.int32))
+        shard['labels'].append(np.concatenate([
+            cat_ids.flatten().numpy().astype(np.int16),
+            -np.ones(n_pred, dtype=np.int16)
+        ]))
+        row += n_gt + n_pred
+
+        # Close the shard when it is full
+        if len(shard['images']) == shard_size:
+            write_shard()
+            num_shards += 1
+            row = 0
+
+    if len(shard['images']) > 0:
+        write_shard()
+        num_shards += 1
+
+    np.save(f'{path}/index.npy', np.array(index, dtype=np.int64).reshape(-1, 5))
+    write_store_meta(path, {
+        'file_names': file_names,
+        'num_shards': num_shards,
+        **normalize_settings({
+            'use_super_categories': dataset.use_super_categories,
+            'img_size': dataset.decode_size,
+            'region_size': dataset.region_size,
+            'proposals_path': dataset.proposals_path,
+        }),
+    })
+
+    return RegionStore(path)
+
+
+def parse_arguments():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--data_path", type=str, default="/dtu/datasets1/02514/data_wastedetection",
+                        help="Path to dataset")
+    parser.add_argument("--store_path", type=str, default='/work3/s184984/02514/project4/region_store',
+                        help="Directory in which a store is written for each split.")
+    parser.add_argument("--proposals_path", type=str, default=PROPOSALS_PATH,
+                        help="Selective search proposals, a store from src/data/project4/proposal_store.py.")
+    parser.add_argument("--splits", nargs='+', default=['val', 'test'],
+                        help="Splits to materialize - train is only valid without augmentations.")
+    parser.add_argument("--use_super_categories", type=bool, default=True,
+                        help="Whether to use 60 categories or 28 less fine-grained super categories")
+    parser.add_argument("--img_size", type=int, default=512,
+                        help="Size images are resized to before extracting regions.")
+    parser.add_argument("--region_size", type=int, default=224,
+                        help="Size of bbox images.")
+    parser.add_argument("--shard_size", type=int, default=64,
+                        help="Number of images per shard.")
+    parser.add_argument("--num_workers", type=int, default=1,
+                        help="Number of workers in the dataloader.")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from src.data.project4.dataloader import WasteDataset, get_transform, PROPOSALS_PATH
+
+    # Get input arguments
+    args = parse_arguments()
+
+    for split in args.splits:
+        dataset = WasteDataset(
+            split,
+            data_path=args.data_path,
+            transform=get_transform((args.img_size, args.img_size)),
+            decode_size=(args.img_size, args.img_size),
+            region_size=(args.region_size, args.region_size),
+            use_super_categories=args.use_super_categories,
+            proposals_path=args.proposals_path,
+        )
+        build_region_store(dataset, f'{args.store_path}/{split}', shard_size=args.shard_size, num_workers=args.num_workers)
@@ -0,0 +1,89 @@
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from tqdm import tqdm
+
+from src.utils import MemmapStore, read_store_meta, write_store_meta, is_store_complete
+
+
+class FeatureCache(MemmapStore, Dataset):
+    '''
+    Pooled backbone embeddings of every sample (or region) as a memory-mapped (N, D) float16
+    array with their labels. Training a head on the cache skips the frozen backbone entirely.
+    '''
+    lazy_attributes = ('features',)
+
+    def __init__(self, path):
+        super().__init__(path)
+        meta = read_store_meta(path)
+        self.num_rows, self.dim = meta['num_rows'], meta['dim']
+        self.labels = np.load(f'{path}/labels.npy')
+
+    def __len__(self):
+        return self.num_rows
+
+    def open(self):
+        self.features = np.memmap(f'{self.path}/features.bin', dtype=np.float16, mode='r', shape=(self.num_rows, self.dim))
+
+    def __getitem__(self, idx):
+        self.ensure_open()
+        return torch.from_numpy(self.features[idx].astype(np.float32)), int(self.labels[idx])
+
+
+class FeatureCacheWriter:
+    '''
+    Appends embeddings to the cache as they are computed, so the number of rows
+    does not have to be known in advance.
+    '''
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.file = open(f'{path}/features.bin', 'wb')
+        self.labels, self.num_rows, self.dim = [], 0, None
+
+    def add(self, features, labels):
+        features = features.detach().to('cpu', torch.float16).numpy()
+        self.dim = features.shape[1]
+        self.file.write(np.ascontiguousarray(features).tobytes())
+        self.labels.append(np.asarray(labels, dtype=np.int64).reshape(-1))
+        self.num_rows += len(features)
+
+    def close(self):
+        self.file.close()
+        np.save(f'{self.path}/labels.npy', np.concatenate(self.labels) if len(self.labels) > 0 else np.zeros(0, dtype=np.int64))
+        write_store_meta(self.path, {'num_rows': self.num_rows, 'dim': self.dim, 'dtype': 'float16'})
+        return FeatureCache(self.path)
+
+
+def is_cached(path):
+    return is_store_complete(path)
+
+@torch.no_grad()
+def build_image_cache(model, loader, path):
+    '''
+    Caches model.embed of every image of an (image, label) loader, e.g. the hotdog splits.
+    Use a loader without random augmentations, as the embeddings are computed once.
+    '''
+    model.eval()
+    writer = FeatureCacheWriter(path)
+    for x, y in tqdm(loader, desc=f'Caching features in {path}...'):
+        writer.add(model.embed(x.to(model.device)), y)
+    return writer.close()
+
+@torch.no_grad()
+def build_region_cache(model, loader, path, sample_background=True):
+    '''
+    Caches model.embed of the regions of every image of a project4 loader (batches packed by
+    collate_batch) with the labels of their best matching ground truth box. With sample_background,
+    all foreground proposals and three background proposals per foreground or ground truth region
+    are kept (the sample is drawn once), otherwise all proposals are kept.
+    '''
+    model.eval()
+    writer = FeatureCacheWriter(path)
+    for batch in tqdm(loader, desc=f'Caching region features in {path}...'):
+        batch = {key: value.to(model.device) if value is not None else None for key, value in batch.items()}
+        boxes, labels, image_idx, regions, _ = model.select_regions(batch, sample_background=sample_background)
+        writer.add(model.classify_boxes(batch, boxes, image_idx, regions, pre_logits=True), labels.cpu())
+    return writer.close()
@@ -20,9 +20,125 @@ def get_optimizer(args, network):
     else:
         raise NotImplementedError("Implement other optimizers when getting this error...")
 
+class Normalize(nn.Module):
+    '''
+    Scales uint8 images to [0, 1] and normalizes them with the training set statistics
+    in a single multiply-add on the device. Float inputs are assumed to be normalized already.
+    '''
+    def __init__(self, mean=(0., 0., 0.), std=(1., 1., 1.)):
+        super(Normalize, self).__init__()
+        # Not saved in checkpoints, set_constants is called after loading (and older checkpoints load strictly)
+        self.register_buffer('scale', torch.ones(1, 3, 1, 1), persistent=False)
+        self.register_buffer('shift', torch.zeros(1, 3, 1, 1), persistent=False)
+        self.set_constants(mean, std)
+
+    def set_constants(self, mean, std):
+        # Kept as lists for the checkpoint, see NormalizedInputModule
+        self.mean, self.std = [float(m) for m in mean], [float(s) for s in std]
+        mean = torch.as_tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+        std = torch.as_tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+        self.scale.copy_(1 / (255 * std))
+        self.shift.copy_(-mean / std)
+
+    def forward(self, x):
+        if x.dtype != torch.uint8:
+            return x
+        return torch.addcmul(self.shift, x.to(self.scale.dtype), self.scale)
+
+
+class BatchAugmentation(nn.Module):
+    '''
+    Random horizontal flip, Gaussian blur and rotation of a whole (B, C, H, W) batch on the
+    device, with the parameters of the former per-sample torchvision transforms. Every sample
+    draws its own flip, blur sigma and rotation angle. uint8 batches stay uint8.
+    '''
+    def __init__(self, flip=False, rotation=False, blur=False, flip_p=0.5, degrees=(60, 70), kernel_size=(5, 9), sigma=(0.1, 5)):
+        super(BatchAugmentation, self).__init__()
+        self.flip, self.rotation, self.blur = flip, rotation, blur
+        self.flip_p = flip_p
+        self.degrees = degrees
+        self.kernel_size = kernel_size  # (width, height) as in transforms.GaussianBlur
+        self.sigma = sigma
+
+    def random_uniform(self, n, low, high, device):
+        return low + (high - low) * torch.rand(n, device=device)
+
+    def gaussian_blur(self, x):
+        # Separable blur with a sigma per sample, as a grouped convolution over all channels of the batch
+        B, C, H, W = x.shape
+        sigma = self.random_uniform(B, *self.sigma, x.device)
+
+        def kernels(size):
+            offsets = torch.arange(size, device=x.device, dtype=x.dtype) - (size - 1) / 2
+            kernel = torch.exp(-0.5 * (offsets[None, :] / sigma[:, None]) ** 2)
+            return (kernel / kernel.sum(1, keepdim=True)).repeat_interleave(C, dim=0)
+
+        kx, ky = self.kernel_size
+        x = x.reshape(1, B * C, H, W)
+        x = nn.functional.conv2d(nn.functional.pad(x, (kx // 2, kx // 2, 0, 0), mode='reflect'), kernels(kx)[:, None, None, :], groups=B * C)
+        x = nn.functional.conv2d(nn.functional.pad(x, (0, 0, ky // 2, ky // 2), mode='reflect'), kernels(ky)[:, None, :, None], groups=B * C)
+        return x.reshape(B, C, H, W)
+
+    def rotate(self, x):
+        # Counter-clockwise rotation about the center, nearest neighbour sampling and black corners
+        B, _, H, W = x.shape
+        angle = torch.deg2rad(self.random_uniform(B, *self.degrees, x.device))
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        zeros = torch.zeros_like(angle)
+        theta = torch.stack([
+            torch.stack([cos, -sin * H / W, zeros], dim=1),
+            torch.stack([sin * W / H, cos, zeros], dim=1),
+        ], dim=1).to(x.dtype)
+        grid = nn.functional.affine_grid(theta, list(x.shape), align_corners=False)
+        return nn.functional.grid_sample(x, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+
+    def forward(self, x):
+        # Cached (N, D) embeddings are not augmented
+        if x.ndim != 4 or not (self.flip or self.rotation or self.blur):
+            return x
+
+        dtype = x.dtype
+        x = x.to(torch.float32)
+        if self.flip:
+            flipped = torch.rand(len(x), device=x.device) < self.flip_p
+            x = torch.where(flipped[:, None, None, None], x.flip(-1), x)
+        if self.blur:
+            x = self.gaussian_blur(x)
+        if self.rotation:
+            x = self.rotate(x)
+        if dtype == torch.uint8:
+            x = x.round_().clamp_(0, 255)
+        return x.to(dtype)
+
+
+def get_augmentation(args):
+    # --augmentation flags are [flip, rotation, blur]
+    flags = list(getattr(args, 'augmentation', None) or []) + [False] * 3
+    return BatchAugmentation(flip=flags[0], rotation=flags[1], blur=flags[2])
+
+
+class NormalizedInputModule(pl.LightningModule):
+    '''
+    Stores the normalization constants of self.normalize in the checkpoints, so inference uses
+    the statistics the model was trained with, see load_normalization_constants.
+    '''
+    def on_save_checkpoint(self, checkpoint):
+        checkpoint['normalization'] = {'mean': self.normalize.mean, 'std': self.normalize.std}
+
+    def on_load_checkpoint(self, checkpoint):
+        if 'normalization' in checkpoint:
+            self.normalize.set_constants(**checkpoint['normalization'])
+
+def load_normalization_constants(model_path):
+    # Mean and std stored in a checkpoint, None for checkpoints saved before they were stored
+    checkpoint = torch.load(model_path, map_location='cpu', weights_only=False)
+    if 'normalization' not in checkpoint:
+        return None
+    return torch.tensor(checkpoint['normalization']['mean']), torch.tensor(checkpoint['normalization']['std'])
+
 
 ### BASEMODEL ###
-class CNNModel(pl.LightningModule):
+class CNNModel(NormalizedInputModule):
     def __init__(self, args):
         super(CNNModel, self).__init__()
         
@@ -32,7 +148,9 @@ class CNNModel(pl.LightningModule):
         self.save_hyperparameters()
         
         
-        # Load network
+        # Load network - inputs are uint8 and normalized on the device
+        self.normalize = Normalize()
+        self.augment = get_augmentation(args)
         self.network = get_network(self.args.network_name, self.args)
 
         # Define metrics and loss criterion
@@ -53,14 +171,15 @@ class CNNModel(pl.LightningModule):
         )
 
     def forward(self, x):
-        return self.network(x)
+        return self.network(self.normalize(x))
 
     def configure_optimizers(self):
         return get_optimizer(self.args, self.network)
     
     def training_step(self, batch, batch_idx):
-        # Extract and process input
+        # Extract and process input, augmented as a batch on the device
         x, y = batch
+        x = self.augment(x)
         y = torch.nn.functional.one_hot(y, num_classes=2) 
         y = y.to(torch.float32)
 
@@ -95,14 +214,16 @@ class CNNModel(pl.LightningModule):
 
 
 ### Transfer learning model ###
-class HotdogEfficientNet(pl.LightningModule):
+class HotdogEfficientNet(NormalizedInputModule):
     def __init__(self, args):
         super(HotdogEfficientNet, self).__init__()
 
         self.args = args
         self.lr = args.lr
         
-        # Load model
+        # Load model - inputs are uint8 and normalized on the device
+        self.normalize = Normalize()
+        self.augment = get_augmentation(args)
         self.network = timm.create_model(args.network_name, pretrained=True, num_classes=2)
         if args.percentage_to_freeze != -1.0:
             self.freeze_parameters(args.percentage_to_freeze)
@@ -150,14 +271,25 @@ class HotdogEfficientNet(pl.LightningModule):
             print(f"Froze {frozen_params}/{frozen_params + non_frozen_params} = {frozen_params / (frozen_params + non_frozen_params)}%")
 
     def forward(self, x):
-        return self.network(x)
+        # Cached (N, D) embeddings only go through the classifier
+        if x.ndim == 2:
+            return self.head(x)
+        return self.network(self.normalize(x))
+
+    def embed(self, x):
+        # Pooled backbone features, input of the classifier
+        return self.network.forward_head(self.network.forward_features(self.normalize(x)), pre_logits=True)
+
+    def head(self, z):
+        return self.network.get_classifier()(z)
 
     def configure_optimizers(self):
         return get_optimizer(self.args, self.network)
         
     def training_step(self, batch, batch_idx):
-        # Extract and process input
+        # Extract and process input, augmented as a batch on the device
         x, y = batch
+        x = self.augment(x)
         y = torch.nn.functional.one_hot(y, num_classes=2) 
         y = y.to(torch.float32)
 
@@ -3,8 +3,8 @@ import torchvision.transforms as transforms
 import argparse
 import matplotlib.pyplot as plt
 
-from src.models.project1.models import get_model
-from src.data.project1.dataloader import get_loaders, get_normalization_constants
+from src.models.project1.models import get_model, load_normalization_constants
+from src.data.project1.dataloader import get_loaders, get_normalization_constants, STATS_CACHE_DIR
 from src.utils import invertNormalization
 from sklearn.metrics import confusion_matrix, ConfusionMatrixDisplay
 import numpy as np
@@ -36,6 +36,10 @@ def parse_arguments():
                         help="Number of epochs for training the model.")
     parser.add_argument("--num_workers", type=int, default=1,
                         help="Number of workers in the dataloader.")
+    parser.add_argument("--stats_cache", type=str, default=STATS_CACHE_DIR,
+                        help="Directory caching the normalization statistics of the training split.")
+    parser.add_argument("--image_store", type=str, default=None,
+                        help="Pre-decoded images built with src/data/project1/image_store.py - used instead of decoding the JPEGs.")
     parser.add_argument("--min_lr", type=float, default=1e-08,
                         help="Minimum allowed learning rater.")
     parser.add_argument("--max_lr", type=float, default=1,
@@ -50,10 +54,12 @@ def parse_arguments():
 args = parse_arguments()
 
 model = get_model(network_name=args.network_name)(args)
-# train_mean, train_std = get_normalization_constants(root=args.data_path, seed=args.seed)
-
-train_mean = torch.tensor([0.5132, 0.4369, 0.3576])
-train_std = torch.tensor([0.0214, 0.0208, 0.0223])
+# Statistics the model was trained with, recomputed for checkpoints saved before they were stored
+constants = load_normalization_constants(args.model_path)
+if constants is None:
+    print(f"Warning: {args.model_path} has no normalization constants, using the statistics of the training split (see the project1 README)")
+    constants = get_normalization_constants(root=args.data_path, seed=args.seed, batch_size=args.batch_size, num_workers=args.num_workers, cache_dir=args.stats_cache)
+train_mean, train_std = constants
 
 # Define transforms for training
 train_transforms = transforms.Compose([
@@ -62,23 +68,20 @@ train_transforms = transforms.Compose([
     # transforms.RandomVerticalFlip(p=1.0),             # flips "upside-down"
     transforms.GaussianBlur(kernel_size=(5, 9), sigma=(0.1, 5)),
     transforms.RandomRotation(degrees=(60, 70)),
-    transforms.ToTensor(),
-    transforms.Normalize(
-        mean=train_mean, 
-        std=train_std, 
-    )
+    transforms.PILToTensor(),
 ])
 
 # Define transforms for test and validation
 test_transforms = transforms.Compose([
     transforms.Resize((224, 224)),
-    transforms.ToTensor(),
-    transforms.Normalize(
-        mean=train_mean, 
-        std=train_std, 
-    )
+    transforms.PILToTensor(),
 ])
 
+# Images from the image store are resized uint8 tensors already
+if args.image_store is not None:
+    train_transforms = transforms.Compose(train_transforms.transforms[1:-1])
+    test_transforms = None
+
 loaders = get_loaders(
     root=args.data_path, 
     batch_size=args.batch_size, 
@@ -86,12 +89,14 @@ loaders = get_loaders(
     train_transforms=train_transforms, 
     test_transforms=test_transforms, 
     num_workers=args.num_workers,
+    image_store=args.image_store,
 )
 
 class2idx = loaders['test'].dataset.subset.dataset.class_to_idx
 idx2class = {v: k for k, v in class2idx.items()}
 
 model = model.load_from_checkpoint(args.model_path, args=args)
+model.normalize.set_constants(train_mean, train_std)
 model.eval()
 
 train_correct = 0
@@ -1,16 +1,20 @@
 import argparse
+import io
 import matplotlib.pyplot as plt
 
 import torch
 import torchvision.transforms as transforms
+from torch.utils.data import DataLoader
 
 import pytorch_lightning as pl
 from pytorch_lightning.loggers import TensorBoardLogger
 
 
-from src.utils import set_seed
+from src.utils import set_seed, apply_loader_profile
 from src.models.project1.models import get_model
-from src.data.project1.dataloader import get_loaders, get_normalization_constants
+from src.data.project1.dataloader import get_loaders, get_normalization_constants, STATS_CACHE_DIR
+from src.features.build_features import FeatureCache, build_image_cache, is_cached
+from src.visualization.writer import get_writer
 
 class BooleanListAction(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
@@ -58,6 +62,18 @@ def parse_arguments():
                         help="Number of epochs for training the model.")
     parser.add_argument("--num_workers", type=int, default=1,
                         help="Number of workers in the dataloader.")
+    parser.add_argument("--pin_memory", type=bool, default=False,
+                        help="Collate batches into pinned memory for faster host to device copies.")
+    parser.add_argument("--persistent_workers", type=bool, default=False,
+                        help="Keep the dataloader workers alive between epochs.")
+    parser.add_argument("--prefetch_factor", type=int, default=None,
+                        help="Number of batches prefetched per worker (DataLoader default if not given).")
+    parser.add_argument("--loader_profile", type=str, default=None,
+                        help="Profile from src/data/benchmark_loaders.py - overrides the dataloader worker settings.")
+    parser.add_argument("--stats_cache", type=str, default=STATS_CACHE_DIR,
+                        help="Directory caching the normalization statistics of the training split.")
+    parser.add_argument("--image_store", type=str, default=None,
+                        help="Pre-decoded images built with src/data/project1/image_store.py - used instead of decoding the JPEGs.")
     parser.add_argument("--min_lr", type=float, default=1e-08,
                         help="Minimum allowed learning rater.")
     parser.add_argument("--max_lr", type=float, default=1,
@@ -70,6 +86,10 @@ def parse_arguments():
     # TRANSFER LEARNING
     parser.add_argument("--percentage_to_freeze", type=float, default=None,
                         help="Percentage to freeze (transfer learning) in [0, 1]")
+    parser.add_argument("--feature_cache", type=str, default=None,
+                        help="Directory of cached backbone embeddings - trains the classifier only (efficientnet with everything else frozen).")
+    parser.add_argument("--cache_batch_size", type=int, default=1024,
+                        help="Number of cached embeddings per batch.")
 
 
     return parser.parse_args()
@@ -79,43 +99,44 @@ def train(args):
     # Set random seed
     set_seed(args.seed)
 
+    # Dataloader worker settings tuned for this machine
+    if args.loader_profile is not None:
+        apply_loader_profile(args, args.loader_profile)
+
+    # Cached embeddings are only valid for a frozen backbone
+    if args.feature_cache is not None and args.percentage_to_freeze is not None:
+        raise ValueError('--feature_cache trains the classifier on frozen embeddings, it cannot be combined with --percentage_to_freeze')
+
     # Load model
     model = get_model(network_name=args.network_name)(args)
+    if args.feature_cache is not None and not hasattr(model, 'embed'):
+        raise ValueError(f'--feature_cache is not supported by {type(model).__name__}, use an efficientnet')
     
     
     print("augmentation", args.augmentation[0], type(args.augmentation[0]), args.augmentation[1], type(args.augmentation[1]), args.augmentation[2], type(args.augmentation[2]))
 
     
-    # Get normalization constants
-    train_mean, train_std = get_normalization_constants(root=args.data_path, seed=args.seed)
-    
-    def no_op_transform(image):
-        return image
+    # Get normalization constants - applied by the model on the device
+    train_mean, train_std = get_normalization_constants(root=args.data_path, seed=args.seed, batch_size=args.batch_size, num_workers=args.num_workers, cache_dir=args.stats_cache)
+    model.normalize.set_constants(train_mean, train_std)
     
-    # Define transforms for training
+    # Only decoding and resizing in the workers - flip, blur and rotation (--augmentation) are applied
+    # by the model to the whole batch on the device
     train_transforms = transforms.Compose([
         transforms.Resize((224, 224)),
-        transforms.RandomHorizontalFlip(p=0.5) if args.augmentation[0] else transforms.Lambda(no_op_transform), # flips "left-right"
-        # transforms.RandomVerticalFlip(p=1.0),             					  # flips "upside-down"
-        transforms.GaussianBlur(kernel_size=(5, 9), sigma=(0.1, 5)) if args.augmentation[2] else transforms.Lambda(no_op_transform),
-        transforms.RandomRotation(degrees=(60, 70)) if args.augmentation[1] else transforms.Lambda(no_op_transform),
-        transforms.ToTensor(),
-        transforms.Normalize(
-            mean=train_mean, 
-            std=train_std, 
-        )
+        transforms.PILToTensor(),
     ])
 
     # Define transforms for test and validation
     test_transforms = transforms.Compose([
         transforms.Resize((224, 224)),
-        transforms.ToTensor(),
-        transforms.Normalize(
-            mean=train_mean, 
-            std=train_std, 
-        )
+        transforms.PILToTensor(),
     ])
 
+    # Images from the image store are resized uint8 tensors already
+    if args.image_store is not None:
+        train_transforms, test_transforms = None, None
+
     # Get data loaders with applied transformations
     loaders = get_loaders(
         root=args.data_path, 
@@ -124,8 +145,31 @@ def train(args):
         train_transforms=train_transforms, 
         test_transforms=test_transforms, 
         num_workers=args.num_workers,
+        image_store=args.image_store,
+        pin_memory=args.pin_memory,
+        persistent_workers=args.persistent_workers,
+        prefetch_factor=args.prefetch_factor,
     )
 
+    # Compute backbone embeddings of the (unaugmented) training and validation images once, only the classifier is trained on them
+    if args.feature_cache is not None:
+        cache_loaders = get_loaders(
+            root=args.data_path, 
+            batch_size=args.batch_size, 
+            seed=args.seed, 
+            train_transforms=test_transforms, 
+            test_transforms=test_transforms, 
+            num_workers=args.num_workers,
+            image_store=args.image_store,
+        )
+        model.to("cuda" if torch.cuda.is_available() else "cpu")
+        caches = {
+            split: FeatureCache(path) if is_cached(path) else build_image_cache(model, cache_loaders[split], path)
+            for split, path in [(split, f'{args.feature_cache}/{split}') for split in ('train', 'validation')]
+        }
+        loaders['train'] = DataLoader(caches['train'], batch_size=args.cache_batch_size, shuffle=True, num_workers=args.num_workers)
+        loaders['validation'] = DataLoader(caches['validation'], batch_size=args.cache_batch_size, shuffle=False, num_workers=args.num_workers)
+
     # Set up logger
     tb_logger = TensorBoardLogger(
         save_dir=f"{args.log_path}/{args.experiment_name}",
@@ -154,11 +198,17 @@ def train(args):
     # manually you can save best checkpoints - 
     trainer.save_checkpoint(f"{args.save_path}/{args.experiment_name}/{args.network_name}.pt")
 
-    # saving sweep
+    # saving sweep, written in the background
+    writer = get_writer()
     if args.initial_lr_steps != -1:
         fig = trainer.model.lr_finder.optimal_lr.plot(suggest=True, show=False);
-        plt.savefig(f"{args.save_path}/{args.experiment_name}/lr_sweep.png")
+        buffer = io.BytesIO()
+        plt.savefig(buffer, format='png')
         plt.close(fig)
+        writer.write_bytes(f"{args.save_path}/{args.experiment_name}/lr_sweep.png", buffer.getvalue())
+
+    writer.flush()
+    print(f"Artifacts written: {writer.stats()}")
 
 
 if __name__ == '__main__':
@@ -3,10 +3,11 @@ import torch.nn as nn
 import torch.nn.functional as F
 from pytorch_lightning.callbacks import ModelCheckpoint, LearningRateFinder
 import pytorch_lightning as pl
-import matplotlib.pyplot as plt
 import numpy as np
 
 from src.utils import accuracy, specificity, sensitivity, iou, dice_score
+from src.visualization import render
+from src.visualization.writer import get_writer
 
 
 def get_model(model_name, args, loss_fun, optimizer, fold, out=False):
@@ -59,10 +60,17 @@ class BaseModel(pl.LightningModule):
 
     def configure_optimizers(self):
         return self.optimizer(self.parameters(), lr = self.args.lr)
+
+    def prepare_input(self, x):
+        # Images are loaded as uint8 and scaled on the device
+        if x.dtype == torch.uint8:
+            x = x.to(torch.float32).mul_(1 / 255)
+        return x
         
     def training_step(self, batch, batch_idx):
         # extract input
         x, y = batch
+        x = self.prepare_input(x)
         # predict
         y_hat = self.forward(x)
         # loss
@@ -83,6 +91,7 @@ class BaseModel(pl.LightningModule):
     def validation_step(self, batch, batch_idx):
         # extract input
         x, y = batch
+        x = self.prepare_input(x)
         # predict
         y_hat = self.forward(x)
         # loss
@@ -103,6 +112,7 @@ class BaseModel(pl.LightningModule):
     def test_step(self, batch, batch_idx): 
         # extract input
         x, y = batch
+        x = self.prepare_input(x)
         # predict
         y_hat = self.forward(x)
         # loss
@@ -123,6 +133,7 @@ class BaseModel(pl.LightningModule):
 
     def predict_step(self, batch, batch_idx):
         x, y = batch
+        x = self.prepare_input(x)
         y_hat = self.forward(x)
         # predicting
         y_hat_sig = F.sigmoid(y_hat)#.detach().cpu() # todo?
@@ -131,40 +142,24 @@ class BaseModel(pl.LightningModule):
         y_hat_sig = y_hat_sig.int()
         y_target = y.int()
         
+        # Images and masks are only copied to the host when they are written
+        if batch_idx != 0 and not self.out:
+            return y_hat_sig
+
+        folder_path = f"{self.args.log_path}/{self.args.experiment_name}/{self.args.model_name}_fold{self.fold}"
+        images = [render.to_uint8_image(image) for image in x]
+        masks = [render.to_uint8_image(mask.reshape(mask.shape[-2:]).cpu().numpy().astype(np.uint8) * 255) for mask in y_hat_sig]
+
         if batch_idx == 0:
-        
-            batch_size = len(x)
-
-            for k in range(batch_size):
-                plt.subplot(3, batch_size, k+1)
-                plt.imshow(np.rollaxis(x[k].detach().cpu().numpy(), 0, 3), cmap='gray')
-                plt.title('Real')
-                plt.axis('off')
-
-                plt.subplot(3, batch_size, k+1+batch_size)
-                plt.imshow(y_hat_sig[k, 0].detach().cpu().numpy(), cmap='gray')
-                plt.title('Output')
-                plt.axis('off')
-				
-                plt.subplot(3, batch_size, k+1+2*batch_size)                
-                plt.imshow(y_target[k, 0].detach().cpu().numpy().transpose(1,2,0), cmap='gray')
-                plt.title('Label')
-                plt.axis('off')
-
-            plt.savefig(f"{self.args.log_path}/{self.args.experiment_name}/{self.args.model_name}_fold{self.fold}/prediction.png")
+            # Rows of real images, outputs and labels
+            labels = [render.to_uint8_image(label.reshape(label.shape[-2:]).cpu().numpy().astype(np.uint8) * 255) for label in y_target]
+            grid = [render.add_caption(image, title) for row, title in [(images, 'Real'), (masks, 'Output'), (labels, 'Label')] for image in row]
+            get_writer().save_image(f"{folder_path}/prediction.png", render.mosaic(grid, ncols=len(x)))
 
-        
         if self.out:
             for k in range(len(x)):
-                fig = plt.figure()
-                plt.imshow(y_hat_sig[k, 0].detach().cpu().numpy(), cmap='gray')
-                plt.savefig(f"{self.args.log_path}/{self.args.experiment_name}/{self.args.model_name}_fold{self.fold}/prediction_mask{k+self.offset}.png")
-                plt.close(fig)
-
-                fig = plt.figure()
-                plt.imshow(np.rollaxis(x[k].detach().cpu().numpy(), 0, 3), cmap='gray')
-                plt.savefig(f"{self.args.log_path}/{self.args.experiment_name}/{self.args.model_name}_fold{self.fold}/prediction_img{k+self.offset}.png", bbox_inches='tight')
-                plt.close(fig)
+                get_writer().save_image(f"{folder_path}/prediction_mask{k+self.offset}.png", masks[k])
+                get_writer().save_image(f"{folder_path}/prediction_img{k+self.offset}.png", images[k])
             self.offset += len(x)
 
         return y_hat_sig  
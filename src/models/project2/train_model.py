@@ -5,14 +5,15 @@ import pytorch_lightning as pl
 from pytorch_lightning.loggers import TensorBoardLogger
 
 import sys
-import json
+import io
 import os
 #sys.path.append('../../')
 
-from src.utils import set_seed, get_optimizer
+from src.utils import set_seed, get_optimizer, apply_loader_profile
 from src.models.project2.models import get_model
 from src.models.project2.losses import get_loss
 from src.data.project2.dataloader import get_loaders#, get_normalization_constants
+from src.visualization.writer import get_writer
 
 
 class BooleanListAction(argparse.Action):
@@ -53,6 +54,14 @@ def parse_arguments():
                         help="Batch size.")
     parser.add_argument("--num_workers", type=int, default=1,
                         help="Number of workers in the dataloader.")
+    parser.add_argument("--pin_memory", type=bool, default=False,
+                        help="Collate batches into pinned memory for faster host to device copies.")
+    parser.add_argument("--persistent_workers", type=bool, default=False,
+                        help="Keep the dataloader workers alive between epochs.")
+    parser.add_argument("--prefetch_factor", type=int, default=None,
+                        help="Number of batches prefetched per worker (DataLoader default if not given).")
+    parser.add_argument("--loader_profile", type=str, default=None,
+                        help="Profile from src/data/benchmark_loaders.py - overrides the dataloader worker settings.")
     parser.add_argument("--epochs", type=int, default=100,
                         help="Number of epochs for training the model.")
     parser.add_argument("--lr", type=float, default=1e-04,
@@ -93,6 +102,10 @@ def train(args):
     # Set random seed
     set_seed(args.seed)
 
+    # Dataloader worker settings tuned for this machine
+    if args.loader_profile is not None:
+        apply_loader_profile(args, args.loader_profile)
+
     # Get functions
     loss_fun = get_loss(args.loss, args.reg, args.reg_coef)
     optimizer = get_optimizer(args.optimizer)
@@ -108,7 +121,10 @@ def train(args):
         batch_size=args.batch_size, 
         seed=args.seed, 
         num_workers=args.num_workers,
-        augmentations={'rotate': args.augmentation[0], 'flip': args.augmentation[1]}
+        augmentations={'rotate': args.augmentation[0], 'flip': args.augmentation[1]},
+        pin_memory=args.pin_memory,
+        persistent_workers=args.persistent_workers,
+        prefetch_factor=args.prefetch_factor,
     )
 
 
@@ -158,16 +174,20 @@ def train(args):
         for key in returns[0][0].keys()
     }
 
-    if not os.path.exists(f"{args.log_path}/{args.experiment_name}/{args.model_name}"):
-        os.makedirs(f"{args.log_path}/{args.experiment_name}/{args.model_name}")
-    with open(f"{args.log_path}/{args.experiment_name}/{args.model_name}_fold{fold}/test_dict.txt", "w+") as fp:
-        json.dump(test_dict, fp)  # encode dict into JSON
+    # Written in the background together with the prediction images
+    writer = get_writer()
+    writer.write_json(f"{args.log_path}/{args.experiment_name}/{args.model_name}_fold{fold}/test_dict.txt", test_dict)
 
     # saving sweep plot if activated
     if args.initial_lr_steps != -1:
         fig = trainer.model.lr_finder.optimal_lr.plot(suggest=True, show=False);
-        plt.savefig(f"{args.save_path}/{args.experiment_name}/lr_sweep.png")
+        buffer = io.BytesIO()
+        plt.savefig(buffer, format='png')
         plt.close(fig)
+        writer.write_bytes(f"{args.save_path}/{args.experiment_name}/lr_sweep.png", buffer.getvalue())
+
+    writer.flush()
+    print(f"Artifacts written: {writer.stats()}")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,99 @@
+import argparse
+import time
+
+import torch
+from torchvision.ops import box_iou
+
+from src.utils import match_boxes, match_boxes_batched
+
+# python src/models/project4/benchmark_compare_boxes.py --num_proposals 500 2000 5000
+
+def compare_boxes_loop(bboxes, cat_ids, pred_bboxes, num_classes, iou_threshold=0.5):
+    # Previous implementation of BaseModel.compare_boxes, kept as reference
+    num_gt_boxes, num_pred_boxes    = bboxes.shape[0], pred_bboxes.shape[0]
+    gt_matches                      = torch.zeros(num_gt_boxes, dtype=torch.bool)
+    pred_matches                    = torch.zeros(num_pred_boxes, dtype=torch.bool)
+    pred_gt_bboxes                  = -torch.ones(num_pred_boxes, dtype=torch.long)
+    pred_labels                     = (num_classes - 1) * torch.ones(num_pred_boxes, dtype=torch.long)
+    iou                             = box_iou(bboxes, pred_bboxes)
+
+    for pred_idx in range(num_pred_boxes):
+        iou_score = iou[:, pred_idx]
+        max_iou = torch.max(iou_score)
+        if max_iou >= iou_threshold:
+            gt_idx = torch.argmax(iou_score)
+            gt_matches[gt_idx] = True
+            pred_matches[pred_idx] = True
+            pred_gt_bboxes[pred_idx]    = gt_idx
+            pred_labels[pred_idx]       = cat_ids[gt_idx][0]
+
+    return pred_matches, gt_matches, pred_labels, pred_gt_bboxes
+
+def random_boxes(n, img_size=512, min_size=20):
+    xy = torch.randint(0, img_size - min_size, (n, 2))
+    wh = torch.randint(min_size, img_size, (n, 2))
+    return torch.cat([xy, torch.clamp(xy + wh, max=img_size)], dim=1).to(torch.float)
+
+def timeit(fun, repeats):
+    # Best of repeats, in milliseconds
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fun()
+        times.append(time.perf_counter() - start)
+    return 1000 * min(times)
+
+def parse_arguments():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--num_proposals", nargs='+', type=int, default=[500, 2000, 5000],
+                        help="Numbers of proposals per image to benchmark.")
+    parser.add_argument("--num_gt", type=int, default=8,
+                        help="Number of ground truth boxes per image.")
+    parser.add_argument("--batch_size", type=int, default=8,
+                        help="Number of images matched at once in the batched version.")
+    parser.add_argument("--num_classes", type=int, default=29,
+                        help="Number of classes including background.")
+    parser.add_argument("--repeats", type=int, default=5,
+                        help="Number of repetitions, the best time is reported.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Pseudo-randomness.")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    # Get input arguments
+    args = parse_arguments()
+    torch.manual_seed(args.seed)
+
+    print(f"{'proposals':>10} {'loop [ms]':>12} {'vectorized [ms]':>16} {'speedup':>8} {'batched/img [ms]':>17} {'speedup':>8}")
+    for num_proposals in args.num_proposals:
+        images = [(
+            random_boxes(args.num_gt),
+            torch.randint(0, args.num_classes - 1, (args.num_gt, 1)),
+            random_boxes(num_proposals),
+        ) for _ in range(args.batch_size)]
+
+        # Check that both implementations agree
+        for bboxes, cat_ids, pred_bboxes in images:
+            for expected, result in zip(
+                compare_boxes_loop(bboxes, cat_ids, pred_bboxes, args.num_classes),
+                match_boxes(bboxes, cat_ids, pred_bboxes, args.num_classes),
+            ):
+                assert torch.equal(expected, result)
+
+        # Padded batch of all images
+        bboxes = torch.stack([bboxes for bboxes, _, _ in images])
+        cat_ids = torch.stack([cat_ids.flatten() for _, cat_ids, _ in images])
+        pred_bboxes = torch.stack([pred_bboxes for _, _, pred_bboxes in images])
+        gt_mask = torch.ones(bboxes.shape[:2], dtype=torch.bool)
+        pred_mask = torch.ones(pred_bboxes.shape[:2], dtype=torch.bool)
+
+        loop = timeit(lambda: [compare_boxes_loop(*image, args.num_classes) for image in images], args.repeats) / args.batch_size
+        vectorized = timeit(lambda: [match_boxes(*image, args.num_classes) for image in images], args.repeats) / args.batch_size
+        batched = timeit(lambda: match_boxes_batched(bboxes, cat_ids, gt_mask, pred_bboxes, pred_mask, args.num_classes), args.repeats) / args.batch_size
+
+        print(f"{num_proposals:>10} {loop:>12.3f} {vectorized:>16.3f} {loop / vectorized:>7.1f}x {batched:>17.3f} {loop / batched:>7.1f}x")
@@ -0,0 +1,257 @@
+import argparse
+import json
+import time
+
+import numpy as np
+
+# COCO evaluation grid
+IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+RECALL_THRESHOLDS = np.linspace(0, 1, 101)
+
+
+def save_predictions(path, batches, background, id2cat=None):
+    '''
+    Saves the classified proposals of a split as one .npz file of flat columns with per-image
+    offsets. Every proposal keeps its box and most likely class and probability, which is all
+    the NMS needs, so the detections can be re-computed without the model. batches is a list
+    of dicts with boxes, scores, labels, offsets, gt_boxes, gt_labels and gt_offsets as arrays.
+    '''
+    def concat_offsets(key):
+        # Per-batch offsets -> offsets into the concatenated columns
+        counts = np.concatenate([np.diff(batch[key]) for batch in batches])
+        return np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    np.savez(
+        path,
+        boxes       = np.concatenate([batch['boxes'] for batch in batches]).astype(np.float32),
+        scores      = np.concatenate([batch['scores'] for batch in batches]).astype(np.float32),
+        labels      = np.concatenate([batch['labels'] for batch in batches]).astype(np.int16),
+        offsets     = concat_offsets('offsets'),
+        gt_boxes    = np.concatenate([batch['gt_boxes'] for batch in batches]).astype(np.float32),
+        gt_labels   = np.concatenate([batch['gt_labels'] for batch in batches]).astype(np.int16),
+        gt_offsets  = concat_offsets('gt_offsets'),
+        background  = np.array(background),
+        id2cat      = np.array(json.dumps(id2cat)),
+    )
+
+def load_predictions(path):
+    with np.load(path) as f:
+        predictions = {key: f[key] for key in f.files}
+    predictions['background'] = int(predictions['background'])
+    predictions['id2cat'] = json.loads(str(predictions['id2cat']))
+    return predictions
+
+
+def pairwise_iou(boxes1, boxes2):
+    # (N, 4) x (M, 4) (x1, y1, x2, y2) -> (N, M)
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    top_left = np.maximum(boxes1[:, None, :2], boxes2[None, :, :2])
+    bottom_right = np.minimum(boxes1[:, None, 2:], boxes2[None, :, 2:])
+    intersection = np.clip(bottom_right - top_left, 0, None).prod(2)
+    return intersection / np.maximum(area1[:, None] + area2[None, :] - intersection, 1e-12)
+
+def class_nms(boxes, labels, iou_thresholds):
+    '''
+    Greedy NMS of the score-sorted boxes of one image, boxes of different classes never suppress
+    each other. iou_thresholds holds the threshold of every box. Returns a keep mask.
+    '''
+    iou = pairwise_iou(boxes, boxes)
+    suppresses = (iou > iou_thresholds[:, None]) & (labels[:, None] == labels[None, :])
+    suppressed = np.zeros(len(boxes), dtype=bool)
+    for i in range(len(boxes)):
+        if not suppressed[i]:
+            suppressed[i+1:] |= suppresses[i, i+1:]
+    return ~suppressed
+
+def detect(predictions, iou_threshold=0.5, score_threshold=0.0, pre_nms_top_k=-1, max_detections=100):
+    '''
+    NumPy version of src.utils.batched_class_nms on saved predictions. iou_threshold and
+    score_threshold are floats or arrays with a threshold per class. Returns the kept proposal indices of every image,
+    ordered by decreasing score.
+    '''
+    scores, labels = predictions['scores'], predictions['labels']
+    offsets = predictions['offsets']
+    iou_threshold = np.asarray(iou_threshold, dtype=np.float64)
+    if iou_threshold.ndim == 0:
+        iou_threshold = np.full(labels.max(initial=0) + 1, iou_threshold)
+    score_threshold = np.asarray(score_threshold, dtype=np.float32)
+    if score_threshold.ndim > 0:
+        score_threshold = score_threshold[labels]
+
+    # Background and low scoring proposals never become detections
+    candidates = (labels != predictions['background']) & (scores >= score_threshold)
+
+    keep = []
+    for i in range(len(offsets) - 1):
+        idx = offsets[i] + np.flatnonzero(candidates[offsets[i]:offsets[i+1]])
+        idx = idx[np.argsort(-scores[idx], kind='stable')]
+        if pre_nms_top_k > 0:
+            idx = idx[:pre_nms_top_k]
+        idx = idx[class_nms(predictions['boxes'][idx], labels[idx], iou_threshold[labels[idx]])]
+        keep.append(idx[:max_detections] if max_detections > 0 else idx)
+    return keep
+
+
+def match_detections(det_boxes, gt_boxes):
+    '''
+    COCO matching of the score-sorted detections of one image and class to its ground truth,
+    for all IoU thresholds at once. Returns a (T, D) true positive mask.
+    '''
+    matched_det = np.zeros((len(IOU_THRESHOLDS), len(det_boxes)), dtype=bool)
+    if len(gt_boxes) == 0:
+        return matched_det
+    iou = pairwise_iou(det_boxes, gt_boxes)
+    matched_gt = np.zeros((len(IOU_THRESHOLDS), len(gt_boxes)), dtype=bool)
+    rows = np.arange(len(IOU_THRESHOLDS))
+    for d in range(len(det_boxes)):
+        # Best still unmatched ground truth per threshold
+        candidates = np.where(matched_gt, -1, iou[d][None, :])
+        best = candidates.argmax(1)
+        found = candidates[rows, best] >= IOU_THRESHOLDS
+        matched_det[found, d] = True
+        matched_gt[rows[found], best[found]] = True
+    return matched_det
+
+def average_precision(scores, true_positives, num_gt):
+    # COCO 101-point interpolated AP for all IoU thresholds, (D,) scores and (T, D) matches
+    order = np.argsort(-scores, kind='mergesort')
+    tp = np.cumsum(true_positives[:, order], axis=1)
+    fp = np.cumsum(~true_positives[:, order], axis=1)
+    recall = tp / num_gt
+    precision = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+    # Precision envelope, non-increasing in recall
+    precision = np.maximum.accumulate(precision[:, ::-1], axis=1)[:, ::-1]
+
+    ap = np.zeros(len(IOU_THRESHOLDS))
+    for t in range(len(IOU_THRESHOLDS)):
+        idx = np.searchsorted(recall[t], RECALL_THRESHOLDS, side='left')
+        ap[t] = np.where(idx < len(scores), precision[t][np.minimum(idx, len(scores) - 1)], 0).mean() if len(scores) > 0 else 0
+    return ap
+
+def evaluate(predictions, keep, recall_ious=(0.5, 0.75)):
+    '''
+    COCO mAP over the classes present in the ground truth, recall of the ground truth boxes
+    at recall_ious and their mean best IoU with any detection (class agnostic, as in the
+    validation metrics).
+    '''
+    gt_offsets = predictions['gt_offsets']
+    boxes, scores, labels = predictions['boxes'], predictions['scores'], predictions['labels']
+    gt_boxes, gt_labels = predictions['gt_boxes'], predictions['gt_labels']
+
+    classes = np.unique(gt_labels)
+    class_scores = {c: [] for c in classes}
+    class_matches = {c: [] for c in classes}
+    best_ious = []
+
+    for i, idx in enumerate(keep):
+        gt_rows = slice(gt_offsets[i], gt_offsets[i+1])
+        image_gt_boxes, image_gt_labels = gt_boxes[gt_rows], gt_labels[gt_rows]
+
+        if len(image_gt_boxes) > 0:
+            best_ious.append(pairwise_iou(image_gt_boxes, boxes[idx]).max(1) if len(idx) > 0 else np.zeros(len(image_gt_boxes)))
+
+        for c in np.unique(labels[idx]):
+            if c not in class_scores:
+                # False positives of classes without ground truth do not enter the mAP
+                continue
+            det = idx[labels[idx] == c]
+            class_scores[c].append(scores[det])
+            class_matches[c].append(match_detections(boxes[det], image_gt_boxes[image_gt_labels == c]))
+
+    ap = np.stack([
+        average_precision(
+            np.concatenate(class_scores[c]) if len(class_scores[c]) > 0 else np.zeros(0),
+            np.concatenate(class_matches[c], axis=1) if len(class_matches[c]) > 0 else np.zeros((len(IOU_THRESHOLDS), 0), dtype=bool),
+            (gt_labels == c).sum(),
+        )
+        for c in classes
+    ]) if len(classes) > 0 else np.zeros((0, len(IOU_THRESHOLDS)))
+
+    best_ious = np.concatenate(best_ious) if len(best_ious) > 0 else np.zeros(0)
+    return {
+        'map':          float(ap.mean()) if len(ap) > 0 else 0.0,
+        'map_50':       float(ap[:, 0].mean()) if len(ap) > 0 else 0.0,
+        'map_75':       float(ap[:, 5].mean()) if len(ap) > 0 else 0.0,
+        'map_per_class': {int(c): float(ap[k].mean()) for k, c in enumerate(classes)},
+        'recall':       {iou: float((best_ious >= iou).mean()) if len(best_ious) > 0 else 0.0 for iou in recall_ious},
+        'IoU':          float(best_ious.mean()) if len(best_ious) > 0 else 0.0,
+        'detections_per_image': float(np.mean([len(idx) for idx in keep])) if len(keep) > 0 else 0.0,
+    }
+
+
+def get_class_thresholds(threshold, class_thresholds, num_classes):
+    # JSON dictionary of label -> threshold as given to --class_iou_thresholds and --class_score_thresholds, other classes use threshold
+    if class_thresholds is None:
+        return threshold
+    thresholds = np.full(num_classes, threshold, dtype=np.float64)
+    for label, class_threshold in json.loads(class_thresholds).items():
+        thresholds[int(label)] = class_threshold
+    return thresholds
+
+def add_nms_arguments(parser):
+    # NMS options shared by train_model.py, predict_model.py, inference.py and this script
+    parser.add_argument("--pre_nms_top_k", type=int, default=-1,
+                        help="Number of highest scoring detections per image entering the NMS, all if -1.")
+    parser.add_argument("--max_detections", type=int, default=100,
+                        help="Maximum number of detections per image after the NMS.")
+    parser.add_argument("--class_iou_thresholds", type=str, default=None,
+                        help="JSON dictionary of label -> NMS IoU threshold, e.g. '{\"3\": 0.3}'. Other classes use --iou_threshold (0.5 if not an option).")
+    parser.add_argument("--class_score_thresholds", type=str, default=None,
+                        help="JSON dictionary of label -> score threshold, e.g. '{\"3\": 0.6}'. Other classes use --score_threshold.")
+    return parser
+
+
+def parse_arguments():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--predictions", type=str, required=True,
+                        help="Predictions saved with --save_predictions in train_model.py or predict_model.py.")
+    parser.add_argument("--iou_threshold", nargs='+', type=float, default=[0.5],
+                        help="IoU thresholds of the NMS - all combinations with --score_threshold are evaluated.")
+    parser.add_argument("--score_threshold", nargs='+', type=float, default=[0.0],
+                        help="Detections with a lower score are dropped before the NMS.")
+    add_nms_arguments(parser)
+    parser.add_argument("--recall_iou", nargs='+', type=float, default=[0.5, 0.75],
+                        help="IoUs at which a ground truth box counts as found for the recall.")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Optionally write all results as json.")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    # Get input arguments
+    args = parse_arguments()
+
+    predictions = load_predictions(args.predictions)
+    num_classes = max(int(predictions['labels'].max(initial=0)), int(predictions['gt_labels'].max(initial=0)), predictions['background']) + 1
+    print(f"Loaded {len(predictions['offsets']) - 1} images, {len(predictions['scores'])} proposals and {len(predictions['gt_labels'])} ground truth boxes")
+
+    results = []
+    print(f"{'NMS IoU':>8} {'score':>6} {'det/img':>8} {'mAP':>7} {'mAP50':>7} {'mAP75':>7} " + ' '.join(f"{f'R@{iou}':>7}" for iou in args.recall_iou) + f" {'IoU':>7} {'time [s]':>9}")
+    for iou_threshold in args.iou_threshold:
+        for score_threshold in args.score_threshold:
+            start = time.perf_counter()
+            keep = detect(
+                predictions,
+                iou_threshold=get_class_thresholds(iou_threshold, args.class_iou_thresholds, num_classes),
+                score_threshold=get_class_thresholds(score_threshold, args.class_score_thresholds, num_classes),
+                pre_nms_top_k=args.pre_nms_top_k, max_detections=args.max_detections,
+            )
+            result = evaluate(predictions, keep, recall_ious=args.recall_iou)
+            elapsed = time.perf_counter() - start
+
+            print(
+                f"{iou_threshold:>8.2f} {score_threshold:>6.2f} {result['detections_per_image']:>8.1f} "
+                f"{result['map']:>7.4f} {result['map_50']:>7.4f} {result['map_75']:>7.4f} "
+                + ' '.join(f"{result['recall'][iou]:>7.4f}" for iou in args.recall_iou)
+                + f" {result['IoU']:>7.4f} {elapsed:>9.2f}"
+            )
+            results.append({'iou_threshold': iou_threshold, 'score_threshold': score_threshold, **result})
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f)
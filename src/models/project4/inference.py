@@ -0,0 +1,292 @@
+import argparse
+import glob
+import json
+import os
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+
+import albumentations as A
+
+from src.utils import selective_search, batched_class_nms
+from src.models.project4.models import TestNet, EfficientNet, get_nms_kwargs
+from src.models.project4.evaluate import add_nms_arguments
+from src.models.project4.losses import get_loss
+from src.data.project4.dataloader import decode_image
+from src.data.project4.proposal_ranking import ProposalRanker
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.JPG', '.JPEG', '.PNG')
+
+# End of stream marker between the stages
+DONE = None
+
+
+def decode_and_propose(path, img_size=(512, 512), scale=500, sigma=0.9, min_size=10, min_box_size=20, proposal_ranker=None, top_n=-1):
+    '''
+    Decodes an image at reduced resolution, resizes it like the test transform and runs
+    selective search on it. Returns the resized image, (x1, y1, x2, y2) proposals in resized
+    coordinates, the factor back to original coordinates and the time spent.
+    '''
+    start = time.perf_counter()
+    image, draft_scale = decode_image(path, img_size)
+    if image.ndim == 2:
+        image = np.repeat(image[..., None], 3, axis=2)
+    image = image[..., :3]
+    height, width = image.shape[:2]
+    image = A.Resize(img_size[0], img_size[1])(image=image)['image']
+    decoded = time.perf_counter()
+
+    # Run selective search and remove small boxes
+    bboxes = selective_search(torch.from_numpy(image).permute(2, 0, 1), scale=scale, sigma=sigma, min_size=min_size)
+    bboxes = np.array(sorted(bbox for bbox in bboxes if bbox[2] > min_box_size and bbox[3] > min_box_size), dtype=np.int64).reshape(-1, 4)
+    bboxes[:, 2:] += bboxes[:, :2]
+
+    # Keep the top-N proposals of the cheap ranking stage
+    if proposal_ranker is not None:
+        bboxes = bboxes[proposal_ranker.top_n(image, bboxes, top_n)]
+
+    # Resized image coordinates -> original image coordinates
+    to_original = np.array([
+        width / img_size[1] / draft_scale[0], height / img_size[0] / draft_scale[1],
+    ] * 2)
+    return {
+        'file_name':    os.path.basename(path),
+        'image':        image,
+        'boxes':        bboxes,
+        'to_original':  to_original,
+        'latency':      {'decode': decoded - start, 'selective_search': time.perf_counter() - decoded},
+    }
+
+
+def propose_images(paths, pool, out_queue, queue_size, **kwargs):
+    '''
+    Keeps at most queue_size images in flight in the pool, so memory stays bounded. Images that
+    fail to decode or propose are reported and skipped, and DONE is always put so the consumer
+    never waits forever.
+    '''
+    def put_result(path, result):
+        try:
+            out_queue.put(result.get())
+        except Exception as e:
+            print(f'Skipping {path}: {type(e).__name__}: {e}')
+
+    pending = deque()
+    try:
+        for path in paths:
+            pending.append((path, pool.apply_async(decode_and_propose, (path,), kwargs)))
+            if len(pending) >= queue_size:
+                put_result(*pending.popleft())
+        while len(pending) > 0:
+            put_result(*pending.popleft())
+    finally:
+        out_queue.put(DONE)
+
+
+def collate_images(samples):
+    # Same packed layout as collate_batch, without ground truth
+    pred_counts = torch.tensor([0] + [len(sample['boxes']) for sample in samples])
+    return {
+        'images':       torch.stack([torch.from_numpy(sample['image']).permute(2, 0, 1) for sample in samples]),
+        'pred_boxes':   torch.from_numpy(np.concatenate([sample['boxes'] for sample in samples])),
+        'pred_offsets': torch.cumsum(pred_counts, 0),
+        'pred_regions': None,
+    }
+
+
+class InferenceEngine:
+    '''
+    Streams a directory of images through decoding and selective search (process pool),
+    batched classification of the proposals on the device, and NMS. Stages are connected
+    by bounded queues, so decoding and classification overlap without unbounded memory use.
+    '''
+    def __init__(
+            self, model,
+            batch_size=8, num_workers=1, queue_size=32,
+            img_size=(512, 512), nms_kwargs=None,
+            **proposal_kwargs,
+        ):
+        self.model = model
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self.img_size = img_size
+        # Same post-processing as validation and test unless overridden
+        self.nms_kwargs = nms_kwargs if nms_kwargs is not None else model.nms_kwargs
+        self.proposal_kwargs = proposal_kwargs
+        self.latency = defaultdict(list)
+
+    @torch.no_grad()
+    def classify(self, samples):
+        batch = collate_images(samples)
+        batch['images'] = batch['images'].to(self.model.device, non_blocking=True)
+        batch['pred_boxes'] = batch['pred_boxes'].to(self.model.device, non_blocking=True)
+        batch['pred_offsets'] = batch['pred_offsets'].to(self.model.device)
+        image_idx = self.model.segment_ids(batch['pred_offsets'])
+        y_hat = self.model.classify_boxes(batch, batch['pred_boxes'], image_idx)
+        return torch.nn.functional.softmax(y_hat, dim=1).cpu(), batch['pred_offsets'].tolist()
+
+    def postprocess(self, samples, outputs, offsets):
+        # Batched NMS over all images, background is dropped and boxes are returned in original image coordinates
+        boxes = torch.from_numpy(np.concatenate([sample['boxes'] for sample in samples]))
+        image_idx = torch.repeat_interleave(torch.arange(len(samples)), torch.diff(torch.tensor(offsets)))
+        keep, scores, labels = batched_class_nms(boxes, outputs, image_idx, self.model.num_classes - 1, **self.nms_kwargs)
+        det_offsets = torch.searchsorted(image_idx[keep], torch.arange(len(samples) + 1)).tolist()
+
+        detections = []
+        for i, sample in enumerate(samples):
+            rows = keep[det_offsets[i]:det_offsets[i+1]]
+            detections.append({
+                'file_name':    sample['file_name'],
+                'boxes':        (boxes[rows].numpy() * sample['to_original']).round(2).tolist(),
+                'scores':       scores[rows].tolist(),
+                'labels':       labels[rows].tolist(),
+            })
+        return detections
+
+    def run(self, paths):
+        '''
+        Returns the detections of every image in paths, in the order they finished.
+        '''
+        self.latency.clear()
+        proposals = queue.Queue(maxsize=self.queue_size)
+        detections = []
+
+        start = time.perf_counter()
+        with Pool(self.num_workers) as pool:
+            producer = threading.Thread(
+                target=propose_images,
+                args=(paths, pool, proposals, self.queue_size),
+                kwargs=dict(img_size=self.img_size, **self.proposal_kwargs),
+                daemon=True,
+            )
+            producer.start()
+
+            done = False
+            while not done:
+                # Collect a batch of proposed images
+                samples = []
+                while len(samples) < self.batch_size:
+                    sample = proposals.get()
+                    if sample is DONE:
+                        done = True
+                        break
+                    samples.append(sample)
+                    for stage, elapsed in sample.pop('latency').items():
+                        self.latency[stage].append(elapsed)
+                if len(samples) == 0:
+                    break
+
+                tic = time.perf_counter()
+                outputs, offsets = self.classify(samples)
+                toc = time.perf_counter()
+                detections.extend(self.postprocess(samples, outputs, offsets))
+                self.latency['classify'].append((toc - tic) / len(samples))
+                self.latency['nms'].append((time.perf_counter() - toc) / len(samples))
+
+            producer.join()
+
+        self.elapsed = time.perf_counter() - start
+        return detections
+
+    def report(self, num_images):
+        print(f"{'stage':>18} {'mean [ms]':>10} {'p50 [ms]':>10} {'p95 [ms]':>10}")
+        for stage, latencies in self.latency.items():
+            latencies = 1000 * np.array(latencies)
+            print(f"{stage:>18} {latencies.mean():>10.2f} {np.percentile(latencies, 50):>10.2f} {np.percentile(latencies, 95):>10.2f}")
+        print(f"Processed {num_images} images in {self.elapsed:.1f}s ({num_images / max(self.elapsed, 1e-9):.2f} images/sec)")
+
+
+def to_coco(detections, id2cat):
+    # COCO results format, category_id is the label index of the model
+    return [
+        {
+            'file_name':        detection['file_name'],
+            'category_id':      label,
+            'category_name':    id2cat[label] if id2cat is not None else str(label),
+            'bbox':             [x1, y1, x2 - x1, y2 - y1],
+            'score':            score,
+        }
+        for detection in detections
+        for (x1, y1, x2, y2), score, label in zip(detection['boxes'], detection['scores'], detection['labels'])
+    ]
+
+
+def load_model(model_name, model_path, device, forward_chunk_size=-1):
+    model_class = TestNet if model_name == 'testnet' else EfficientNet
+    model = model_class.load_from_checkpoint(model_path, map_location=device, loss_fun=get_loss('CrossEntropy'))
+    model.args.forward_chunk_size = forward_chunk_size
+    return model.eval()
+
+
+def parse_arguments():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--image_dir", type=str, required=True,
+                        help="Directory of images to run detection on.")
+    parser.add_argument("--model_path", type=str, required=True,
+                        help="Checkpoint of a model trained with train_model.py.")
+    parser.add_argument("--model_name", type=str, default='efficientnet_b4',
+                        help="Model name - either 'testnet' or a timm model name.")
+    parser.add_argument("--output", type=str, default='detections.json',
+                        help="File the detections are written to.")
+    parser.add_argument("--format", type=str, default='json',
+                        help="Output format - one of: [json (per image), coco (results list)]")
+    parser.add_argument("--batch_size", type=int, default=8,
+                        help="Number of images classified at once.")
+    parser.add_argument("--forward_chunk_size", type=int, default=-1,
+                        help="Maximum number of regions per forward pass - all regions of a batch at once if -1.")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(),
+                        help="Number of processes decoding images and running selective search.")
+    parser.add_argument("--queue_size", type=int, default=32,
+                        help="Maximum number of proposed images waiting for classification.")
+    parser.add_argument("--img_size", type=int, default=512,
+                        help="Size images are resized to before running selective search.")
+    parser.add_argument("--iou_threshold", type=float, default=0.5,
+                        help="IoU threshold of the NMS.")
+    parser.add_argument("--score_threshold", type=float, default=0.0,
+                        help="Detections with a lower score are dropped before the NMS.")
+    add_nms_arguments(parser)
+    parser.add_argument("--proposal_ranker", type=str, default=None,
+                        help="Proposal ranker weights from src/data/project4/proposal_ranking.py fit - hand-set weights if not given.")
+    parser.add_argument("--top_n", type=int, default=-1,
+                        help="Number of top ranked proposals per image to classify, all if -1.")
+    parser.add_argument("--scale", type=float, default=500,
+                        help="Selective search scale (free parameter, higher means larger clusters).")
+    parser.add_argument("--sigma", type=float, default=0.9,
+                        help="Selective search sigma (width of Gaussian kernel for smoothing).")
+    parser.add_argument("--min_size", type=int, default=10,
+                        help="Selective search min_size (minimum component size).")
+    parser.add_argument("--min_box_size", type=int, default=20,
+                        help="Only keep boxes with width and height larger than this.")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    # Get input arguments
+    args = parse_arguments()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = load_model(args.model_name, args.model_path, device, forward_chunk_size=args.forward_chunk_size)
+
+    paths = sorted(path for path in glob.glob(f'{args.image_dir}/*') if path.endswith(IMAGE_EXTENSIONS))
+    engine = InferenceEngine(
+        model,
+        batch_size=args.batch_size, num_workers=args.num_workers, queue_size=args.queue_size,
+        img_size=(args.img_size, args.img_size), nms_kwargs=get_nms_kwargs(args, model.num_classes, args.iou_threshold),
+        scale=args.scale, sigma=args.sigma, min_size=args.min_size, min_box_size=args.min_box_size,
+        proposal_ranker=ProposalRanker.load(args.proposal_ranker) if args.proposal_ranker is not None else ProposalRanker(),
+        top_n=args.top_n,
+    )
+    detections = engine.run(paths)
+    engine.report(len(paths))
+
+    with open(args.output, 'w') as f:
+        json.dump(to_coco(detections, model.id2cat) if args.format == 'coco' else detections, f)
@@ -7,13 +7,19 @@ import matplotlib.pyplot as plt
 import numpy as np
 import timm
 from torchmetrics.classification import Accuracy
-from torchvision.ops import box_iou, nms
+from torchvision.ops import box_iou, roi_align
+from torch.nn.utils.rnn import pad_sequence
+from torchmetrics import MeanMetric, SumMetric
 from torchmetrics.detection.mean_ap import MeanAveragePrecision
 from collections import Counter
 
-from src.utils import accuracy, IoU, plot_SS, Recall
+from src.utils import accuracy, IoU, plot_SS, Recall, match_boxes, match_boxes_batched, batched_class_nms
+from src.models.project4.evaluate import save_predictions, get_class_thresholds
 
 def get_model(model_name, args, loss_fun, optimizer, out=False, num_classes=2, region_size=(512,512), id2cat=None):
+    # Shared features pool from the whole images, crops made by the dataset would be thrown away
+    if getattr(args, 'shared_features', False) and getattr(args, 'region_mode', 'crop') != 'roi':
+        raise ValueError('--shared_features True requires --region_mode roi')
     if model_name == 'testnet':
         return TestNet(args, loss_fun, optimizer, out=out, num_classes=num_classes, region_size=region_size, id2cat=id2cat)
     elif model_name == 'efficientnet_b4' or 'resnet18':
@@ -21,12 +27,20 @@ def get_model(model_name, args, loss_fun, optimizer, out=False, num_classes=2, r
     else:
         raise ValueError('unknown model name')
 
+def get_nms_kwargs(args, num_classes, iou_threshold=0.5):
+    return {
+        'iou_threshold':    torch.as_tensor(get_class_thresholds(iou_threshold, getattr(args, 'class_iou_thresholds', None), num_classes), dtype=torch.float),
+        'score_threshold':  torch.as_tensor(get_class_thresholds(getattr(args, 'score_threshold', 0.0), getattr(args, 'class_score_thresholds', None), num_classes), dtype=torch.float),
+        'pre_nms_top_k':    getattr(args, 'pre_nms_top_k', -1),
+        'max_detections':   getattr(args, 'max_detections', 100),
+    }
+
 ### BASEMODEL ###
 class BaseModel(pl.LightningModule):
     '''
     Contains all recurring functionality
     '''
-    def __init__(self, args, loss_fun, optimizer, out, num_classes, id2cat):
+    def __init__(self, args, loss_fun, optimizer, out, num_classes, id2cat, region_size=(224, 224)):
         super().__init__()
         self.args = args
         self.lr = self.args.lr
@@ -36,7 +50,14 @@ class BaseModel(pl.LightningModule):
         self.offset = 0
         self.num_classes = num_classes
         self.iou_threshold = .5 # TODO: appropriate???
+        # post-processing shared by validation, test, predict and inference.py
+        self.nms_kwargs = get_nms_kwargs(args, num_classes, self.iou_threshold)
         self.id2cat = id2cat
+        self.region_size = tuple(region_size)
+
+        # metrics accumulated over an epoch
+        self.val_metrics = self.get_metrics()
+        self.test_metrics = self.get_metrics()
         
         # checkpointing and logging
         self.model_checkpoint = ModelCheckpoint(
@@ -50,258 +71,312 @@ class BaseModel(pl.LightningModule):
 
     def configure_optimizers(self):
         return self.optimizer(self.parameters(), lr = self.args.lr)
-        
-    def compare_boxes(self, bboxes, cat_ids, pred_bboxes, num_classes):
-        # initializing
-        num_gt_boxes, num_pred_boxes    = bboxes.shape[0], pred_bboxes.shape[0]
-        gt_matches                      = torch.zeros(num_gt_boxes, dtype=torch.bool)
-        pred_matches                    = torch.zeros(num_pred_boxes, dtype=torch.bool)
-        pred_gt_bboxes                  = -torch.ones(num_pred_boxes, dtype=torch.long)
-
-        # Mark no match as background index (which is num_classes - 1 as defined in data loader)
-        pred_labels  = (num_classes - 1) * torch.ones(num_pred_boxes, dtype=torch.long) 
-        # Get IoU matrix
-        iou         = box_iou(bboxes, pred_bboxes)
-
-        for pred_idx in range(num_pred_boxes):
-            # rows are true, columns are how they compare to each estimates
-            iou_score = iou[:, pred_idx] # get row
-
-            # check if there are any matches between pred_box and gt_bboxes
-            max_iou = torch.max(iou_score)
-            if max_iou >= self.iou_threshold:
-                # Get index of max score
-                gt_idx = torch.argmax(iou_score)
-                # Store matches
-                gt_matches[gt_idx] = True
-                pred_matches[pred_idx] = True
-                # for finding the box later on
-                pred_gt_bboxes[pred_idx]    = gt_idx
-                pred_labels[pred_idx]       = cat_ids[gt_idx][0]
-
-        return pred_matches, gt_matches, pred_labels, pred_gt_bboxes
 
-    def training_step(self, batch, batch_idx):
-        # extract input
-        loss, acc = 0, 0
+    def prepare_regions(self, regions):
+        # Images and regions are loaded as uint8 and scaled on the device
+        if regions.dtype == torch.uint8:
+            regions = regions.to(self.device, dtype=torch.float32).mul_(1 / 255)
+        return regions
+
+    def segment_ids(self, offsets):
+        # Image index of every row of a packed tensor
+        return torch.repeat_interleave(torch.arange(len(offsets) - 1, device=offsets.device), torch.diff(offsets))
+
+    def extract_regions(self, images, boxes, image_idx):
+        # One batched RoIAlign resample over all boxes of all images, replaces cropping and resizing box by box
+        images = self.prepare_regions(images.to(self.device))
+        rois = torch.concat([image_idx[:, None].to(boxes.device), boxes], dim=1).to(images.device, dtype=torch.float32)
+        return roi_align(images, rois, output_size=self.region_size, spatial_scale=1.0, sampling_ratio=-1, aligned=True)
+
+    def classify_boxes(self, batch, boxes, image_idx, regions=None, pre_logits=False):
+        '''
+        Classifies boxes of the packed batch in a single forward pass, optionally in chunks of
+        args.forward_chunk_size regions. Regions are extracted from the images if not given.
+        With pre_logits, the pooled embeddings of the regions are returned instead of logits.
+        '''
+        forward = self.embed if pre_logits else self.forward
+        chunk_size = getattr(self.args, 'forward_chunk_size', -1)
+        chunk_size = chunk_size if chunk_size > 0 else max(len(boxes), 1)
 
-        # for each image
-        for (img, cat_ids, bboxes_data, pred_bboxes_data) in batch:
-            # for each bounding box
-            (bboxes, regions)           = bboxes_data
-            (pred_bboxes, pred_regions) = pred_bboxes_data
+        y_hat = []
+        for start in range(0, len(boxes), chunk_size):
+            rows = slice(start, start + chunk_size)
+            if regions is not None:
+                regions_ = self.prepare_regions(regions[rows])
+            else:
+                regions_ = self.extract_regions(batch['images'], boxes[rows], image_idx[rows])
+            y_hat.append(forward(regions_))
+        return torch.concat(y_hat) if len(y_hat) > 0 else torch.zeros((0, self.num_classes), device=self.device)
+
+    def match_batch(self, batch):
+        # Match the proposals of all images at once by padding the batch
+        gt_counts, pred_counts = torch.diff(batch['gt_offsets']).tolist(), torch.diff(batch['pred_offsets']).tolist()
+        bboxes      = pad_sequence(batch['gt_boxes'].split(gt_counts), batch_first=True)
+        cat_ids     = pad_sequence(batch['gt_labels'].split(gt_counts), batch_first=True)
+        pred_bboxes = pad_sequence(batch['pred_boxes'].split(pred_counts), batch_first=True)
+        gt_mask     = torch.arange(bboxes.shape[1])[None] < torch.tensor(gt_counts)[:, None]
+        pred_mask   = torch.arange(pred_bboxes.shape[1])[None] < torch.tensor(pred_counts)[:, None]
+
+        _, _, pred_labels, pred_gt_bboxes = match_boxes_batched(
+            bboxes, cat_ids, gt_mask, pred_bboxes, pred_mask, self.num_classes, iou_threshold=self.iou_threshold
+        )
+        # Back to packed proposals
+        pred_mask = pred_mask.to(pred_labels.device)
+        return pred_labels[pred_mask], pred_gt_bboxes[pred_mask]
+        
+    def compare_boxes(self, bboxes, cat_ids, pred_bboxes, num_classes):
+        # Vectorized matching of every proposal to its best ground truth box
+        pred_matches, gt_matches, pred_labels, pred_gt_bboxes = match_boxes(bboxes, cat_ids, pred_bboxes, num_classes, iou_threshold=self.iou_threshold)
+        return pred_matches.cpu(), gt_matches.cpu(), pred_labels.cpu(), pred_gt_bboxes.cpu()
+
+    def select_regions(self, batch, sample_background=True):
+        '''
+        Labels the proposals of the batch with their best matching ground truth box and returns the
+        boxes, labels, image indices and regions (None if extracted in the model) of the proposals and
+        ground truth boxes to train on, grouped by image, and the number of rows of every image.
+        Background is downsampled to 3 background regions per foreground or ground truth region.
+        '''
+        num_images = len(batch['images'])
+        background = self.num_classes - 1
+        pred_offsets, gt_offsets = batch['pred_offsets'].tolist(), batch['gt_offsets'].tolist()
+
+        # find corresponding gt box
+        pred_labels, _ = self.match_batch(batch)
+        pred_labels = pred_labels.cpu()
+
+        # Select proposals and ground truth boxes of every image, grouped by image
+        pred_idx, gt_idx, counts = [], [], []
+        for i in range(num_images):
+            pred_start, pred_end = pred_offsets[i], pred_offsets[i+1]
+            gt_start, gt_end = gt_offsets[i], gt_offsets[i+1]
+            labels = pred_labels[pred_start:pred_end]
 
-            # find corresponding gt box
-            pred_matches, gt_matches, pred_labels, _ = self.compare_boxes(bboxes, cat_ids, pred_bboxes, self.num_classes)
-            
             # Downsample background to 25% non-background vs 75% background
-            non_background      = pred_labels != (self.num_classes - 1) 
-            n_non_background    = non_background.sum().item()
-            n_background_sample = (n_non_background + len(regions)) * 3
+            non_background      = torch.nonzero(labels != background).flatten()
+            n_background_sample = (len(non_background) + gt_end - gt_start) * 3 if sample_background else len(labels)
             # Get subset background idxs
-            background_idxs     = np.random.permutation(np.arange(len(pred_labels))[pred_labels == (self.num_classes - 1)])[:n_background_sample]
+            background_idxs     = torch.nonzero(labels == background).flatten()
+            background_idxs     = background_idxs[torch.randperm(len(background_idxs))[:n_background_sample]]
 
-            # Filter data to subset
-            pred_bboxes         = torch.concat([pred_bboxes[non_background], pred_bboxes[background_idxs]])
-            pred_labels         = torch.concat([pred_labels[non_background], pred_labels[background_idxs]])
-            pred_regions        = torch.concat([pred_regions[non_background], pred_regions[background_idxs]])
-            
-            all_regions         = torch.concat([pred_regions, regions])            
-            all_labels          = torch.concat([pred_labels.to(self.device), cat_ids.flatten().to(self.device)])
+            pred_idx.append(pred_start + torch.concat([non_background, background_idxs]))
+            gt_idx.append(torch.arange(gt_start, gt_end))
+            counts.append(len(pred_idx[-1]) + gt_end - gt_start)
 
-            # Classify proposed regions
-            y_hat               = self.forward(all_regions)
-            outputs             = torch.nn.functional.softmax(y_hat, dim=1)
-            pred_prob, pred_cat = torch.max(outputs, 1)
+        # Filter data to subset, proposals and ground truths of image i are in segment i
+        idx         = [torch.concat([pred_idx_, gt_idx_ + len(pred_labels)]) for pred_idx_, gt_idx_ in zip(pred_idx, gt_idx)]
+        idx         = torch.concat(idx)
+        all_boxes   = torch.concat([batch['pred_boxes'], batch['gt_boxes']])[idx]
+        all_labels  = torch.concat([pred_labels, batch['gt_labels'].cpu()])[idx].to(self.device)
+        image_idx   = torch.concat([self.segment_ids(batch['pred_offsets']), self.segment_ids(batch['gt_offsets'])])[idx]
+        all_regions = None
+        if batch['pred_regions'] is not None:
+            all_regions = torch.concat([batch['pred_regions'], batch['gt_regions']])[idx.to(batch['pred_regions'].device)]
 
-            # Encode data and compute loss
-            one_hot_cat_pred    = torch.nn.functional.one_hot(all_labels, num_classes=self.num_classes).to(torch.float)
-            loss               += self.loss_fun(y_hat, one_hot_cat_pred)
+        return all_boxes, all_labels, image_idx, all_regions, counts
 
-            acc                += torch.mean((all_labels.detach().cpu() == pred_cat.detach().cpu()).to(torch.float))
-            # acc                += (y_hat.detach().cpu().argmax(dim=1) == all_labels.detach().cpu()).to(torch.float).mean().item()
-
-        loss /= len(batch)
-        acc /= len(batch)
+    def training_step(self, batch, batch_idx):
+        # Head-only training on cached region embeddings
+        if not isinstance(batch, dict):
+            return self.training_step_cached(batch)
+
+        # extract input - packed by collate_batch
+        num_images = len(batch['images'])
+        all_boxes, all_labels, image_idx, all_regions, counts = self.select_regions(batch)
+
+        # Classify all regions of the batch at once
+        y_hat               = self.classify_boxes(batch, all_boxes, image_idx, all_regions)
+        pred_cat            = y_hat.argmax(dim=1)
+
+        # Encode data and compute loss per image
+        one_hot_cat_pred    = torch.nn.functional.one_hot(all_labels, num_classes=self.num_classes).to(torch.float)
+        loss = torch.stack([
+            self.loss_fun(y_hat_, one_hot_) 
+            for y_hat_, one_hot_ in zip(y_hat.split(counts), one_hot_cat_pred.split(counts))
+        ]).mean()
+        acc = torch.stack([
+            torch.mean((labels_ == pred_cat_).to(torch.float)) 
+            for labels_, pred_cat_ in zip(all_labels.detach().cpu().split(counts), pred_cat.detach().cpu().split(counts))
+        ]).mean()
 
         # Log performance
-        self.log('loss/train_step',  loss, batch_size=len(batch), on_step=True, on_epoch=False, prog_bar=True, logger=True)
-        self.log('loss/train_epoch', loss, batch_size=len(batch), on_step=False, on_epoch=True, prog_bar=True, logger=True)
-        self.log('acc/train_step',  acc, batch_size=len(batch), on_step=True, on_epoch=False, prog_bar=True, logger=True)
-        self.log('acc/train_epoch', acc, batch_size=len(batch), on_step=False, on_epoch=True, prog_bar=True, logger=True)
+        self.log('loss/train_step',  loss, batch_size=num_images, on_step=True, on_epoch=False, prog_bar=True, logger=True)
+        self.log('loss/train_epoch', loss, batch_size=num_images, on_step=False, on_epoch=True, prog_bar=True, logger=True)
+        self.log('acc/train_step',  acc, batch_size=num_images, on_step=True, on_epoch=False, prog_bar=True, logger=True)
+        self.log('acc/train_epoch', acc, batch_size=num_images, on_step=False, on_epoch=True, prog_bar=True, logger=True)
+
+        return loss
 
+    def cached_step(self, batch):
+        # Loss and accuracy of the head on a batch of cached region embeddings and labels
+        z, labels = batch
+        y_hat = self.head(z)
+        one_hot_cat_pred = torch.nn.functional.one_hot(labels, num_classes=self.num_classes).to(torch.float)
+        loss = self.loss_fun(y_hat, one_hot_cat_pred)
+        acc = torch.mean((y_hat.argmax(dim=1) == labels).to(torch.float))
+        return loss, acc, len(labels)
+
+    def training_step_cached(self, batch):
+        loss, acc, num_regions = self.cached_step(batch)
+        self.log('loss/train_step',  loss, batch_size=num_regions, on_step=True, on_epoch=False, prog_bar=True, logger=True)
+        self.log('loss/train_epoch', loss, batch_size=num_regions, on_step=False, on_epoch=True, prog_bar=True, logger=True)
+        self.log('acc/train_step',  acc, batch_size=num_regions, on_step=True, on_epoch=False, prog_bar=True, logger=True)
+        self.log('acc/train_epoch', acc, batch_size=num_regions, on_step=False, on_epoch=True, prog_bar=True, logger=True)
         return loss
+
+    def get_metrics(self):
+        # Split-level detection metrics, updated per image and computed at the end of the epoch
+        return nn.ModuleDict({
+            'mAP':          MeanAveragePrecision(),
+            'acc':          MeanMetric(),   # over all predictions kept by NMS
+            'IoU':          MeanMetric(),   # over all ground truth boxes
+            'recall_TP':    SumMetric(),
+            'recall_P':     SumMetric(),
+        })
+
+    def detect(self, batch, y_hat):
+        '''
+        Batched class-aware NMS over all proposals of the batch. Returns the kept proposal
+        indices (grouped by image), their scores and labels and per-image offsets into them.
+        '''
+        image_idx = self.segment_ids(batch['pred_offsets'])
+        outputs = torch.nn.functional.softmax(y_hat.detach(), dim=1)
+        keep, scores, labels = batched_class_nms(batch['pred_boxes'], outputs, image_idx, self.num_classes - 1, **self.nms_kwargs)
+        offsets = torch.searchsorted(image_idx[keep], torch.arange(len(batch['images']) + 1, device=keep.device))
+        return keep.cpu(), scores[keep].cpu(), labels[keep].cpu(), offsets.tolist()
+
+    def evaluate_batch(self, batch, metrics):
+        '''
+        Classifies all proposals of the batch at once, applies NMS to the whole batch and updates
+        the epoch-level metrics. Returns the loss averaged over the images of the batch.
+        '''
+        num_images = len(batch['images'])
+        pred_offsets, gt_offsets = batch['pred_offsets'].tolist(), batch['gt_offsets'].tolist()
+        loss, preds, targets = 0, [], []
+
+        # find corresponding gt box
+        pred_labels, _ = self.match_batch(batch)
+        pred_labels = pred_labels.cpu()
+
+        # Classify proposed regions and remove redundant boxes
+        y_hat = self.classify_boxes(batch, batch['pred_boxes'], self.segment_ids(batch['pred_offsets']), batch['pred_regions'])
+        keep, scores, labels, det_offsets = self.detect(batch, y_hat)
+        pred_boxes = batch['pred_boxes'].cpu()
+
+        for i in range(num_images):
+            pred_rows   = slice(pred_offsets[i], pred_offsets[i+1])
+            gt_rows     = slice(gt_offsets[i], gt_offsets[i+1])
+            det_rows    = slice(det_offsets[i], det_offsets[i+1])
+            bboxes = batch['gt_boxes'][gt_rows].cpu()
+
+            # Images without proposals add no loss, but their ground truth still counts in the metrics
+            if pred_rows.stop > pred_rows.start:
+                one_hot_cat_pred    = torch.nn.functional.one_hot(pred_labels[pred_rows].to(self.device), num_classes=self.num_classes).to(torch.float)
+                loss               += self.loss_fun(y_hat[pred_rows], one_hot_cat_pred)
+
+            # Detections kept by NMS, empty without proposals
+            keep_indices = keep[det_rows]
+            preds.append({'boxes':  pred_boxes[keep_indices], 
+                          'scores': scores[det_rows], 
+                          'labels': labels[det_rows]})
+            targets.append({'boxes':  bboxes, 
+                            'labels': batch['gt_labels'][gt_rows].cpu()})
+
+            # Label accuracy
+            if len(keep_indices) > 0:
+                metrics['acc'].update((pred_labels[keep_indices] == labels[det_rows]).to(torch.float))
+            
+            # IoU - best IoU of every ground truth with the boxes kept by NMS
+            if len(bboxes) > 0:
+                best_iou = box_iou(bboxes, pred_boxes[keep_indices]).max(dim=1)[0] if len(keep_indices) > 0 else torch.zeros(len(bboxes))
+                metrics['IoU'].update(best_iou)
+
+                # Recall - ground truths found by a kept box
+                metrics['recall_TP'].update((best_iou >= 0.5).sum())
+                metrics['recall_P'].update(len(bboxes))
+
+        # One update for all images of the batch
+        if len(preds) > 0:
+            metrics['mAP'].update(preds, targets)
+
+        return loss / num_images, num_images
+
+    def log_metrics(self, metrics, stage):
+        # Compute and reset the epoch-level metrics
+        self.log(f'mAP/{stage}',    metrics['mAP'].compute()['map'],    prog_bar=True, logger=True)
+        self.log(f'acc/{stage}',    metrics['acc'].compute(),           prog_bar=True, logger=True)
+        self.log(f'IoU/{stage}',    metrics['IoU'].compute(),           prog_bar=True, logger=True)
+        self.log(f'recall/{stage}', metrics['recall_TP'].compute() / metrics['recall_P'].compute().clamp(min=1), prog_bar=True, logger=True)
+        for metric in metrics.values():
+            metric.reset()
     
     def validation_step(self, batch, batch_idx):
-        # extract input
-        loss_val, mAP, acc, IoU, recall = 0, 0, 0, 0, 0
-        y_hat = []
-        # for each image
-        for (img, cat_ids, bboxes_data, pred_bboxes_data) in batch:
-            # for each bounding box
-            (bboxes, regions)           = bboxes_data
-            (pred_bboxes, pred_regions) = pred_bboxes_data
-
-            # find corresponding gt box
-            _, _, pred_labels, pred_gt_bboxes = self.compare_boxes(bboxes, cat_ids, pred_bboxes, self.num_classes)
-
-            # Classify proposed regions
-            try: 
-                y_hat = self.forward(pred_regions)
-                # maximum probabilities
-                outputs             = torch.nn.functional.softmax(y_hat, dim=1)
-                pred_prob, pred_cat = torch.max(outputs, 1)
-
-                one_hot_cat_pred    = torch.nn.functional.one_hot(pred_labels, num_classes=self.num_classes).to(torch.float)
-                loss_val           += self.loss_fun(y_hat, one_hot_cat_pred)
-                print(loss_val)
-
-                # Applying NMS (remove redundant boxes)
-                keep_indices = nms(pred_bboxes.to(torch.float), pred_prob, self.iou_threshold).to('cpu')
-                # Computing AP
-                preds = [{'boxes':  pred_bboxes[keep_indices], 
-                        'scores':   pred_prob[keep_indices], 
-                        'labels':   pred_cat[keep_indices]}]
-                
-                targets = [{'boxes':    bboxes, 
-                            'labels':   cat_ids.flatten()}]
-                
-                # calculate mAP
-                mAP += MeanAveragePrecision()(preds, targets)['map']
-
-                # Label accuracy
-                acc += torch.mean((pred_labels.detach().cpu()[keep_indices]==pred_cat.detach().cpu()[keep_indices]).to(torch.float))
-                
-                # IoU - find pred_bbox with max IoU to ground truths and average
-                iou_with_nms        = box_iou(bboxes, pred_bboxes[keep_indices][pred_gt_bboxes[keep_indices] != -1])
-                iou_without_nms     = box_iou(bboxes, pred_bboxes[pred_gt_bboxes != -1])
-                try:
-                    IoU            += iou_with_nms.max(dim=1)[0].mean()
-                except IndexError:
-                    IoU            += 0
-
-                # Calculate recall of proposed bboxes
-                bboxes_TP           = (iou_with_nms.argmax(dim=0) > 0.5).sum()  # determine if box is correct based on IoU between NMS pred and GT 
-                all_P               = len(bboxes)     
-                # Store recall in list for computing confidence scores                                                  
-                recall             += (bboxes_TP / all_P).detach().cpu()
-
-            except KeyError as e:
-                print(e)
-
-        # Normalize
-        mAP     /= len(batch)
-        acc     /= len(batch)
-        IoU     /= len(batch)
-        recall  /= len(batch)
-        loss_val /= len(batch)
+        if isinstance(batch, dict):
+            loss, num_images = self.evaluate_batch(batch, self.val_metrics)
+        else:
+            # Cached region embeddings, detection metrics need the full model
+            loss, acc, num_images = self.cached_step(batch)
+            self.log('acc/val',     acc,        batch_size=num_images, prog_bar=True, logger=True)
 
         # Log performance
-        self.log('loss/val',        loss_val,   batch_size=len(batch), prog_bar=True, logger=True)
-        self.log('loss_val',        loss_val,   batch_size=len(batch), prog_bar=True, logger=True)
-        self.log('mAP/val',         mAP,    batch_size=len(batch), prog_bar=True, logger=True)
-        self.log('acc/val',         acc,    batch_size=len(batch), prog_bar=True, logger=True)
-        self.log('IoU/val',         IoU,    batch_size=len(batch), prog_bar=True, logger=True)
-        self.log('recall/val',      recall, batch_size=len(batch), prog_bar=True, logger=True)
-        self.log('learning_rate',   self.lr, batch_size=len(batch), prog_bar=True, logger=True)
+        self.log('loss/val',        loss,       batch_size=num_images, prog_bar=True, logger=True)
+        self.log('loss_val',        loss,       batch_size=num_images, prog_bar=True, logger=True)
+        self.log('learning_rate',   self.lr,    batch_size=num_images, prog_bar=True, logger=True)
 
+    def on_validation_epoch_end(self):
+        if self.val_metrics['mAP'].update_called:
+            self.log_metrics(self.val_metrics, 'val')
 
     def test_step(self, batch, batch_idx):
-        # extract input
-        loss, mAP, acc, IoU, recall = 0, 0, 0, 0, 0
-        y_hat = []
-        # for each image
-        for (img, cat_ids, bboxes_data, pred_bboxes_data) in batch:
-            # for each bounding box
-            (bboxes, regions)           = bboxes_data
-            (pred_bboxes, pred_regions) = pred_bboxes_data
-
-            # find corresponding gt box
-            _, _, pred_labels, pred_gt_bboxes = self.compare_boxes(bboxes, cat_ids, pred_bboxes, self.num_classes)
-
-            # Classify proposed regions
-            try: 
-                y_hat = self.forward(pred_regions)
-                # maximum probabilities
-                outputs             = torch.nn.functional.softmax(y_hat, dim=1)
-                pred_prob, pred_cat = torch.max(outputs, 1)
-
-                # Applying NMS (remove redundant boxes)
-                keep_indices = nms(pred_bboxes.to(torch.float), pred_prob, self.iou_threshold).to('cpu')
-                # Computing AP
-                preds = [{'boxes':  pred_bboxes[keep_indices], 
-                        'scores':   pred_prob[keep_indices], 
-                        'labels':   pred_cat[keep_indices]}]
-                
-                targets = [{'boxes':    bboxes, 
-                            'labels':   cat_ids.flatten()}]
-                
-                # calculate mAP
-                # self.mAP.update(preds, targets)
-                # mAP += self.mAP.compute()['map_50']
-                mAP += MeanAveragePrecision()(preds, targets)['map']
-
-                # Label accuracy
-                acc += torch.mean((pred_labels.detach().cpu()[keep_indices]==pred_cat.detach().cpu()[keep_indices]).to(torch.float))
-                
-                # IoU - find pred_bbox with max IoU to ground truths and average
-                iou_with_nms        = box_iou(bboxes, pred_bboxes[keep_indices][pred_gt_bboxes[keep_indices] != -1])
-                iou_without_nms     = box_iou(bboxes, pred_bboxes[pred_gt_bboxes != -1])
-                IoU                += iou_with_nms.max(dim=1)[0].mean()
-
-                # Calculate recall of proposed bboxes
-                bboxes_TP           = (iou_with_nms.argmax(dim=0) > 0.5).sum()  # determine if box is correct based on IoU between NMS pred and GT 
-                all_P               = len(bboxes)     
-                # Store recall in list for computing confidence scores                         
-                recall             += (bboxes_TP / all_P).detach().cpu()
-
-            except: 
-                pass 
-                # print("Error found!!!")
-
-        # Normalize
-        mAP     /= len(batch)
-        acc     /= len(batch)
-        IoU     /= len(batch)
-        recall  /= len(batch)
+        self.evaluate_batch(batch, self.test_metrics)
 
-        # Log performance
-        self.log('mAP/test',    mAP, batch_size=len(batch), prog_bar=True, logger=True)
-        self.log('acc/test',    acc, batch_size=len(batch), prog_bar=True, logger=True)
-        self.log('IoU/test',    IoU, batch_size=len(batch), prog_bar=True, logger=True)
-        self.log('recall/test', recall, batch_size=len(batch), prog_bar=True, logger=True)
+    def on_test_epoch_end(self):
+        if self.test_metrics['mAP'].update_called:
+            self.log_metrics(self.test_metrics, 'test')
 
-    def predict_step(self, batch, batch_idx):
-
-        # for each image
-        for i, (img, cat_ids, bboxes_data, pred_bboxes_data) in enumerate(batch):
-            # for each bounding box
-            (bboxes, regions)           = bboxes_data # - not available at this point
-            (pred_bboxes, pred_regions) = pred_bboxes_data
+    def on_predict_epoch_start(self):
+        # Classified proposals of the split are kept for offline evaluation with evaluate.py
+        self.predictions = [] if getattr(self.args, 'save_predictions', None) is not None else None
 
-            # Classify proposed regions
-            y_hat = self.forward(pred_regions)
+    def on_predict_epoch_end(self):
+        if self.predictions:
+            save_predictions(self.args.save_predictions, self.predictions, self.num_classes - 1, self.id2cat)
+        self.predictions = None
 
-            # maximum probabilities
-            outputs = torch.nn.functional.softmax(y_hat, dim=1)
-            pred_prob, pred_cat = torch.max(outputs, 1)
-
-            print("pred_cat:", pred_cat)
+    def predict_step(self, batch, batch_idx):
+        gt_offsets = batch['gt_offsets'].tolist()
+
+        # Classify proposed regions of all images at once and remove redundant and background boxes
+        y_hat = self.classify_boxes(batch, batch['pred_boxes'], self.segment_ids(batch['pred_offsets']), batch['pred_regions'])
+        keep, scores, labels, det_offsets = self.detect(batch, y_hat)
+        pred_boxes = batch['pred_boxes'].cpu()
+
+        if getattr(self, 'predictions', None) is not None:
+            proposal_scores, proposal_labels = torch.nn.functional.softmax(y_hat.detach(), dim=1).max(dim=1)
+            self.predictions.append({
+                'boxes':        pred_boxes.numpy(),
+                'scores':       proposal_scores.cpu().numpy(),
+                'labels':       proposal_labels.cpu().numpy(),
+                'offsets':      batch['pred_offsets'].cpu().numpy(),
+                'gt_boxes':     batch['gt_boxes'].cpu().numpy(),
+                'gt_labels':    batch['gt_labels'].cpu().numpy(),
+                'gt_offsets':   batch['gt_offsets'].cpu().numpy(),
+            })
 
-            # Applying NMS (remove redundant boxes)
-            keep_indices = nms(pred_bboxes.to(torch.float), pred_prob, 0.5)
+        # for each image
+        for i in range(len(batch['images'])):
+            gt_rows     = slice(gt_offsets[i], gt_offsets[i+1])
+            det_rows    = slice(det_offsets[i], det_offsets[i+1])
 
-            # Computing AP
-            preds = {'boxes': pred_bboxes[keep_indices][pred_cat[keep_indices] != max(self.id2cat.keys())], 
-                    'scores': pred_prob[keep_indices][pred_cat[keep_indices] != max(self.id2cat.keys())], 
-                    'labels': pred_cat[keep_indices][pred_cat[keep_indices] != max(self.id2cat.keys())]} 
+            preds = {'boxes': pred_boxes[keep[det_rows]], 
+                    'scores': scores[det_rows], 
+                    'labels': labels[det_rows]} 
             
             targets = {
-                'boxes':  bboxes, 
-                'labels': cat_ids.flatten()
+                'boxes':  batch['gt_boxes'][gt_rows], 
+                'labels': batch['gt_labels'][gt_rows]
             }
 
-            plot_SS(img, targets['boxes'], targets['labels'], preds['boxes'], preds['labels'], preds['scores'], i, batch_idx, self.id2cat)
+            plot_SS(batch['images'][i], targets['boxes'], targets['labels'], preds['boxes'], preds['labels'], preds['scores'], i, batch_idx, self.id2cat)
 
 
         
@@ -309,7 +384,7 @@ class BaseModel(pl.LightningModule):
 
 class TestNet(BaseModel):
     def __init__(self, args, loss_fun, optimizer, out, num_classes, region_size, id2cat):
-        super().__init__(args, loss_fun, optimizer, out, num_classes, id2cat)
+        super().__init__(args, loss_fun, optimizer, out, num_classes, id2cat, region_size=region_size)
         h, w = region_size
         self.fc1 = nn.Linear(h*w*3, 128)  # 5*5 from image dimension
         self.fc2 = nn.Linear(128, 64)
@@ -317,24 +392,42 @@ class TestNet(BaseModel):
         self.relu = nn.ReLU()
         #self.softmax = nn.Softmax()
 
+    def freeze_parameters(self, percentage_to_freeze):
+        # Freeze everything but the last layer
+        for param in self.parameters():
+            param.requires_grad = False
+        self.fc3.requires_grad_()
+
     def forward(self, x):
+        x = self.embed(x)
+        x = self.head(x)
+        #x = self.softmax(x)
+        return x
+
+    def embed(self, x):
+        # Hidden features, input of the last layer
         x = x.view(x.size(0), -1)
         x = self.fc1(x)
         x = self.relu(x)
         x = self.fc2(x)
         x = self.relu(x)
-        x = self.fc3(x)
-        #x = self.softmax(x)
         return x
 
+    def head(self, z):
+        return self.fc3(z)
+
 
 class EfficientNet(BaseModel):
     def __init__(self, args, loss_fun, optimizer, out, num_classes, region_size, id2cat):
-        super().__init__(args, loss_fun, optimizer, out, num_classes, id2cat)
+        super().__init__(args, loss_fun, optimizer, out, num_classes, id2cat, region_size=region_size)
 
         # Load model
         self.network = timm.create_model(args.model_name, pretrained=True, num_classes=self.num_classes)
 
+        # Run the backbone once per image and pool proposal features from the shared feature map (Fast R-CNN)
+        self.shared_features = getattr(args, 'shared_features', False)
+        self.roi_output_size = getattr(args, 'roi_output_size', 7)
+
         # Freeze parameters
         # self.freeze_parameters(args.percentage_to_freeze)
 
@@ -345,7 +438,38 @@ class EfficientNet(BaseModel):
             param.requires_grad = False
         
         # Require gradient for classification layer
-        self.network.classifier.requires_grad_()
+        self.network.get_classifier().requires_grad_()
 
     def forward(self, x):
-        return self.network(x)
\ No newline at end of file
+        return self.network(x)
+
+    def embed(self, x):
+        # Pooled backbone features, input of the classifier
+        return self.network.forward_head(self.network.forward_features(x), pre_logits=True)
+
+    def head(self, z):
+        return self.network.get_classifier()(z)
+
+    def classify_boxes(self, batch, boxes, image_idx, regions=None, pre_logits=False):
+        '''
+        In shared feature mode, the backbone runs once on every whole image and the
+        classification head runs on RoIAlign-pooled features of the boxes, so the cost of
+        the backbone does not depend on the number of proposals. Regions are not used.
+        '''
+        if not self.shared_features:
+            return super().classify_boxes(batch, boxes, image_idx, regions, pre_logits=pre_logits)
+
+        images = self.prepare_regions(batch['images'].to(self.device))
+        features = self.network.forward_features(images)
+        spatial_scale = features.shape[-1] / images.shape[-1]
+
+        chunk_size = getattr(self.args, 'forward_chunk_size', -1)
+        chunk_size = chunk_size if chunk_size > 0 else max(len(boxes), 1)
+
+        y_hat = []
+        for start in range(0, len(boxes), chunk_size):
+            rows = slice(start, start + chunk_size)
+            rois = torch.concat([image_idx[rows][:, None].to(boxes.device), boxes[rows]], dim=1).to(features.device, dtype=features.dtype)
+            pooled = roi_align(features, rois, output_size=self.roi_output_size, spatial_scale=spatial_scale, sampling_ratio=-1, aligned=True)
+            y_hat.append(self.network.forward_head(pooled, pre_logits=pre_logits))
+        return torch.concat(y_hat) if len(y_hat) > 0 else torch.zeros((0, self.num_classes), device=self.device)
@@ -4,6 +4,7 @@ import pytorch_lightning as pl
 
 from src.utils import set_seed, get_optimizer
 from src.models.project4.models import get_model
+from src.models.project4.evaluate import add_nms_arguments
 from src.models.project4.losses import get_loss
 from src.data.project4.dataloader import get_loaders
 
@@ -40,6 +41,13 @@ def parse_arguments():
     # TRAINING PARAMETERS
     parser.add_argument("--batch_size", type=int, default=64,
                         help="Batch size.")
+    parser.add_argument("--forward_chunk_size", type=int, default=-1,
+                        help="Maximum number of regions per forward pass - all regions of a batch at once if -1.")
+    parser.add_argument("--score_threshold", type=float, default=0.0,
+                        help="Detections with a lower score are dropped before the NMS.")
+    add_nms_arguments(parser)
+    parser.add_argument("--save_predictions", type=str, default=None,
+                        help="Save the classified test proposals (.npz) for offline evaluation with src/models/project4/evaluate.py.")
     parser.add_argument("--num_workers", type=int, default=1,
                         help="Number of workers in the dataloader.")
     parser.add_argument("--epochs", type=int, default=100,
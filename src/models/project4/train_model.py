@@ -4,13 +4,18 @@ import matplotlib.pyplot as plt
 import pytorch_lightning as pl
 from pytorch_lightning.loggers import TensorBoardLogger
 import torch
+from torch.utils.data import DataLoader
+import io
 import json
 import os
 
-from src.utils import set_seed, get_optimizer
+from src.utils import set_seed, get_optimizer, apply_loader_profile
 from src.models.project4.models import get_model
+from src.models.project4.evaluate import add_nms_arguments
 from src.models.project4.losses import get_loss
 from src.data.project4.dataloader import get_loaders 
+from src.features.build_features import FeatureCache, build_region_cache, is_cached
+from src.visualization.writer import get_writer
 from dummy_args import dummy_args
 
 class BooleanListAction(argparse.Action):
@@ -44,6 +49,10 @@ def parse_arguments():
                         help="Number of devices"),
     parser.add_argument("--data_path", type=str, default="/dtu/datasets1/02514/data_wastedetection", 
                         help="Path to dataset"),
+    parser.add_argument("--proposals_path", type=str, default="/work3/s184984/02514/project4/bboxes/proposals", 
+                        help="Path to selective search proposals generated with src/data/project4/proposals.py"),
+    parser.add_argument("--region_store", type=str, default=None, 
+                        help="Path to region store built with src/data/project4/region_store.py - serves val and test regions"),
     
     parser.add_argument("--out", type=bool, default=False,
                         help="output individual predicted images")
@@ -51,10 +60,33 @@ def parse_arguments():
     # TRAINING PARAMETERS
     parser.add_argument("--region_size", type=int, default=224,
                         help="Size of bbox images for training.")
+    parser.add_argument("--region_mode", type=str, default='crop',
+                        help="Where regions are extracted - one of: [crop (in the dataset), roi (batched RoIAlign in the model)]")
+    parser.add_argument("--sample_regions", type=bool, default=False,
+                        help="Sample foreground/background proposals of training images before extracting regions (requires proposal matches)")
+    parser.add_argument("--proposal_ranker", type=str, default=None,
+                        help="Proposal ranker weights from src/data/project4/proposal_ranking.py fit - validation and test proposals are not ranked if not given.")
+    parser.add_argument("--top_n_proposals", type=int, default=-1,
+                        help="Number of top ranked validation and test proposals per image to classify, all if -1.")
     parser.add_argument("--batch_size", type=int, default=8,
                         help="Batch size.")
+    parser.add_argument("--forward_chunk_size", type=int, default=-1,
+                        help="Maximum number of regions per forward pass - all regions of a batch at once if -1.")
+    parser.add_argument("--score_threshold", type=float, default=0.0,
+                        help="Detections with a lower score are dropped before the NMS.")
+    add_nms_arguments(parser)
+    parser.add_argument("--save_predictions", type=str, default=None,
+                        help="Save the classified test proposals (.npz) for offline evaluation with src/models/project4/evaluate.py.")
     parser.add_argument("--num_workers", type=int, default=1,
                         help="Number of workers in the dataloader.")
+    parser.add_argument("--pin_memory", type=bool, default=False,
+                        help="Collate batches into pinned memory for faster host to device copies.")
+    parser.add_argument("--persistent_workers", type=bool, default=False,
+                        help="Keep the dataloader workers alive between epochs.")
+    parser.add_argument("--prefetch_factor", type=int, default=None,
+                        help="Number of batches prefetched per worker (DataLoader default if not given).")
+    parser.add_argument("--loader_profile", type=str, default=None,
+                        help="Profile from src/data/benchmark_loaders.py - overrides the dataloader worker settings.")
     parser.add_argument("--epochs", type=int, default=100,
                         help="Number of epochs for training the model.")
     parser.add_argument("--lr", type=float, default=1e-04,
@@ -81,6 +113,14 @@ def parse_arguments():
                         help="Model name - either 'efficientnet_b4' or ...")
     parser.add_argument("--percentage_to_freeze", type=float, default=None,
                         help="Percentage to freeze (transfer learning) in [0, 1]")
+    parser.add_argument("--shared_features", type=bool, default=False,
+                        help="Run the backbone once per image and pool proposal features from the feature map (timm models only) - use with --region_mode roi.")
+    parser.add_argument("--roi_output_size", type=int, default=7,
+                        help="Size of the pooled proposal features in shared feature mode.")
+    parser.add_argument("--feature_cache", type=str, default=None,
+                        help="Directory of cached region embeddings - freezes the backbone and trains the classification head only.")
+    parser.add_argument("--cache_batch_size", type=int, default=1024,
+                        help="Number of cached region embeddings per batch.")
 
     return parser.parse_args()
 
@@ -89,6 +129,10 @@ def train(args):
     # Set random seed
     set_seed(args.seed)
 
+    # Dataloader worker settings tuned for this machine
+    if args.loader_profile is not None:
+        apply_loader_profile(args, args.loader_profile)
+
     # Get functions
     loss_fun = get_loss(args.loss)
     optimizer = get_optimizer(args.optimizer)
@@ -103,12 +147,33 @@ def train(args):
         region_size = (args.region_size, args.region_size),
         use_super_categories=args.use_super_categories,
         root = args.data_path,
+        region_store = args.region_store,
+        proposals_path = args.proposals_path,
+        region_mode = args.region_mode,
+        sample_regions = args.sample_regions,
+        pin_memory = args.pin_memory,
+        persistent_workers = args.persistent_workers,
+        prefetch_factor = args.prefetch_factor,
+        proposal_ranker = args.proposal_ranker,
+        top_n_proposals = args.top_n_proposals,
     )
 
     # Load model
     model = get_model(args.model_name, args, loss_fun, optimizer, out=args.out, num_classes=num_classes, region_size=(args.region_size, args.region_size), id2cat=loaders['train'].dataset.id2cat)
     model.lr = args.lr
 
+    # Compute backbone embeddings of the training and validation regions once, only the head is trained on them
+    train_loader, val_loader = loaders['train'], loaders['validation']
+    if args.feature_cache is not None:
+        model.freeze_parameters(None)
+        model.to("cuda" if torch.cuda.is_available() else "cpu")
+        caches = {
+            split: FeatureCache(path) if is_cached(path) else build_region_cache(model, loaders[split], path)
+            for split, path in [(split, f'{args.feature_cache}/{split}') for split in ('train', 'validation')]
+        }
+        train_loader = DataLoader(caches['train'], batch_size=args.cache_batch_size, shuffle=True, num_workers=args.num_workers)
+        val_loader = DataLoader(caches['validation'], batch_size=args.cache_batch_size, shuffle=False, num_workers=args.num_workers)
+
     # Set up logger
     tb_logger = TensorBoardLogger(
         save_dir=f"{args.log_path}/{args.experiment_name}/{args.model_name}",
@@ -135,8 +200,8 @@ def train(args):
     # Train model
     trainer.fit(
         model=model,
-        train_dataloaders = loaders['train'],
-        val_dataloaders   = loaders['validation']
+        train_dataloaders = train_loader,
+        val_dataloaders   = val_loader
     )
 
     # manually you can save best checkpoints - 
@@ -149,10 +214,17 @@ def train(args):
     trainer.predict(model, dataloaders=loaders['test'], ckpt_path = 'best')
         
     # saving sweep plot if activated
+    writer = get_writer()
     if args.initial_lr_steps != -1:
         fig = trainer.model.lr_finder.optimal_lr.plot(suggest=True, show=False);
-        plt.savefig(f"{args.save_path}/{args.experiment_name}/lr_sweep.png")
+        buffer = io.BytesIO()
+        plt.savefig(buffer, format='png')
         plt.close(fig)
+        writer.write_bytes(f"{args.save_path}/{args.experiment_name}/lr_sweep.png", buffer.getvalue())
+
+    # Wait for the prediction images written in the background
+    writer.flush()
+    print(f"Artifacts written: {writer.stats()}")
 
 
 if __name__ == '__main__':
@@ -1,19 +1,87 @@
 import torch
 import numpy as np
+import json
 import os
 
 import torch.optim as optim
+from torchvision.ops import batched_nms
 from torchvision import transforms
 
 import selectivesearch
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
+from src.visualization import render
+from src.visualization.writer import get_writer
 from torchmetrics.detection.mean_ap import MeanAveragePrecision
 
 def set_seed(SEED):
     np.random.seed(SEED)
     torch.manual_seed(SEED)
 
+def get_loader_kwargs(num_workers=1, pin_memory=False, persistent_workers=False, prefetch_factor=None):
+    # DataLoader worker settings shared by all get_loaders, persistence and prefetching need workers
+    return {
+        'num_workers':          num_workers,
+        'pin_memory':           pin_memory,
+        'persistent_workers':   persistent_workers and num_workers > 0,
+        'prefetch_factor':      prefetch_factor if num_workers > 0 else None,
+    }
+
+def apply_loader_profile(args, path):
+    """overrides the DataLoader settings in args with a profile written by
+    src/data/benchmark_loaders.py, preferring the best configuration for args.batch_size
+    """
+    with open(path, 'r') as f:
+        profile = json.load(f)
+    config = profile['by_batch_size'].get(str(args.batch_size), profile['best'])
+    for key in ('num_workers', 'pin_memory', 'persistent_workers', 'prefetch_factor'):
+        setattr(args, key, config[key])
+    print(f"Loader profile {path}: num_workers={args.num_workers}, pin_memory={args.pin_memory}, "
+          f"persistent_workers={args.persistent_workers}, prefetch_factor={args.prefetch_factor} "
+          f"({config['samples_per_sec']:.1f} samples/sec at batch size {config['batch_size']})")
+    return args
+
+# Root of the caches of all projects
+CACHE_ROOT = os.path.expanduser('~/.cache/DL-COMVIS')
+
+class MemmapStore:
+    """base of the read-only stores that memory-map their arrays from a directory. The
+    attributes named in lazy_attributes hold opened memory maps: they are None until open()
+    is called on first access and are not pickled, so DataLoader workers re-open them
+    """
+    lazy_attributes = ()
+
+    def __init__(self, path):
+        self.path = path
+        for name in self.lazy_attributes:
+            setattr(self, name, None)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in self.lazy_attributes:
+            state[name] = None
+        return state
+
+    def open(self):
+        raise NotImplementedError
+
+    def ensure_open(self):
+        if getattr(self, self.lazy_attributes[0]) is None:
+            self.open()
+
+def read_store_meta(path):
+    with open(f'{path}/meta.json', 'r') as f:
+        return json.load(f)
+
+def write_store_meta(path, meta):
+    # Written last (atomically), marks the store in path as complete
+    with open(f'{path}/meta.json.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(f'{path}/meta.json.tmp', f'{path}/meta.json')
+
+def is_store_complete(path):
+    return os.path.exists(f'{path}/meta.json')
+
 def invertNormalization(train_mean, train_std):
     return transforms.Compose([
         transforms.Normalize(
@@ -91,6 +159,61 @@ def Recall(y, y_hat):
 
 
 
+def batched_box_iou(boxes1, boxes2):
+    """IoU matrices for a batch of images, expects bounding boxes
+    [x1, y1, x2, y2] of shape (B, N, 4) and (B, M, 4)
+    """
+    area1 = (boxes1[..., 2] - boxes1[..., 0]) * (boxes1[..., 3] - boxes1[..., 1])
+    area2 = (boxes2[..., 2] - boxes2[..., 0]) * (boxes2[..., 3] - boxes2[..., 1])
+    lt = torch.max(boxes1[:, :, None, :2], boxes2[:, None, :, :2])
+    rb = torch.min(boxes1[:, :, None, 2:], boxes2[:, None, :, 2:])
+    wh = torch.clamp(rb - lt, min=0)
+    intersection = wh[..., 0] * wh[..., 1]
+    return intersection / (area1[:, :, None] + area2[:, None, :] - intersection)
+
+def match_boxes_batched(bboxes, cat_ids, gt_mask, pred_bboxes, pred_mask, num_classes, iou_threshold=0.5):
+    """matches proposals to ground truth boxes for a padded batch of images, expects bounding boxes
+    [x1, y1, x2, y2] of shape (B, G, 4) and (B, P, 4), labels (B, G) and masks of the non-padded entries
+    """
+    batch_size, num_pred_boxes = pred_bboxes.shape[:2]
+    device = pred_bboxes.device
+
+    # Mark no match as background index (which is num_classes - 1 as defined in data loader)
+    pred_labels     = torch.full((batch_size, num_pred_boxes), num_classes - 1, dtype=torch.long, device=device)
+    pred_gt_bboxes  = -torch.ones((batch_size, num_pred_boxes), dtype=torch.long, device=device)
+    gt_matches      = torch.zeros(gt_mask.shape, dtype=torch.bool, device=device)
+    gt_mask, pred_mask = gt_mask.to(device), pred_mask.to(device)
+    if bboxes.shape[1] == 0:
+        return torch.zeros_like(pred_mask), gt_matches, pred_labels, pred_gt_bboxes
+
+    # Best ground truth box for every proposal, padded ground truth boxes never match
+    iou = batched_box_iou(bboxes.to(device, torch.float), pred_bboxes.to(torch.float))
+    iou = iou.masked_fill(~gt_mask[:, :, None], -1)
+    max_iou, gt_idx = iou.max(dim=1)
+
+    # Threshold and gather labels of the matched boxes
+    pred_matches    = (max_iou >= iou_threshold) & pred_mask
+    pred_gt_bboxes  = torch.where(pred_matches, gt_idx, pred_gt_bboxes)
+    pred_labels     = torch.where(pred_matches, torch.gather(cat_ids.to(device, torch.long), 1, gt_idx), pred_labels)
+
+    # Ground truth boxes matched by at least one proposal
+    image_idx, _    = torch.nonzero(pred_matches, as_tuple=True)
+    gt_matches[image_idx, gt_idx[pred_matches]] = True
+
+    return pred_matches, gt_matches, pred_labels, pred_gt_bboxes
+
+def match_boxes(bboxes, cat_ids, pred_bboxes, num_classes, iou_threshold=0.5):
+    """matches proposals to ground truth boxes of a single image, expects bounding boxes
+    [x1, y1, x2, y2]
+    """
+    pred_matches, gt_matches, pred_labels, pred_gt_bboxes = match_boxes_batched(
+        bboxes[None], cat_ids.reshape(1, -1), torch.ones((1, len(bboxes)), dtype=torch.bool, device=bboxes.device),
+        pred_bboxes[None], torch.ones((1, len(pred_bboxes)), dtype=torch.bool, device=pred_bboxes.device),
+        num_classes, iou_threshold=iou_threshold,
+    )
+    return pred_matches[0], gt_matches[0], pred_labels[0], pred_gt_bboxes[0]
+
+
 def mAP(preds, targets):
     """mean average precision for object detection"""
     return MeanAveragePrecision()(preds, targets)
@@ -101,6 +224,51 @@ def non_maximum_suppression(y, y_hat, iou_threshold=0.5):
     iou_matrix[iou_matrix < iou_threshold] = 0
     return iou_matrix
 
+def top_k_per_image(scores, image_idx, k=-1):
+    """indices of the k highest scores of every image, ordered by image and then by
+    decreasing score. All indices are kept (only reordered) if k is -1
+    """
+    order = torch.argsort(scores, descending=True, stable=True)
+    order = order[torch.argsort(image_idx[order], stable=True)]
+    if k < 0:
+        return order
+    counts = torch.bincount(image_idx[order])
+    starts = torch.cumsum(counts, 0) - counts
+    rank = torch.arange(len(order), device=order.device) - starts[image_idx[order]]
+    return order[rank < k]
+
+def batched_class_nms(boxes, probs, image_idx, background, iou_threshold=0.5, score_threshold=0.0, pre_nms_top_k=-1, max_detections=-1):
+    """class-aware non maximum suppression over the packed proposals of a batch of images.
+    Every box takes its most likely class, background and low scoring boxes are dropped and
+    the pre_nms_top_k best boxes per image enter a single batched NMS, in which boxes of
+    different images or classes never suppress each other. iou_threshold and score_threshold
+    are floats or tensors with a threshold per class. Returns indices into boxes ordered by image and
+    decreasing score, with the scores and labels of all boxes
+    """
+    scores, labels = probs.max(dim=1)
+    score_threshold = torch.as_tensor(score_threshold, dtype=scores.dtype, device=scores.device)
+    if score_threshold.ndim > 0:
+        score_threshold = score_threshold[labels]
+    keep = torch.nonzero((labels != background) & (scores >= score_threshold)).flatten()
+    if pre_nms_top_k > 0:
+        keep = keep[top_k_per_image(scores[keep], image_idx[keep], pre_nms_top_k)]
+
+    # One NMS call per distinct threshold, a single one unless thresholds are per class
+    iou_threshold = torch.as_tensor(iou_threshold, dtype=torch.float)
+    if iou_threshold.ndim == 0:
+        groups = [(iou_threshold.item(), keep)]
+    else:
+        thresholds = iou_threshold.to(labels.device)[labels[keep]]
+        groups = [(threshold.item(), keep[thresholds == threshold]) for threshold in thresholds.unique()]
+
+    keep = torch.concat([
+        idx[batched_nms(boxes[idx].to(torch.float), scores[idx], image_idx[idx] * probs.shape[1] + labels[idx], threshold)]
+        for threshold, idx in groups
+    ]) if len(keep) > 0 else keep
+
+    keep = keep[top_k_per_image(scores[keep], image_idx[keep], max_detections)]
+    return keep, scores, labels
+
 def selective_search(transformed_img, scale=500, sigma=0.9, min_size=10):
 
     _, regions = selectivesearch.selective_search(transformed_img.permute(1,2,0), scale=scale, sigma=sigma, min_size=min_size)
@@ -132,38 +300,10 @@ def plot_SS_old(transformed_img, bboxes, idx = None, batch_idx = None, path = '/
     plt.close()
 
 def plot_SS(transformed_img, GTs, GT_labels, bboxes, bbox_labels, bbox_scores, idx = None, batch_idx = None, id2cat = None, path = '/work3/s184984/02514/project4_results/predict_imgs'):
-    # Albumentations
-    fig, ax = plt.subplots(figsize=(6, 6))
+    # Predictions in red (labelled at the box center), ground truth in green
     folder_path = f"{path}/{path.split('/')[-1]}_batchidx{batch_idx}"
 
-    if not os.path.exists(folder_path):
-        os.makedirs(folder_path)
-
-    ax.imshow(transforms.ToPILImage()(transformed_img))
-    for i, (x1,y1,x2,y2) in enumerate(bboxes.cpu().numpy()):
-        bbox = mpatches.Rectangle(
-            (x1, y1), x2-x1, y2-y1, fill=False, edgecolor='red', linewidth=1)
-        ax.add_patch(bbox)
-        ax.add_artist(bbox)
-        rx, ry = bbox.get_xy()
-        cx = rx + bbox.get_width()/2.0
-        cy = ry + bbox.get_height()/2.0
-
-        ax.annotate(f"{id2cat[int(bbox_labels[i].cpu().numpy())]}, prob {bbox_scores[i].cpu().numpy():.2f}", (cx, cy), color='red', weight='bold', 
-                    fontsize=6, ha='center', va='center')
-        
-    for i, (x1,y1,x2,y2) in enumerate(GTs.cpu().numpy()):
-        bbox = mpatches.Rectangle(
-            (x1, y1), x2-x1, y2-y1, fill=False, edgecolor='green', linewidth=1)
-        ax.add_patch(bbox)
-        ax.add_artist(bbox)
-        rx, ry = bbox.get_xy()
-        #cx = rx + bbox.get_width()/2.0
-        #cy = ry + bbox.get_height()/2.0
-
-        ax.annotate(f"{id2cat[int(GT_labels[i].cpu().numpy())]}", (rx+5, ry-5), color='green', weight='bold', 
-                    fontsize=6, ha='center', va='center')        
-
-    plt.axis('off')
-    plt.savefig(f'{folder_path}/idx{idx}.png')
-    plt.close()
+    pred_labels = [f"{id2cat[int(label)]}, prob {float(score):.2f}" for label, score in zip(bbox_labels.tolist(), bbox_scores.tolist())]
+    image = render.draw_boxes(transformed_img, bboxes, pred_labels, color=render.RED, label_position='center')
+    image = render.draw_boxes(image, GTs, [id2cat[int(label)] for label in GT_labels.tolist()], color=render.GREEN)
+    get_writer().save_image(f'{folder_path}/idx{idx}.png', image)
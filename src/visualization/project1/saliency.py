@@ -1,11 +1,11 @@
 import torch
 import torchvision.transforms as transforms
 import argparse
-import matplotlib.pyplot as plt
 
-from src.models.project1.models import get_model
-from src.data.project1.dataloader import get_loaders, get_normalization_constants
+from src.models.project1.models import get_model, load_normalization_constants
+from src.data.project1.dataloader import get_loaders, get_normalization_constants, STATS_CACHE_DIR
 from src.utils import invertNormalization
+from src.visualization import render
 
 def parse_arguments():
 
@@ -30,6 +30,8 @@ def parse_arguments():
                         help="Number of epochs for training the model.")
     parser.add_argument("--num_workers", type=int, default=1,
                         help="Number of workers in the dataloader.")
+    parser.add_argument("--stats_cache", type=str, default=STATS_CACHE_DIR,
+                        help="Directory caching the normalization statistics of the training split.")
     parser.add_argument("--min_lr", type=float, default=1e-08,
                         help="Minimum allowed learning rater.")
     parser.add_argument("--max_lr", type=float, default=1,
@@ -47,10 +49,12 @@ args = parse_arguments()
 
 
 model0 = get_model(network_name=args.network_name)(args)
-# train_mean, train_std = get_normalization_constants(root=args.data_path, seed=args.seed)
-
-train_mean = torch.tensor([0.5132, 0.4369, 0.3576])
-train_std = torch.tensor([0.0214, 0.0208, 0.0223])
+# Statistics the model was trained with, recomputed for checkpoints saved before they were stored
+constants = load_normalization_constants(args.model_path)
+if constants is None:
+    print(f"Warning: {args.model_path} has no normalization constants, using the statistics of the training split (see the project1 README)")
+    constants = get_normalization_constants(root=args.data_path, seed=args.seed, batch_size=args.batch_size, num_workers=args.num_workers, cache_dir=args.stats_cache)
+train_mean, train_std = constants
 
 # Define transforms for training
 train_transforms = transforms.Compose([
@@ -99,7 +103,7 @@ x0, y0 = x.to(model.device), y.to(model.device)
 stdev_spreads = [0.001, 0.05, 0.1, 0.2, 0.3, 0.5]
 n_samples = 25
 
-fig, ax = plt.subplots(4, len(stdev_spreads)+1, figsize=(15, 10))
+tiles = []
 
 
 indeces_found = False
@@ -130,6 +134,7 @@ for i, idx in enumerate(idxs):
     # Visualize the image and the saliency map
     img_back_transformed = invertNormalization(train_mean, train_std)(image).cpu().detach().numpy().transpose(1, 2, 0)
     img_back_transformed = img_back_transformed.clip(0, 1)
+    tiles.append(render.add_caption(img_back_transformed, f"y_hat: {idx2class[y_hat_base.argmax().item()]}, y: {idx2class[y.item()]}"))
     for j in range(1, len(stdev_spreads)+1):
         # heavily inspired by https://github.com/pkmr06/pytorch-smoothgrad/blob/master/lib/gradients.py
         # scale the noise according to the image
@@ -160,18 +165,12 @@ for i, idx in enumerate(idxs):
         saliency = torch.clamp(saliency, min=0, max=mask99)
         saliency = (saliency - saliency.min()) / (saliency.max() - saliency.min())
 
-        ax[i, 0].imshow(img_back_transformed)
-        ax[i, 0].set_title(r"$\hat{y}$"+f": {idx2class[y_hat_base.argmax().item()]}, y: {idx2class[y.item()]}")
-        ax[i, 0].axis('off')
-        ax[i, j].imshow(saliency.cpu().permute(1,2,0).mean(2), cmap='gray')
-        ax[i, j].set_title(f"noise: {stdev_spreads[j-1]*100} %")
-        ax[i, j].axis('off')
-
-plt.tight_layout()
-fig.suptitle('Image and Saliency Map')
-plt.savefig("src/visualization/project1/saliency_map.png",dpi=300)
-
-fig, ax = plt.subplots(1)
-ax.hist(saliency.cpu().detach().numpy().flatten(), bins=100)
-ax.set_title('Histogram of Saliency Map')
-plt.savefig("src/visualization/project1/saliency_map_hist.png",dpi=300)
+        tiles.append(render.add_caption(render.heatmap(saliency.mean(0), colormap='gray'), f"noise: {stdev_spreads[j-1]*100} %"))
+
+# One row per (y, y_hat) pair: the image followed by its saliency maps
+render.save_image("src/visualization/project1/saliency_map.png", render.add_caption(render.mosaic(tiles, ncols=len(stdev_spreads)+1), 'Image and Saliency Map'))
+
+render.save_image(
+    "src/visualization/project1/saliency_map_hist.png",
+    render.add_caption(render.histogram_image(saliency, bins=100), 'Histogram of Saliency Map'),
+)
@@ -0,0 +1,183 @@
+import io
+import os
+
+import numpy as np
+import torch
+from PIL import Image, ImageDraw, ImageFont
+
+# Renders boxes, labels, mask overlays and heatmaps directly onto (H, W, 3) uint8 arrays,
+# much faster than one matplotlib figure per image when writing many predictions.
+
+RED     = (255, 0, 0)
+GREEN   = (0, 255, 0)
+BLUE    = (0, 0, 255)
+WHITE   = (255, 255, 255)
+BLACK   = (0, 0, 0)
+
+
+def to_uint8_image(image):
+    '''
+    Converts a (C, H, W) tensor or (H, W, C) / (H, W) array, either uint8 or float in [0, 1],
+    to an (H, W, 3) uint8 array.
+    '''
+    if isinstance(image, torch.Tensor):
+        image = image.detach().cpu()
+        if image.ndim == 3:
+            image = image.permute(1, 2, 0)
+        image = image.numpy()
+
+    image = np.asarray(image)
+    if image.dtype != np.uint8:
+        image = (np.clip(image.astype(np.float32), 0, 1) * 255 + 0.5).astype(np.uint8)
+    if image.ndim == 2:
+        image = image[..., None]
+    if image.shape[2] == 1:
+        image = np.repeat(image, 3, axis=2)
+    return np.ascontiguousarray(image[..., :3])
+
+
+def _colormap_lut(name):
+    # 256 x 3 uint8 lookup table
+    x = np.linspace(0, 1, 256)
+    if name == 'gray':
+        lut = np.stack([x, x, x], axis=1)
+    elif name == 'jet':
+        lut = np.clip(1.5 - np.abs(4 * x[:, None] - np.array([3, 2, 1])), 0, 1)
+    elif name == 'hot':
+        lut = np.clip(np.stack([3 * x, 3 * x - 1, 3 * x - 2], axis=1), 0, 1)
+    else:
+        raise ValueError(f'Unknown colormap {name}')
+    return (lut * 255 + 0.5).astype(np.uint8)
+
+COLORMAPS = {name: _colormap_lut(name) for name in ('gray', 'jet', 'hot')}
+
+
+def heatmap(values, colormap='jet', normalize=True):
+    '''
+    Maps an (H, W) array or tensor to an (H, W, 3) uint8 image, min-max normalized unless
+    normalize is False (values are then expected in [0, 1]).
+    '''
+    if isinstance(values, torch.Tensor):
+        values = values.detach().cpu().numpy()
+    values = np.asarray(values, dtype=np.float32)
+    if normalize:
+        low, high = values.min(), values.max()
+        values = (values - low) / max(high - low, 1e-12)
+    return COLORMAPS[colormap][(np.clip(values, 0, 1) * 255 + 0.5).astype(np.uint8)]
+
+
+def overlay(image, layer, alpha=0.5, mask=None):
+    '''
+    Blends an (H, W, 3) uint8 layer onto the image, only where mask is set if given.
+    '''
+    image, layer = to_uint8_image(image), to_uint8_image(layer)
+    blended = (image * (1 - alpha) + layer * alpha + 0.5).astype(np.uint8)
+    if mask is None:
+        return blended
+    return np.where(np.asarray(mask, dtype=bool)[..., None], blended, image)
+
+
+def overlay_mask(image, mask, color=RED, alpha=0.5):
+    # Colors the pixels of a binary (H, W) mask
+    if isinstance(mask, torch.Tensor):
+        mask = mask.detach().cpu().numpy()
+    image = to_uint8_image(image)
+    return overlay(image, np.broadcast_to(np.array(color, dtype=np.uint8), image.shape), alpha, mask=mask)
+
+
+def overlay_heatmap(image, values, colormap='jet', alpha=0.5):
+    return overlay(image, heatmap(values, colormap), alpha)
+
+
+def _text_size(draw, text, font):
+    left, top, right, bottom = draw.textbbox((0, 0), text, font=font)
+    return right - left, bottom - top
+
+
+def draw_boxes(image, boxes, labels=None, color=RED, width=1, label_position='top_left'):
+    '''
+    Draws (x1, y1, x2, y2) boxes with optional text labels on a copy of the image.
+    label_position is one of: [top_left (above the box), center].
+    '''
+    image = Image.fromarray(to_uint8_image(image))
+    draw, font = ImageDraw.Draw(image), ImageFont.load_default()
+    if isinstance(boxes, torch.Tensor):
+        boxes = boxes.detach().cpu().numpy()
+
+    for i, (x1, y1, x2, y2) in enumerate(np.asarray(boxes, dtype=np.float32).reshape(-1, 4)):
+        draw.rectangle([x1, y1, x2, y2], outline=color, width=width)
+        if labels is None:
+            continue
+        text_width, text_height = _text_size(draw, labels[i], font)
+        if label_position == 'center':
+            position = ((x1 + x2 - text_width) / 2, (y1 + y2 - text_height) / 2)
+        else:
+            position = (x1, max(y1 - text_height - 2, 0))
+        draw.text(position, labels[i], fill=color, font=font)
+
+    return np.asarray(image)
+
+
+def add_caption(image, text, height=14, color=BLACK, background=WHITE):
+    # Adds a line of text above the image
+    image = to_uint8_image(image)
+    bar = Image.new('RGB', (image.shape[1], height), background)
+    draw, font = ImageDraw.Draw(bar), ImageFont.load_default()
+    text_width, text_height = _text_size(draw, text, font)
+    draw.text(((image.shape[1] - text_width) / 2, (height - text_height) / 2), text, fill=color, font=font)
+    return np.concatenate([np.asarray(bar), image], axis=0)
+
+
+def histogram_image(values, bins=100, size=(200, 400), color=BLUE, background=WHITE):
+    # Bar plot of the histogram of values as an (H, W, 3) uint8 image
+    if isinstance(values, torch.Tensor):
+        values = values.detach().cpu().numpy()
+    counts, _ = np.histogram(np.asarray(values).ravel(), bins=bins)
+    height, width = size
+    bar_heights = np.round(counts / max(counts.max(), 1) * (height - 1)).astype(np.int64)
+    columns = np.minimum(np.arange(width) * bins // width, bins - 1)
+
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[:] = background
+    filled = np.arange(height)[::-1, None] < bar_heights[columns][None, :]
+    image[filled] = color
+    return image
+
+
+def mosaic(images, ncols=None, padding=2, background=WHITE):
+    '''
+    Tiles a list of images into a single image, row by row. Images are padded to the
+    largest height and width in the list.
+    '''
+    images = [to_uint8_image(image) for image in images]
+    ncols = ncols or len(images)
+    nrows = -(-len(images) // ncols)
+    height = max(image.shape[0] for image in images)
+    width = max(image.shape[1] for image in images)
+
+    canvas = np.empty((nrows * (height + padding) + padding, ncols * (width + padding) + padding, 3), dtype=np.uint8)
+    canvas[:] = background
+    for k, image in enumerate(images):
+        y = padding + (k // ncols) * (height + padding)
+        x = padding + (k % ncols) * (width + padding)
+        canvas[y:y + image.shape[0], x:x + image.shape[1]] = image
+    return canvas
+
+
+def encode(image, format='png', quality=90):
+    # Encoded image bytes, e.g. for writing to a file or a log
+    buffer = io.BytesIO()
+    image = Image.fromarray(to_uint8_image(image))
+    if format.lower() in ('jpg', 'jpeg'):
+        image.save(buffer, format='JPEG', quality=quality)
+    else:
+        # Fast compression, prediction images are written often and read rarely
+        image.save(buffer, format='PNG', compress_level=1)
+    return buffer.getvalue()
+
+
+def save_image(path, image, quality=90):
+    # Format is inferred from the file extension
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(encode(image, os.path.splitext(path)[1][1:] or 'png', quality))
@@ -0,0 +1,110 @@
+import atexit
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+
+from src.visualization import render
+
+# End of queue marker
+STOP = None
+
+
+class ArtifactWriter:
+    '''
+    Writes prediction images and result files from a background thread, so the model loop
+    does not wait for the disk. The queue is bounded: when the disk cannot keep up, callers
+    block instead of holding an unbounded number of images in memory. Everything queued is
+    written before the interpreter exits.
+    '''
+    def __init__(self, max_queue=64):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.lock = threading.Lock()
+        self.queued_bytes, self.written_bytes = 0, 0
+        self.num_queued, self.num_written = 0, 0
+        self.errors = []
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.closed = False
+        atexit.register(self.close)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is STOP:
+                self.queue.task_done()
+                break
+            path, encode, payload = item
+            try:
+                data = encode(payload)
+                os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(data)
+                with self.lock:
+                    self.written_bytes += len(data)
+                    self.num_written += 1
+            except Exception as e:
+                self.errors.append((path, e))
+            finally:
+                self.queue.task_done()
+
+    def submit(self, path, encode, payload, num_bytes):
+        if self.closed:
+            raise RuntimeError('ArtifactWriter is closed')
+        with self.lock:
+            self.queued_bytes += num_bytes
+            self.num_queued += 1
+        self.queue.put((path, encode, payload))
+
+    def write_bytes(self, path, data):
+        self.submit(path, bytes, data, len(data))
+
+    def write_json(self, path, obj):
+        # Serialized right away, so later changes to obj are not written
+        self.write_bytes(path, json.dumps(obj).encode())
+
+    def save_image(self, path, image, quality=90):
+        # Encoded in the writer thread, format from the file extension as in render.save_image
+        image = np.array(render.to_uint8_image(image))
+        format = os.path.splitext(path)[1][1:] or 'png'
+        self.submit(path, lambda image: render.encode(image, format, quality), image, image.nbytes)
+
+    def flush(self):
+        # Blocks until everything queued so far is written, raises the first failed write
+        self.queue.join()
+        if len(self.errors) > 0:
+            path, e = self.errors[0]
+            self.errors = []
+            raise RuntimeError(f'Failed to write {path}') from e
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(STOP)
+        self.thread.join()
+        for path, e in self.errors:
+            print(f'ArtifactWriter: failed to write {path}: {e}')
+
+    def stats(self):
+        with self.lock:
+            return {
+                'queued':           self.num_queued,
+                'written':          self.num_written,
+                'pending':          self.queue.qsize(),
+                'queued_bytes':     self.queued_bytes,
+                'written_bytes':    self.written_bytes,
+            }
+
+
+_writer = None
+
+def get_writer():
+    # Shared writer of the process, started on first use (not in dataloader workers that never write)
+    global _writer
+    if _writer is None:
+        _writer = ArtifactWriter()
+    return _writer
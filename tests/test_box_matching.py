@@ -0,0 +1,70 @@
+import pytest
+import torch
+from torchvision.ops import box_iou
+
+from src.utils import batched_box_iou, match_boxes, match_boxes_batched
+from src.models.project4.benchmark_compare_boxes import compare_boxes_loop, random_boxes
+
+NUM_CLASSES = 5
+
+
+def random_image(num_gt, num_pred, seed):
+    torch.manual_seed(seed)
+    bboxes = random_boxes(num_gt, img_size=128, min_size=8)
+    cat_ids = torch.randint(0, NUM_CLASSES - 1, (num_gt, 1))
+    # Jittered copies of the ground truth, so that some proposals match
+    pred_bboxes = torch.cat([random_boxes(num_pred, img_size=128, min_size=8), bboxes + torch.randint(-4, 5, bboxes.shape)])
+    return bboxes, cat_ids, pred_bboxes
+
+
+def test_batched_box_iou_matches_torchvision():
+    torch.manual_seed(0)
+    boxes1, boxes2 = random_boxes(6), random_boxes(9)
+    iou = batched_box_iou(boxes1[None], boxes2[None])[0]
+    torch.testing.assert_close(iou, box_iou(boxes1, boxes2))
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('iou_threshold', [0.3, 0.5, 0.7])
+def test_match_boxes_matches_loop(seed, iou_threshold):
+    bboxes, cat_ids, pred_bboxes = random_image(4, 30, seed)
+    expected = compare_boxes_loop(bboxes, cat_ids, pred_bboxes, NUM_CLASSES, iou_threshold=iou_threshold)
+    result = match_boxes(bboxes, cat_ids, pred_bboxes, NUM_CLASSES, iou_threshold=iou_threshold)
+    for actual, reference in zip(result, expected):
+        torch.testing.assert_close(actual, reference)
+
+
+def test_match_boxes_without_ground_truth():
+    pred_bboxes = random_boxes(7)
+    pred_matches, gt_matches, pred_labels, pred_gt_bboxes = match_boxes(
+        torch.zeros((0, 4)), torch.zeros((0, 1), dtype=torch.long), pred_bboxes, NUM_CLASSES,
+    )
+    assert not pred_matches.any()
+    assert len(gt_matches) == 0
+    assert (pred_labels == NUM_CLASSES - 1).all()
+    assert (pred_gt_bboxes == -1).all()
+
+
+def test_match_boxes_batched_ignores_padding():
+    # Two images padded to the same number of boxes give the same result as one at a time
+    images = [random_image(3, 10, 0), random_image(1, 4, 1)]
+    num_gt = max(len(bboxes) for bboxes, _, _ in images)
+    num_pred = max(len(pred_bboxes) for _, _, pred_bboxes in images)
+
+    bboxes = torch.zeros((2, num_gt, 4))
+    cat_ids = torch.zeros((2, num_gt), dtype=torch.long)
+    pred_bboxes = torch.zeros((2, num_pred, 4))
+    gt_mask = torch.zeros((2, num_gt), dtype=torch.bool)
+    pred_mask = torch.zeros((2, num_pred), dtype=torch.bool)
+    for i, (bboxes_, cat_ids_, pred_bboxes_) in enumerate(images):
+        bboxes[i, :len(bboxes_)], cat_ids[i, :len(bboxes_)] = bboxes_, cat_ids_.flatten()
+        pred_bboxes[i, :len(pred_bboxes_)] = pred_bboxes_
+        gt_mask[i, :len(bboxes_)], pred_mask[i, :len(pred_bboxes_)] = True, True
+
+    batched = match_boxes_batched(bboxes, cat_ids, gt_mask, pred_bboxes, pred_mask, NUM_CLASSES)
+    for i, (bboxes_, cat_ids_, pred_bboxes_) in enumerate(images):
+        single = match_boxes(bboxes_, cat_ids_, pred_bboxes_, NUM_CLASSES)
+        torch.testing.assert_close(batched[0][i, :len(pred_bboxes_)], single[0])
+        torch.testing.assert_close(batched[1][i, :len(bboxes_)], single[1])
+        torch.testing.assert_close(batched[2][i, :len(pred_bboxes_)], single[2])
+        torch.testing.assert_close(batched[3][i, :len(pred_bboxes_)], single[3])
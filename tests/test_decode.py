@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from src.data.project4.dataloader import ORIENTATION, decode_image, exif_rotate
+
+# Stored (width, height) of the test images
+WIDTH, HEIGHT = 400, 200
+
+
+def write_jpeg(path, orientation=None):
+    # Smooth gradients with a red top left block, so orientation and downscaling can be checked
+    x, y = np.meshgrid(np.linspace(0, 255, WIDTH), np.linspace(0, 255, HEIGHT))
+    array = np.stack([x, y, 255 - x], axis=2).astype(np.uint8)
+    array[:40, :40] = (255, 0, 0)
+    exif = Image.Exif()
+    if orientation is not None:
+        exif[ORIENTATION] = orientation
+    Image.fromarray(array).save(path, quality=95, exif=exif)
+    return path
+
+
+@pytest.mark.parametrize('orientation, red_corner', [
+    (None, (0, 0)),
+    (1, (0, 0)),
+    (3, (-1, -1)),  # Upside down
+    (6, (0, -1)),   # Stored rotated 90 degrees counter clockwise, the top left ends up top right
+    (8, (-1, 0)),
+])
+def test_exif_rotate(tmp_path, orientation, red_corner):
+    image = np.asarray(exif_rotate(Image.open(write_jpeg(tmp_path / 'image.jpg', orientation))))
+    assert image.shape[:2] == ((WIDTH, HEIGHT) if orientation in (6, 8) else (HEIGHT, WIDTH))
+    corner = image[10 if red_corner[0] == 0 else -10, 10 if red_corner[1] == 0 else -10]
+    assert corner[0] > 200 and corner[1] < 50
+
+
+@pytest.mark.parametrize('orientation', [None, 3, 6, 8])
+def test_decode_image_matches_exif_rotate(tmp_path, orientation):
+    path = write_jpeg(tmp_path / 'image.jpg', orientation)
+    image, scale = decode_image(path)
+    np.testing.assert_array_equal(image, np.asarray(exif_rotate(Image.open(path))))
+    assert scale == (1.0, 1.0)
+
+
+@pytest.mark.parametrize('orientation', [None, 3, 6, 8])
+@pytest.mark.parametrize('size, factor', [
+    ((50, 100), 4),     # (height, width) in displayed orientation, reachable by 1/4
+    ((60, 60), 2),      # 1/4 would be smaller than the requested height
+    ((300, 500), 1),    # Larger than the image, no reduction
+])
+def test_decode_image_draft(tmp_path, orientation, size, factor):
+    path = write_jpeg(tmp_path / 'image.jpg', orientation)
+    full = exif_rotate(Image.open(path))
+    if orientation in (6, 8):
+        size = size[::-1]
+
+    image, scale = decode_image(path, size)
+    assert image.shape == (full.height // factor, full.width // factor, 3)
+    assert scale == (1 / factor, 1 / factor)
+    assert image.shape[0] >= min(size[0], full.height) and image.shape[1] >= min(size[1], full.width)
+
+    # The reduced image is a downscaled version of the correctly oriented full image
+    expected = np.asarray(full.resize((image.shape[1], image.shape[0]), Image.Resampling.BOX), dtype=np.float32)
+    assert np.abs(image.astype(np.float32) - expected).mean() < 8
@@ -0,0 +1,150 @@
+import numpy as np
+import pytest
+import torch
+
+from src.utils import batched_class_nms
+from src.models.project4.evaluate import (
+    IOU_THRESHOLDS, average_precision, detect, evaluate, load_predictions, match_detections, save_predictions,
+)
+
+NUM_CLASSES = 4
+BACKGROUND = NUM_CLASSES - 1
+
+
+def random_predictions(num_images, num_boxes, seed):
+    # Jittered copies of random ground truth boxes with random labels and scores
+    rng = np.random.default_rng(seed)
+    boxes, scores, labels, gt_boxes, gt_labels = [], [], [], [], []
+    for _ in range(num_images):
+        num_gt = rng.integers(1, 5)
+        xy = rng.uniform(0, 60, (num_gt, 2))
+        image_gt_boxes = np.concatenate([xy, xy + rng.uniform(10, 40, (num_gt, 2))], axis=1)
+        image_boxes = np.repeat(image_gt_boxes, num_boxes // num_gt + 1, axis=0)[:num_boxes] + rng.normal(0, 4, (num_boxes, 4))
+        image_boxes[:, 2:] = np.maximum(image_boxes[:, 2:], image_boxes[:, :2] + 1)
+        boxes.append(image_boxes)
+        scores.append(rng.uniform(size=num_boxes))
+        labels.append(rng.integers(0, NUM_CLASSES, num_boxes))
+        gt_boxes.append(image_gt_boxes)
+        gt_labels.append(rng.integers(0, NUM_CLASSES - 1, num_gt))
+    offsets = lambda columns: np.concatenate([[0], np.cumsum([len(c) for c in columns])])
+    return {
+        'boxes':        np.concatenate(boxes).astype(np.float32),
+        'scores':       np.concatenate(scores).astype(np.float32),
+        'labels':       np.concatenate(labels),
+        'offsets':      offsets(boxes),
+        'gt_boxes':     np.concatenate(gt_boxes).astype(np.float32),
+        'gt_labels':    np.concatenate(gt_labels),
+        'gt_offsets':   offsets(gt_boxes),
+        'background':   BACKGROUND,
+    }
+
+
+def test_average_precision_toy_case():
+    # 2 ground truth boxes, detections TP, FP, TP by decreasing score: precision 1, 1/2, 2/3 at
+    # recall 1/2, 1/2, 1. The envelope is 1 up to recall 0.5 (51 points) and 2/3 above (50 points)
+    true_positives = np.tile([True, False, True], (len(IOU_THRESHOLDS), 1))
+    ap = average_precision(np.array([0.9, 0.8, 0.7]), true_positives, num_gt=2)
+    np.testing.assert_allclose(ap, (51 + 50 * 2 / 3) / 101)
+
+    # Recall never exceeds 0.5, higher recall thresholds count as precision 0
+    ap = average_precision(np.array([0.9]), true_positives[:, :1], num_gt=2)
+    np.testing.assert_allclose(ap, 51 / 101)
+
+    # Order by score, not by input order
+    ap = average_precision(np.array([0.7, 0.8, 0.9]), true_positives[:, ::-1], num_gt=2)
+    np.testing.assert_allclose(ap, (51 + 50 * 2 / 3) / 101)
+
+
+def test_match_detections_is_greedy_by_score():
+    gt_boxes = np.array([[0, 0, 10, 10], [20, 0, 30, 10]], dtype=np.float32)
+    det_boxes = np.array([
+        [0, 0, 10, 10],     # IoU 1 with the first box
+        [0, 0, 10, 9],      # IoU 0.9 with the first box, already matched
+        [20, 0, 30, 6],     # IoU 0.6 with the second box
+    ], dtype=np.float32)
+    matches = match_detections(det_boxes, gt_boxes)
+    np.testing.assert_array_equal(matches[:, 0], True)
+    np.testing.assert_array_equal(matches[:, 1], False)
+    np.testing.assert_array_equal(matches[:, 2], IOU_THRESHOLDS <= 0.6)
+
+    assert not match_detections(det_boxes, np.zeros((0, 4), dtype=np.float32)).any()
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_evaluate_matches_pycocotools(seed):
+    COCO = pytest.importorskip('pycocotools.coco').COCO
+    COCOeval = pytest.importorskip('pycocotools.cocoeval').COCOeval
+
+    predictions = random_predictions(5, 12, seed)
+    keep = detect(predictions, iou_threshold=1.0, max_detections=-1)
+    result = evaluate(predictions, keep)
+
+    xywh = lambda box: [float(box[0]), float(box[1]), float(box[2] - box[0]), float(box[3] - box[1])]
+    annotations, detections = [], []
+    for i, idx in enumerate(keep):
+        gt_rows = range(predictions['gt_offsets'][i], predictions['gt_offsets'][i+1])
+        for j in gt_rows:
+            box = predictions['gt_boxes'][j]
+            annotations.append({'id': j + 1, 'image_id': i, 'category_id': int(predictions['gt_labels'][j]),
+                                'bbox': xywh(box), 'area': xywh(box)[2] * xywh(box)[3], 'iscrowd': 0})
+        for j in idx:
+            detections.append({'image_id': i, 'category_id': int(predictions['labels'][j]),
+                               'bbox': xywh(predictions['boxes'][j]), 'score': float(predictions['scores'][j])})
+    gt = COCO()
+    gt.dataset = {'images': [{'id': i} for i in range(len(keep))], 'annotations': annotations,
+                  'categories': [{'id': c} for c in range(BACKGROUND)]}
+    gt.createIndex()
+    coco_eval = COCOeval(gt, gt.loadRes(detections), 'bbox')
+    coco_eval.evaluate()
+    coco_eval.accumulate()
+    coco_eval.summarize()
+
+    assert result['map'] == pytest.approx(coco_eval.stats[0], abs=1e-6)
+    assert result['map_50'] == pytest.approx(coco_eval.stats[1], abs=1e-6)
+    assert result['map_75'] == pytest.approx(coco_eval.stats[2], abs=1e-6)
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('iou_threshold, score_threshold', [
+    (0.5, 0.0),
+    ([0.3, 0.5, 0.7, 0.5], [0.6, 0.2, 0.4, 0.0]),
+])
+def test_detect_matches_batched_class_nms(seed, iou_threshold, score_threshold):
+    predictions = random_predictions(4, 30, seed)
+    keep = detect(predictions, iou_threshold=np.array(iou_threshold), score_threshold=np.array(score_threshold),
+                  pre_nms_top_k=20, max_detections=8)
+
+    # A one-hot probability of the saved score and label selects the same boxes in batched_class_nms
+    probs = torch.zeros((len(predictions['scores']), NUM_CLASSES))
+    probs[torch.arange(len(probs)), torch.as_tensor(predictions['labels'])] = torch.as_tensor(predictions['scores'])
+    image_idx = torch.arange(len(keep)).repeat_interleave(torch.as_tensor(np.diff(predictions['offsets'])))
+    expected, _, _ = batched_class_nms(
+        torch.as_tensor(predictions['boxes']), probs, image_idx, BACKGROUND,
+        iou_threshold=torch.tensor(iou_threshold), score_threshold=torch.tensor(score_threshold),
+        pre_nms_top_k=20, max_detections=8,
+    )
+    np.testing.assert_array_equal(np.concatenate(keep), expected.numpy())
+
+
+def test_save_and_load_predictions(tmp_path):
+    predictions = random_predictions(5, 6, seed=0)
+    # Two batches of 3 and 2 images with their own offsets
+    batches = []
+    for images in (slice(0, 3), slice(3, 5)):
+        rows = slice(predictions['offsets'][images.start], predictions['offsets'][images.stop])
+        gt_rows = slice(predictions['gt_offsets'][images.start], predictions['gt_offsets'][images.stop])
+        batches.append({
+            'boxes': predictions['boxes'][rows], 'scores': predictions['scores'][rows], 'labels': predictions['labels'][rows],
+            'offsets': predictions['offsets'][images.start:images.stop+1] - predictions['offsets'][images.start],
+            'gt_boxes': predictions['gt_boxes'][gt_rows], 'gt_labels': predictions['gt_labels'][gt_rows],
+            'gt_offsets': predictions['gt_offsets'][images.start:images.stop+1] - predictions['gt_offsets'][images.start],
+        })
+
+    path = tmp_path / 'predictions.npz'
+    save_predictions(path, batches, BACKGROUND, id2cat={0: 'Bottle'})
+    loaded = load_predictions(path)
+
+    for key in ('boxes', 'scores', 'labels', 'offsets', 'gt_boxes', 'gt_labels', 'gt_offsets'):
+        np.testing.assert_array_equal(loaded[key], predictions[key])
+    assert loaded['background'] == BACKGROUND
+    assert loaded['id2cat'] == {'0': 'Bottle'}
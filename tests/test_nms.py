@@ -0,0 +1,76 @@
+import pytest
+import torch
+from torchvision.ops import nms
+
+from src.utils import batched_class_nms, top_k_per_image
+
+NUM_CLASSES = 4
+BACKGROUND = NUM_CLASSES - 1
+
+
+def random_batch(num_images, num_boxes, seed):
+    torch.manual_seed(seed)
+    xy = torch.rand(num_images * num_boxes, 2) * 80
+    wh = torch.rand(num_images * num_boxes, 2) * 40 + 5
+    boxes = torch.cat([xy, xy + wh], dim=1)
+    probs = torch.softmax(3 * torch.randn(num_images * num_boxes, NUM_CLASSES), dim=1)
+    image_idx = torch.arange(num_images).repeat_interleave(num_boxes)
+    return boxes, probs, image_idx
+
+
+def reference_nms(boxes, probs, image_idx, iou_threshold, score_threshold, pre_nms_top_k, max_detections):
+    # One torchvision nms call per image and class, with per-class thresholds as lists
+    scores, labels = probs.max(dim=1)
+    keep = []
+    for i in image_idx.unique():
+        candidates = torch.tensor([j for j in torch.nonzero(image_idx == i).flatten().tolist()
+                                   if labels[j] != BACKGROUND and scores[j] >= score_threshold[labels[j]]], dtype=torch.long)
+        candidates = candidates[torch.argsort(scores[candidates], descending=True, stable=True)]
+        if pre_nms_top_k > 0:
+            candidates = candidates[:pre_nms_top_k]
+        image_keep = []
+        for c in range(NUM_CLASSES - 1):
+            idx = candidates[labels[candidates] == c]
+            image_keep.append(idx[nms(boxes[idx], scores[idx], iou_threshold[c])])
+        image_keep = torch.cat(image_keep)
+        image_keep = image_keep[torch.argsort(scores[image_keep], descending=True, stable=True)]
+        keep.append(image_keep[:max_detections] if max_detections > 0 else image_keep)
+    return torch.cat(keep)
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('iou_threshold, score_threshold', [
+    (0.5, 0.0),
+    (0.3, 0.4),
+    ([0.3, 0.5, 0.7, 0.5], 0.2),
+    (0.5, [0.6, 0.2, 0.4, 0.0]),
+    ([0.7, 0.4, 0.5, 0.5], [0.3, 0.5, 0.0, 0.0]),
+])
+@pytest.mark.parametrize('pre_nms_top_k, max_detections', [(-1, -1), (-1, 5), (15, -1), (15, 5)])
+def test_batched_class_nms_matches_per_image_nms(seed, iou_threshold, score_threshold, pre_nms_top_k, max_detections):
+    boxes, probs, image_idx = random_batch(3, 40, seed)
+    per_class = lambda value: value if isinstance(value, list) else [value] * NUM_CLASSES
+
+    keep, scores, labels = batched_class_nms(
+        boxes, probs, image_idx, BACKGROUND,
+        iou_threshold=torch.tensor(iou_threshold) if isinstance(iou_threshold, list) else iou_threshold,
+        score_threshold=torch.tensor(score_threshold) if isinstance(score_threshold, list) else score_threshold,
+        pre_nms_top_k=pre_nms_top_k, max_detections=max_detections,
+    )
+    expected = reference_nms(boxes, probs, image_idx, per_class(iou_threshold), per_class(score_threshold),
+                             pre_nms_top_k, max_detections)
+
+    torch.testing.assert_close(keep, expected)
+    assert (labels[keep] != BACKGROUND).all()
+
+
+def test_batched_class_nms_without_boxes():
+    keep, scores, labels = batched_class_nms(torch.zeros((0, 4)), torch.zeros((0, NUM_CLASSES)), torch.zeros(0, dtype=torch.long), BACKGROUND)
+    assert len(keep) == 0
+
+
+def test_top_k_per_image():
+    scores = torch.tensor([0.1, 0.9, 0.5, 0.7, 0.3, 0.8])
+    image_idx = torch.tensor([0, 0, 0, 1, 1, 1])
+    assert top_k_per_image(scores, image_idx, 2).tolist() == [1, 2, 5, 3]
+    assert top_k_per_image(scores, image_idx).tolist() == [1, 2, 0, 5, 3, 4]
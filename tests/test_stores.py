@@ -0,0 +1,179 @@
+import json
+import os
+import pickle
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from src.features.build_features import FeatureCache, FeatureCacheWriter, is_cached
+from src.data.project1.image_store import ImageStore, build_image_store, is_image_store
+from src.data.project4.annotations import load_annotation_index
+from src.data.project4.proposal_store import ProposalStore, write_proposal_store
+from src.data.project4.region_store import RegionStore, build_region_store
+
+
+def assert_lazy_attributes_dropped(store):
+    # Pickled stores, e.g. sent to DataLoader workers, reopen their maps on first access
+    store.ensure_open()
+    copy = pickle.loads(pickle.dumps(store))
+    assert all(getattr(copy, attribute) is None for attribute in copy.lazy_attributes)
+    return copy
+
+
+def test_feature_cache(tmp_path):
+    path = str(tmp_path / 'features')
+    features = torch.randn(7, 5)
+    writer = FeatureCacheWriter(path)
+    writer.add(features[:4], torch.tensor([0, 1, 0, 1]))
+    assert not is_cached(path)
+    writer.add(features[4:], [2, 2, 0])
+    cache = writer.close()
+
+    assert is_cached(path)
+    assert len(cache) == 7
+    for idx in range(7):
+        x, y = cache[idx]
+        torch.testing.assert_close(x, features[idx].half().float())
+        assert y == [0, 1, 0, 1, 2, 2, 0][idx]
+
+    copy = assert_lazy_attributes_dropped(FeatureCache(path))
+    torch.testing.assert_close(copy[6][0], cache[6][0])
+
+
+def test_proposal_store(tmp_path):
+    proposals = {
+        'b.jpg': [[0, 0, 10, 10], [5, 5, 2, 30], [1, 2, 40, 50]],
+        'a.jpg': [[3, 4, 5, 6]],
+        'c.jpg': [],
+    }
+    store = write_proposal_store(proposals, str(tmp_path / 'proposals'), min_box_size=4)
+
+    assert len(store) == 3 and 'a.jpg' in store and 'd.jpg' not in store
+    # Boxes of width or height up to min_box_size are dropped
+    np.testing.assert_array_equal(store['a.jpg'], [[3, 4, 5, 6]])
+    np.testing.assert_array_equal(store['b.jpg'], [[0, 0, 10, 10], [1, 2, 40, 50]])
+    assert store['c.jpg'].shape == (0, 4)
+    assert not store.has_matches
+
+    copy = assert_lazy_attributes_dropped(store)
+    np.testing.assert_array_equal(copy['b.jpg'], store['b.jpg'])
+
+
+def test_annotation_index(tmp_path):
+    anns_file_path = str(tmp_path / 'annotations.json')
+    with open(anns_file_path, 'w') as f:
+        json.dump({
+            'images': [
+                {'id': 7, 'file_name': 'a.jpg', 'width': 100, 'height': 50},
+                {'id': 3, 'file_name': 'b.jpg', 'width': 30, 'height': 60},
+                {'id': 5, 'file_name': 'c.jpg', 'width': 20, 'height': 20},
+            ],
+            'annotations': [
+                {'image_id': 3, 'bbox': [1, 2, 3, 4], 'category_id': 2},
+                {'image_id': 7, 'bbox': [5, 6, 7, 8], 'category_id': 1},
+                {'image_id': 3, 'bbox': [9, 10, 11, 12], 'category_id': 0},
+            ],
+            'categories': [
+                {'id': c, 'name': f'cat{c}', 'supercategory': 'super', 'extra': None} for c in range(3)
+            ],
+        }, f)
+    cache_dir = str(tmp_path / 'cache')
+    index = load_annotation_index(anns_file_path, cache_dir=cache_dir)
+
+    assert index.file_names == ['a.jpg', 'b.jpg', 'c.jpg']
+    assert index.categories[0] == {'id': 0, 'name': 'cat0', 'supercategory': 'super'}
+    boxes, category_ids = index.get(1)
+    np.testing.assert_array_equal(boxes, [[1, 2, 3, 4], [9, 10, 11, 12]])
+    np.testing.assert_array_equal(category_ids, [2, 0])
+    assert index.get(2)[0].shape == (0, 4)
+    assert index.get_size(1) == (30, 60)
+    # Built once, no temporary directories are left behind
+    assert os.listdir(cache_dir) == [os.path.basename(index.path)]
+
+    copy = assert_lazy_attributes_dropped(index)
+    np.testing.assert_array_equal(copy.get(0)[0], [[5, 6, 7, 8]])
+
+
+def test_image_store(tmp_path):
+    root = tmp_path / 'images'
+    colors = {}
+    for split, num_images in (('train', 3), ('test', 2)):
+        for label in ('hotdog', 'nothotdog'):
+            os.makedirs(root / split / label)
+            for i in range(num_images):
+                color = (len(colors) * 10, 255 - len(colors) * 10, 128)
+                Image.new('RGB', (20, 12), color).save(root / split / label / f'{i}.png')
+                colors[str(root / split / label / f'{i}.png')] = color
+
+    path = str(tmp_path / 'store')
+    build_image_store(str(root), path, img_size=(8, 6), batch_size=4, num_workers=0)
+    assert is_image_store(path)
+
+    for split, num_images in (('train', 6), ('test', 4)):
+        store = ImageStore(path, split=split)
+        assert len(store) == num_images
+        assert store.classes == ['hotdog', 'nothotdog']
+        for idx, (sample_path, label) in enumerate(store.samples):
+            x, y = store[idx]
+            assert x.shape == (3, 8, 6) and x.dtype == torch.uint8
+            assert y == label == (0 if '/hotdog/' in sample_path else 1)
+            np.testing.assert_array_equal(x[:, 0, 0].numpy(), colors[sample_path])
+
+    copy = assert_lazy_attributes_dropped(ImageStore(path, split='test'))
+    torch.testing.assert_close(copy[3][0], store[3][0])
+
+
+class FakeWasteDataset:
+    '''
+    Dataset with the attributes and (image, cat_ids, (gt_boxes, gt_regions), (pred_boxes, pred_regions))
+    samples that build_region_store reads from a WasteDataset.
+    '''
+    use_super_categories = True
+    decode_size = (32, 24)
+    region_size = (8, 8)
+    proposals_path = 'proposals'
+
+    def __init__(self, num_images):
+        generator = torch.Generator().manual_seed(0)
+        self.image_paths = [(f'batch_{idx}', f'batch_{idx}/{idx}.jpg') for idx in range(num_images)]
+        self.samples = []
+        for idx in range(num_images):
+            n_gt, n_pred = idx % 3, 2 + idx
+            self.samples.append((
+                torch.randint(0, 256, (3, 32, 24), dtype=torch.uint8, generator=generator),
+                torch.randint(0, 28, (n_gt, 1), generator=generator),
+                (torch.randint(0, 24, (n_gt, 4), generator=generator), torch.rand((n_gt, 3, 8, 8), generator=generator)),
+                (torch.randint(0, 24, (n_pred, 4), generator=generator), torch.rand((n_pred, 3, 8, 8), generator=generator)),
+            ))
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, idx):
+        return self.samples[idx]
+
+
+def test_region_store(tmp_path):
+    dataset = FakeWasteDataset(5)
+    store = build_region_store(dataset, str(tmp_path / 'regions'), shard_size=2, num_workers=0)
+
+    assert len(store) == 5 and store.num_shards == 3
+    for idx, (image, cat_ids, (bboxes, regions), (pred_bboxes, pred_regions)) in enumerate(dataset.samples):
+        stored_image, labels, boxes, stored_regions, n_gt = store[dataset.image_paths[idx][1]]
+        assert n_gt == len(bboxes)
+        torch.testing.assert_close(stored_image, image)
+        torch.testing.assert_close(labels, cat_ids)
+        torch.testing.assert_close(boxes, torch.cat([bboxes, pred_bboxes]).int())
+        # Float regions are quantized to uint8
+        torch.testing.assert_close(stored_regions.float() / 255, torch.cat([regions, pred_regions]), atol=1 / 510, rtol=0)
+
+    store.check_settings(use_super_categories=True, img_size=(32, 24), region_size=(8, 8), proposals_path='proposals')
+    with pytest.raises(ValueError, match='region_size'):
+        store.check_settings(use_super_categories=True, img_size=(32, 24), region_size=(16, 16), proposals_path='proposals')
+    with pytest.raises(ValueError, match='proposals_path'):
+        store.check_settings(proposals_path='other_proposals')
+
+    copy = assert_lazy_attributes_dropped(RegionStore(store.path))
+    torch.testing.assert_close(copy['batch_4/4.jpg'][3], store['batch_4/4.jpg'][3])